@@ -1,5 +1,7 @@
+import copy
 import json
-import re
+import os
+import threading
 from os import path as osp
 from pathlib import Path
 
@@ -7,6 +9,8 @@ import appdirs
 
 from .exceptions import ExitException
 from .okta import Okta
+from .predicates import parse, match_node, compile_predicate, \
+    filter_columnar
 
 
 def _check_config(config):
@@ -17,54 +21,209 @@ def _check_config(config):
     return config
 
 
+# the config file by (XDG_CONFIG_HOME, HOME), appdirs is slow-ish
+_config_files = {}
+
+# the last parsed config file: (file, mtime, size) and the parsed config
+_config_cache = {"key": None, "config": None}
+_config_lock = threading.Lock()
+
+
 def get_config_file():
-    config_dir = appdirs.user_config_dir("okta-cli")
-    config_file = osp.join(config_dir, "config.json")
+    env = (os.environ.get("XDG_CONFIG_HOME"), os.environ.get("HOME"))
+    config_file = _config_files.get(env)
+    if config_file is None:
+        config_dir = appdirs.user_config_dir("okta-cli")
+        config_file = _config_files[env] = osp.join(config_dir,
+                                                    "config.json")
     return config_file
 
 
-def load_config():
+def _read_config():
+    """
+    Parses the config file, but only if it changed (modification time or
+    size) since the last call. The cache lives in this process only, every
+    okta-cli run parses the file once.
+
+    :return: The config, shared between all callers - do not modify it
+    """
     config_file = get_config_file()
-    if not osp.isfile(config_file):
+    try:
+        stat = os.stat(config_file)
+    except FileNotFoundError:
         raise ExitException("okta-cli was not configured. Please run with "
                             "'config new' command.")
-    with open(config_file, "r") as fh:
-        return _check_config(json.loads(fh.read()))
+    key = (config_file, stat.st_mtime_ns, stat.st_size)
+    with _config_lock:
+        if _config_cache["key"] != key:
+            with open(config_file, "r") as fh:
+                config = _check_config(json.loads(fh.read()))
+            _config_cache.update(key=key, config=config)
+        return _config_cache["config"]
+
+
+def load_config():
+    """
+    :return: A copy of the config, which can be changed and saved with
+             save_config()
+    """
+    return copy.deepcopy(_read_config())
 
 
 def save_config(config_to_save):
     config_file = get_config_file()
     Path(osp.dirname(config_file)).mkdir(parents=True, exist_ok=True)
-    with open(config_file, "w") as fh:
+    # the file contains API tokens: only the user may read it, and readers
+    # never see a half-written file
+    tmp_file = config_file + ".tmp"
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "w") as fh:
         fh.write(json.dumps(config_to_save))
-
-
-def get_manager():
-    config = load_config()
-    if "default" not in config or config["default"] not in config["profiles"]:
-        raise ExitException("Default profile '{}' not configured. "
-                            "Use use-profile command to change it.")
-    return Okta(**config["profiles"][config["default"]])
-
-
-def filter_users(user_list, *, filters={}, partial=False):
-    if not filters:
-        return user_list
-
+    os.replace(tmp_file, config_file)
+    with _config_lock:
+        _config_cache["key"] = None
+
+
+def list_profiles():
+    """
+    :return: The names of all config profiles
+    """
+    return list(_read_config()["profiles"])
+
+
+def get_profile(name=None):
+    """
+    :param name: The profile name, None for the default profile
+    :return: A tuple (profile name, copy of the profile settings)
+    """
+    config = _read_config()
+    if name is None:
+        name = config.get("default")
+        if name not in config["profiles"]:
+            raise ExitException(f"Default profile '{name}' not configured. "
+                                f"Use use-context command to change it.")
+    elif name not in config["profiles"]:
+        raise ExitException(f"Unknown profile name: '{name}'.")
+    return name, copy.deepcopy(config["profiles"][name])
+
+
+def get_manager(profile=None):
+    """
+    :param profile: The profile name, None for the default profile
+    :return: An Okta client for the profile
+    """
+    return Okta(**get_profile(profile)[1])
+
+
+# characters which have a special meaning in a regular expression
+REGEX_META = set(".^$*+?{}[]|()")
+
+
+def _regex_literal(regex):
+    """
+    Returns the plain string a regular expression matches if it does not use
+    any regex features (escaped special chars are okay), otherwise None.
+    """
+    rv = []
+    chars = iter(regex)
+    for char in chars:
+        if char == "\\":
+            char = next(chars, "")
+            # \d, \w, \b etc. are not literals
+            if not char or char.isalnum():
+                return None
+        elif char in REGEX_META:
+            return None
+        rv.append(char)
+    return "".join(rv)
+
+
+def _quote_search_value(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _plan_one(field, regex, partial):
     if not partial:
-        filters = {k: re.compile(v).fullmatch for k, v in filters.items()}
+        # full match: "abc" -> eq, "abc.*" -> sw, "a|b" -> eq or eq
+        alternatives = regex.split("|")
+        if len(alternatives) > 1:
+            literals = [_regex_literal(x) for x in alternatives]
+            if all(literals):
+                return "(" + " or ".join(
+                        f"{field} eq {_quote_search_value(x)}"
+                        for x in literals) + ")"
+            return None
+        if regex.endswith(".*") and not regex.endswith("\\.*"):
+            literal = _regex_literal(regex[:-2])
+            op = "sw"
+        else:
+            literal = _regex_literal(regex)
+            op = "eq"
     else:
-        filters = {k: re.compile(v).search for k, v in filters.items()}
-
-    def _match(user):
-        for k, check_func in filters.items():
-            user_value = user["profile"].get(k, None)
-            # user does not have the key? go away.
-            if user_value is None:
-                return False
-            # user has the key? let's do an exact string match
-            if not check_func(user_value):
-                return False
-        return True
-
-    return filter(_match, user_list)
+        # partial match: only anchored expressions can be pushed down
+        if not regex.startswith("^"):
+            return None
+        regex = regex[1:]
+        if regex.endswith("$") and not regex.endswith("\\$"):
+            literal = _regex_literal(regex[:-1])
+            op = "eq"
+        else:
+            if regex.endswith(".*") and not regex.endswith("\\.*"):
+                regex = regex[:-2]
+            literal = _regex_literal(regex)
+            op = "sw"
+    if not literal:
+        return None
+    return f"{field} {op} {_quote_search_value(literal)}"
+
+
+def plan_user_search(filters, *, partial=False, search_query=""):
+    """
+    Translates the match filters of 'users list' into an Okta search
+    expression where possible, so Okta does the filtering and we do not
+    have to download all users.
+
+    Plain strings become "eq", a trailing ".*" (or, for partial matches, a
+    leading "^") becomes "sw", and alternatives of plain strings ("a|b")
+    become "or" expressions. All translated filters are combined with
+    "and". Filters which cannot be translated are simply left out.
+
+    The result is only a pre-selection: Okta compares case-insensitively,
+    so filter_users() must still be applied to the result.
+
+    :param filters: A dict {profile_field: regex}
+    :param partial: Whether the regexes are partial matches (re.search)
+    :param search_query: An existing search expression to combine with
+    :return: The search expression, or "" if nothing could be translated
+    """
+    parts = [_plan_one("profile." + k, v, partial) for k, v in filters.items()]
+    parts = [x for x in parts if x]
+    if not parts:
+        return search_query
+    if search_query:
+        parts.insert(0, f"({search_query})")
+    return " and ".join(parts)
+
+
+def filter_users(user_list, *, filters={}, partial=False, where=None,
+                 columnar=False):
+    """
+    Filters a list of users.
+
+    :param user_list: The users, any iterable
+    :param filters: A dict {profile_field: regex}, all must match
+    :param partial: Use re.search() instead of re.fullmatch() for filters
+    :param where: An additional filter expression, see predicates.parse()
+    :param columnar: Evaluate column-wise using numpy (returns a list)
+    :return: An iterable of the matching users
+    """
+    nodes = [match_node(("profile", k), v, partial=partial)
+             for k, v in filters.items()]
+    if where:
+        nodes.append(parse(where))
+    if not nodes:
+        return user_list
+    node = nodes[0] if len(nodes) == 1 else ("and", nodes)
+    if columnar:
+        return filter_columnar(node, user_list)
+    return filter(compile_predicate(node), user_list)
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+
+import appdirs
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+# seconds a cached response is used without asking Okta again, per
+# endpoint (see Okta.endpoint_of()). endpoints not listed are not cached.
+DEFAULT_TTLS = {
+    "/meta/schemas/user/default": 3600,
+    "/apps":                      300,
+    "/apps/{id}":                 300,
+    "/groups":                    300,
+    "/groups/{id}":               300,
+    "/users/{id}":                60,
+}
+
+# the response headers we keep
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Link")
+
+# entries not used for this long are removed
+MAX_AGE = 7 * 24 * 3600
+
+
+def default_cache_file():
+    return os.path.join(appdirs.user_cache_dir("okta-cli"),
+                        "http-cache.sqlite")
+
+
+class CacheEntry:
+
+    def __init__(self, url, headers, body, stored_at):
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+
+    def age(self):
+        return time.time() - self.stored_at
+
+    def conditional_headers(self):
+        """
+        :return: The headers for a conditional request (If-None-Match /
+                 If-Modified-Since), empty if the response had no validators
+        """
+        rv = {}
+        if "ETag" in self.headers:
+            rv["If-None-Match"] = self.headers["ETag"]
+        if "Last-Modified" in self.headers:
+            rv["If-Modified-Since"] = self.headers["Last-Modified"]
+        return rv
+
+    def response(self):
+        """
+        :return: A requests.Response with the cached content
+        """
+        rsp = requests.Response()
+        rsp.status_code = 200
+        rsp.url = self.url
+        rsp.headers = CaseInsensitiveDict(self.headers)
+        rsp._content = self.body
+        rsp.encoding = "utf-8"
+        rsp.elapsed = timedelta(0)
+        return rsp
+
+
+class ResponseCache:
+    """
+    An on-disk cache for GET responses of the Okta API, stored in an SQLite
+    database.
+
+    Responses of endpoints with a TTL are used without any request while
+    they are younger than the TTL. After that they are revalidated with a
+    conditional request (If-None-Match / If-Modified-Since) if Okta sent an
+    ETag or Last-Modified header, so an unchanged resource costs only a
+    304 response.
+
+    Any write request (POST, PUT, DELETE) drops the cached responses of the
+    same collection, e.g. updating a user drops all cached "/users..."
+    responses.
+    """
+
+    def __init__(self, file=None, *, ttls=None, scope=""):
+        """
+        :param file: The database file, default: in the user cache dir
+        :param ttls: TTLs by endpoint (seconds), added to DEFAULT_TTLS
+        :param scope: Separates the entries of different Okta tenants and
+                      tokens (usually the URL and the API token)
+        """
+        self.file = file or default_cache_file()
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.scope = hashlib.sha256(scope.encode("utf-8")).hexdigest()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.file)),
+                    exist_ok=True)
+        self.db = sqlite3.connect(self.file, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                scope TEXT,
+                collection TEXT,
+                url TEXT,
+                headers TEXT,
+                body BLOB,
+                stored_at REAL
+            );
+        """)
+        self.db.execute("DELETE FROM responses WHERE stored_at < ?",
+                        (time.time() - MAX_AGE,))
+
+    def ttl_of(self, endpoint):
+        """
+        :return: The TTL of an endpoint, None if it is not cached
+        """
+        return self.ttls.get(endpoint)
+
+    def _key(self, url):
+        return hashlib.sha256((self.scope + url).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _collection(endpoint):
+        # "/users/{id}/groups" -> "/users"
+        return "/" + endpoint.strip("/").split("/")[0]
+
+    def get(self, url):
+        """
+        :param url: The full request URL, including the query string
+        :return: A CacheEntry or None
+        """
+        with self._lock:
+            row = self.db.execute(
+                    "SELECT url, headers, body, stored_at FROM responses "
+                    "WHERE key = ?", (self._key(url),)).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(row[0], json.loads(row[1]), row[2], row[3])
+
+    def put(self, url, endpoint, rsp):
+        """
+        Stores a (successful) response.
+        """
+        headers = {k: rsp.headers[k] for k in STORED_HEADERS
+                   if k in rsp.headers}
+        with self._lock:
+            self.db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?)",
+                    (self._key(url), self.scope, self._collection(endpoint),
+                     url, json.dumps(headers), rsp.content, time.time()))
+
+    def touch(self, url):
+        """
+        Marks an entry as fresh again, e.g. after a 304 response.
+        """
+        with self._lock:
+            self.db.execute("UPDATE responses SET stored_at = ? "
+                            "WHERE key = ?", (time.time(), self._key(url)))
+
+    def invalidate(self, endpoint):
+        """
+        Drops all entries of the collection of an endpoint.
+        """
+        with self._lock:
+            self.db.execute("DELETE FROM responses "
+                            "WHERE scope = ? AND collection = ?",
+                            (self.scope, self._collection(endpoint)))
+
+    def clear(self):
+        with self._lock:
+            self.db.execute("DELETE FROM responses")
+            self.db.execute("VACUUM")
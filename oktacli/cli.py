@@ -1,29 +1,47 @@
 import json
+import os
 import sys
 import collections
 import csv
+import io
 import re
+import tempfile
 from datetime import datetime as dt
+from contextlib import contextmanager
 from functools import wraps
+from itertools import chain, islice
 from os.path import splitext, join, isdir
-from os import mkdir
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import requests
 import click
 from dotted.collection import DottedDict, DottedCollection
 from requests.exceptions import HTTPError as RequestsHTTPError
-from openpyxl import load_workbook
 
 from .api import load_config, save_config, get_manager, filter_users, get_config_file
+from .api import list_profiles
+from .api import plan_user_search
+from .cache import ResponseCache
+from .diff import CHUNK_SIZE, TABLES, diff_dumps, diff_snapshots
 from .okta import REST
-from .exceptions import ExitException
+from .parallel import batched, inheriting, ordered_map, run_parallel
+from .parallel import thread_values
+from .pwgen import generate_password, generate_passwords
+from .readers import read_rows
+from .retry import RetryPolicy
+from .schema import compile_schema, validate_row
+from .trace import Tracer, read_trace, analyze
+from .exceptions import ExitException, DeadlineExceeded
 
 
 VERSION = "10.0.0"
 
 okta_manager = None
 config = None
+# settings of the Okta client given on the command line (see cli_main())
+client_options = {"timeouts": {}, "deadline": None, "cache": None,
+                  "stats": False, "stats_file": None, "trace": None,
+                  "profiles": None}
 
 # https://is.gd/T1enMM
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -74,40 +92,260 @@ def _dump_csv(print_obj, *, dialect=None, out=sys.stdout, fields=None):
         writer.writerow(_dict_nested_to_flat(obj))
 
 
+def _dump_csv_spooled(objects, file):
+    """
+    Like _dump_csv() into file, but for any number of objects (e.g. from
+    Okta.iter_users()): the header needs the columns of all rows, so the
+    rows are spooled to a temporary file first instead of kept in memory.
+    """
+    columns = set()
+    with tempfile.TemporaryFile("w+", encoding="utf-8",
+                                dir=os.path.dirname(file) or None) as spool:
+        for obj in objects:
+            row = _dict_nested_to_flat(obj)
+            columns.update(row)
+            spool.write(json.dumps(row) + "\n")
+        spool.seek(0)
+        with open(file, "w") as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=sorted(columns),
+                                    extrasaction='ignore')
+            writer.writeheader()
+            for line in spool:
+                writer.writerow(json.loads(line))
+
+
+def _configured_manager(profile=None, tracer=None):
+    """
+    :param profile: The config profile, None for the default profile
+    :param tracer: A Tracer to use, default: a new one if --trace is given
+    :return: An Okta client with the settings of the command line
+    """
+    manager = get_manager(profile)
+    manager.set_timeouts(**client_options["timeouts"])
+    manager.set_deadline(client_options["deadline"])
+    if client_options["cache"] is not None and \
+            client_options["cache"] != bool(manager.cache):
+        manager.set_cache(client_options["cache"])
+    if tracer is None and client_options["trace"]:
+        tracer = Tracer(client_options["trace"])
+    if tracer is not None:
+        manager.set_tracer(tracer)
+    return manager
+
+
+def _print_result(rv, kwargs):
+    if rv is None:
+        # the command printed everything itself
+        pass
+    elif not isinstance(rv, str):
+        if kwargs.get("print_json", False) is True:
+            print(json.dumps(rv, indent=2, sort_keys=True))
+        elif kwargs.get("print_yaml", False) is True:
+            raise ExitException("YAML printing not (yet) implemented.")
+        elif kwargs.get("print_csv", False) is True:
+            _dump_csv(rv, dialect=kwargs['csv_dialect'])
+        elif "output_fields" in kwargs and len(rv) > 0:
+            _print_table_from(rv, kwargs["output_fields"])
+        else:
+            # default fallback setting - print json.
+            print(json.dumps(rv, indent=2, sort_keys=True))
+    else:
+        print(rv)
+
+
+@contextmanager
+def _handled_errors():
+    """
+    Prints errors instead of a traceback, and exits with -1 for an
+    ExitException and with -2 for anything else.
+    """
+    try:
+        yield
+    except ExitException as e:
+        print("ERROR: {}".format(str(e)), file=sys.stderr)
+        sys.exit(-1)
+    except Exception as e:
+        print(f"SOMETHING REALLY BAD HAPPENED\n{str(type(e))}"
+              f"!\nERROR: {e}",
+              file=sys.stderr)
+        sys.exit(-2)
+
+
 def _command_wrapper(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         global okta_manager
         global config
+        if client_options["profiles"]:
+            return _run_for_profiles(func, args, kwargs)
+        okta_manager = None
         try:
-            okta_manager = get_manager()
-            rv = func(*args, **kwargs)
-            if not isinstance(rv, str):
-                if kwargs.get("print_json", False) is True:
-                    print(json.dumps(rv, indent=2, sort_keys=True))
-                elif kwargs.get("print_yaml", False) is True:
-                    raise ExitException("YAML printing not (yet) implemented.")
-                elif kwargs.get("print_csv", False) is True:
-                    _dump_csv(rv, dialect=kwargs['csv_dialect'])
-                elif "output_fields" in kwargs and len(rv) > 0:
-                    _print_table_from(rv, kwargs["output_fields"])
-                else:
-                    # default fallback setting - print json.
-                    print(json.dumps(rv, indent=2, sort_keys=True))
-            else:
-                print(rv)
-        except ExitException as e:
-            print("ERROR: {}".format(str(e)), file=sys.stderr)
-            sys.exit(-1)
-        except Exception as e:
-            print(f"SOMETHING REALLY BAD HAPPENED\n{str(type(e))}"
-                  f"!\nERROR: {e}",
-                  file=sys.stderr)
-            sys.exit(-2)
+            with _handled_errors():
+                okta_manager = _configured_manager()
+                _print_result(func(*args, **kwargs), kwargs)
+        finally:
+            _report_stats(okta_manager)
 
     return wrapper
 
 
+def _report_stats(manager, *, close_tracer=True):
+    if manager is None:
+        return
+    if close_tracer and manager.tracer is not None:
+        manager.tracer.close()
+    stats = manager.stats
+    if client_options["stats"]:
+        print(stats.summary(), file=sys.stderr)
+    stats_file = client_options["stats_file"]
+    if stats_file:
+        # ".prom" files are picked up by the node_exporter textfile collector
+        prometheus = splitext(stats_file)[1].lower() == ".prom"
+        with open(stats_file, "w") as outfile:
+            outfile.write(stats.to_prometheus() if prometheus
+                          else stats.to_json())
+
+
+class _ProfileClient:
+    """
+    The okta_manager with --profiles: forwards everything to the Okta client
+    of the profile the current thread works for.
+    """
+
+    def __getattr__(self, name):
+        return getattr(thread_values()["okta_manager"], name)
+
+
+class _ThreadOutput:
+    """
+    Replaces sys.stdout with --profiles, so every profile's output is
+    collected separately (in thread_values()["stdout"]).
+    """
+
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, data):
+        return thread_values().get("stdout", self.out).write(data)
+
+    def flush(self):
+        thread_values().get("stdout", self.out).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+
+def _current_profile():
+    """
+    :return: The profile the current thread works for with --profiles,
+             None otherwise
+    """
+    return thread_values().get("config_profile")
+
+
+def _confirm(prompt, expected):
+    """
+    Asks the user to enter expected (e.g. the login of the user to delete),
+    raises ExitException on anything else. With --profiles the prompts of
+    all profiles would race for stdin, so --no-confirmation is required.
+    """
+    if _current_profile():
+        raise ExitException("Cannot ask for confirmation with --profiles, "
+                            "use --no-confirmation.")
+    if input(prompt) != expected:
+        raise ExitException("Aborted.")
+
+
+def _profile_suffix():
+    # keeps the output files of different profiles apart
+    profile = _current_profile()
+    return f"-{profile}" if profile else ""
+
+
+def _run_for_profiles(func, args, kwargs):
+    """
+    Runs a command for several config profiles at the same time, each in
+    its own thread with its own Okta client (and so its own rate limits
+    and concurrency limiter).
+
+    Lists and objects returned by the command are merged, with the profile
+    name in a "config_profile" column. Everything else is printed per
+    profile, after a "==> PROFILE <==" line.
+    """
+    global okta_manager
+    profiles = client_options["profiles"]
+    if profiles is True:
+        profiles = list_profiles()
+    if client_options["stats_file"]:
+        print("ERROR: --stats-file cannot be used with --profiles.",
+              file=sys.stderr)
+        sys.exit(-1)
+    tracer = Tracer(client_options["trace"]) \
+        if client_options["trace"] else None
+
+    def run(profile):
+        values = thread_values()
+        values.clear()
+        values.update(config_profile=profile, stdout=io.StringIO())
+        manager = None
+        try:
+            manager = values["okta_manager"] = \
+                _configured_manager(profile, tracer)
+            return values["stdout"], manager, func(*args, **kwargs)
+        except Exception as e:
+            e.output = values["stdout"]
+            e.manager = manager
+            raise
+
+    okta_manager = _ProfileClient()
+    stdout = sys.stdout
+    sys.stdout = _ThreadOutput(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=len(profiles)) as ex:
+            futures = [ex.submit(run, profile) for profile in profiles]
+    finally:
+        sys.stdout = stdout
+        if tracer is not None:
+            tracer.close()
+
+    merged = []
+    exit_code = 0
+    for profile, future in zip(profiles, futures):
+        error = future.exception()
+        if error is None:
+            output, manager, rv = future.result()
+        else:
+            output, manager, rv = getattr(error, "output", None), \
+                getattr(error, "manager", None), None
+        if isinstance(rv, dict):
+            rv = [rv]
+        if isinstance(rv, list):
+            merged += [dict(item, config_profile=profile) for item in rv]
+            rv = None
+        if (output and output.getvalue()) or rv is not None:
+            print(f"==> {profile} <==")
+            print(output.getvalue() if output else "", end="")
+            if rv is not None:
+                print(rv)
+        if isinstance(error, ExitException):
+            print(f"ERROR: [{profile}] {error}", file=sys.stderr)
+            exit_code = min(exit_code, -1)
+        elif error is not None:
+            print(f"SOMETHING REALLY BAD HAPPENED\n[{profile}] "
+                  f"{str(type(error))}!\nERROR: {error}", file=sys.stderr)
+            exit_code = -2
+        if client_options["stats"] and manager is not None:
+            print(f"==> {profile} <==", file=sys.stderr)
+            _report_stats(manager, close_tracer=False)
+    if merged:
+        if kwargs.get("output_fields"):
+            kwargs = dict(kwargs, output_fields="config_profile," +
+                          kwargs["output_fields"])
+        _print_result(merged, kwargs)
+    if exit_code:
+        sys.exit(exit_code)
+
+
 def _output_type_command_wrapper(default_fields):
     def _output_type_command_wrapper_inner(func):
         @wraps(func)
@@ -130,6 +368,56 @@ def _output_type_command_wrapper(default_fields):
     return _output_type_command_wrapper_inner
 
 
+def _parallel_options(func):
+    """
+    Adds the concurrency options shared by all commands which fire many
+    requests in parallel (workers, max_workers, adaptive).
+    """
+    func = click.option("--adaptive/--no-adaptive", default=True,
+                        help="Adapt the number of parallel requests to the "
+                             "rate limit and errors, default: True")(func)
+    func = click.option("--max-workers", metavar="NUM", default=100,
+                        help="never use more than NUM parallel requests "
+                             "with --adaptive, default: 100")(func)
+    func = click.option("-w", "--workers", metavar="NUM", default=25,
+                        help="start with NUM parallel requests (always use "
+                             "NUM with --no-adaptive), default: 25")(func)
+    return func
+
+
+def _get_limiter(workers, max_workers, adaptive):
+    return okta_manager.get_limiter(workers,
+                                    max_workers=max_workers,
+                                    adaptive=adaptive)
+
+
+def _parse_retries(settings):
+    """
+    Converts "CLASS=N" strings (e.g. "server=10", "throttled=unlimited",
+    "base_delay=0.5") into the retry settings of a config profile.
+    """
+    rv = {}
+    for setting in settings:
+        key, sep, value = setting.partition("=")
+        key = key.strip().replace("-", "_")
+        try:
+            if not sep:
+                raise ValueError
+            if key in ("base_delay", "max_delay"):
+                rv[key] = float(value)
+            elif value.strip().lower() in ("unlimited", "none"):
+                rv[key] = None
+            else:
+                rv[key] = int(value)
+        except ValueError:
+            raise ExitException(f"Invalid retry setting: '{setting}'")
+    try:
+        RetryPolicy(**rv)
+    except ValueError as e:
+        raise ExitException(str(e))
+    return rv
+
+
 def _dict_flat_to_nested(flat_dict, defaults=None):
     """
     Takes a "flat" dictionary, whose keys are of the form "one.two.three".
@@ -227,16 +515,41 @@ def cli_config():
               help="The base URL of Okta, e.g. 'https://my.okta.com'.")
 @click.option("-t", "--token", required=True, prompt=True,
               help="The API token to use")
-def config_new(name, url, token):
+@click.option("-r", "--retry", "retries", multiple=True, metavar="CLASS=N",
+              help="Retry failed requests up to N times (or 'unlimited'). "
+                   "CLASS is throttled (429, default: unlimited), server "
+                   "(502/503/504, default: 4), connection (default: 3) or "
+                   "timeout (default: 2); base_delay and max_delay set the "
+                   "backoff in seconds. Can be given multiple times.")
+@click.option("--connect-timeout", metavar="SECONDS", type=float,
+              help="Timeout for connecting to Okta, default: 10")
+@click.option("--read-timeout", metavar="SECONDS", type=float,
+              help="Timeout for waiting for a response, default: 60")
+@click.option("--cache", is_flag=True,
+              help="Cache responses of read requests on disk")
+def config_new(name, url, token, retries, connect_timeout, read_timeout,
+               cache):
     """
     Create a new configuration profile
     """
     global config
+    try:
+        retries = _parse_retries(retries)
+    except ExitException as e:
+        raise click.BadParameter(str(e), param_hint="'-r' / '--retry'")
     try:
         config = load_config()
     except ExitException:
         config = dict(profiles={})
     config["profiles"][name] = dict(url=url, token=token)
+    if retries:
+        config["profiles"][name]["retries"] = retries
+    timeouts = {k: v for k, v in (("connect", connect_timeout),
+                                  ("read", read_timeout)) if v is not None}
+    if timeouts:
+        config["profiles"][name]["timeouts"] = timeouts
+    if cache:
+        config["profiles"][name]["cache"] = True
     save_config(config)
     print("Profile '{}' added.".format(name))
 
@@ -302,6 +615,15 @@ def config_file():
     return get_config_file()
 
 
+@cli_config.command(name="clear-cache", context_settings=CONTEXT_SETTINGS)
+def config_clear_cache():
+    """
+    Delete all cached responses
+    """
+    ResponseCache().clear()
+    print("Cache cleared.")
+
+
 @cli_config.command(name="current-context", context_settings=CONTEXT_SETTINGS)
 @_command_wrapper
 def config_current_context():
@@ -349,16 +671,9 @@ def pw_expire(login_or_id, temp_password):
 @_command_wrapper
 def pw_set(login_or_id, set_password, generate, language, min_length):
     """Expire the password of a user"""
-    # import here cause it takes time it seems ...
-    from .pwgen import generate_password
-    default_password_length = 5
-    num_words = max(3, int(min_length / default_password_length + 3))
     if generate:
-        words = generate_password(num_words, lang=language)
-        for i in range(3, num_words):
-            set_password = " ".join(words[:i])
-            if len(set_password) >= min_length:
-                break
+        words = generate_password(_password_words(min_length), lang=language)
+        set_password = _passphrase(words, min_length)
     elif not set_password:
         raise ExitException("Either use -s or -g!")
     profile_dict = {"credentials.password.value": set_password}
@@ -367,6 +682,247 @@ def pw_set(login_or_id, set_password, generate, language, min_length):
     return set_password
 
 
+def _password_words(min_length):
+    # the number of words to draw for a password of min_length
+    default_password_length = 5
+    return max(3, int(min_length / default_password_length + 3))
+
+
+def _passphrase(words, min_length):
+    # the shortest passphrase of at least 3 words and min_length characters
+    for i in range(3, len(words) + 1):
+        password = " ".join(words[:i])
+        if len(password) >= min_length:
+            break
+    return password
+
+
+def _bulk_user_options(func):
+    """
+    Adds the options shared by the commands which run an operation for many
+    users (user list or search, results file, concurrency).
+    """
+    func = _parallel_options(func)
+    func = click.option("--resume", metavar="FILE", default=None,
+                        help="Skip the users which were done successfully "
+                             "according to the results FILE of an earlier "
+                             "run")(func)
+    func = click.option("-o", "--output", metavar="FILE", default=None,
+                        help="Write the results to FILE (CSV), default: "
+                             "okta-OPERATION-TIMESTAMP.csv; with --profiles "
+                             "the profile is added to the name")(func)
+    func = click.option("--search", metavar="EXPR", default=None,
+                        help="Use all users matching this Okta search "
+                             "expression, e.g. "
+                             "'profile.department eq \"IT\"'")(func)
+    func = click.option("-f", "--file", "user_file", metavar="FILE",
+                        default=None,
+                        help="Read user IDs or logins from FILE, one per "
+                             "line ('-' for stdin)")(func)
+    return func
+
+
+def _bulk_users(user_file, search, resume=None, operation=None):
+    """
+    :param resume: A results file of _run_bulk(), users which are "ok" in
+                   it are skipped
+    :param operation: The operation of this run, the results file must be
+                      of the same operation
+    :return: A generator of the user IDs or logins given with -f or
+             --search
+    """
+    if user_file and search:
+        raise ExitException("Use either -f or --search, not both.")
+    if user_file:
+        users = _read_user_list(user_file)
+    elif search:
+        users = (user["profile"]["login"]
+                 for user in okta_manager.iter_users(search_query=search))
+    else:
+        raise ExitException("Either use -f or --search.")
+    if not resume:
+        return users
+    try:
+        with open(resume, "r", newline="", encoding="utf-8") as fh:
+            rows = list(csv.DictReader(fh))
+    except OSError as e:
+        raise ExitException(f"Cannot read results file {resume}: {e}")
+    # "ok" for a deactivate doesn't mean the user is deleted
+    other = {row.get("operation") for row in rows} - {operation}
+    if other:
+        found = ", ".join(sorted(x or "unknown" for x in other))
+        raise ExitException(f"The results file {resume} is of another "
+                            f"operation ({found}), not {operation}.")
+    done = {row["user"] for row in rows if row.get("result") == "ok"}
+    return (user for user in users if user not in done)
+
+
+def _open_results(output, operation):
+    # the results can contain passwords, so only the user may read them
+    if output is None:
+        timestamp_str = dt.now().strftime("%Y%m%d_%H%M%S")
+        output = f"okta-{operation}{_profile_suffix()}-{timestamp_str}.csv"
+    else:
+        # with --profiles "out.csv" becomes "out-PROFILE.csv"
+        root, ext = splitext(output)
+        output = f"{root}{_profile_suffix()}{ext}"
+    fh = open(output, "w", newline="", encoding="utf-8",
+              opener=lambda path, flags: os.open(path, flags, 0o600))
+    return output, fh
+
+
+def _run_bulk(operation, func, items, output, workers, max_workers,
+              adaptive):
+    """
+    Runs an operation for many users in parallel, and writes one CSV row
+    (user, result, detail, operation) per user to the results file as soon as it is
+    done. With --deadline no new operations are started after the
+    deadline, and the remaining users are not read at all (so they are
+    not in the results file). Operations which were running when the
+    deadline was reached are written with the result "skipped". Both are
+    done by a later run with --resume, which skips only the "ok" users.
+
+    :param operation: The name of the operation, e.g. "pw-expire"
+    :param func: Called with every item, returns the detail for the
+                 results file
+    :param items: Tuples, the first element is the user
+    :return: A summary
+    """
+    counts = collections.Counter()
+    progress = {"stopped": False}
+
+    def until_deadline():
+        for item in items:
+            if okta_manager.deadline_reached():
+                progress["stopped"] = True
+                break
+            yield item
+
+    output, fh = _open_results(output, operation)
+    with fh:
+        writer = csv.writer(fh)
+        writer.writerow(("user", "result", "detail", "operation"))
+        limiter = _get_limiter(workers, max_workers, adaptive)
+        for item, detail, error in run_parallel(func, until_deadline(),
+                                                limiter=limiter):
+            if isinstance(error, DeadlineExceeded):
+                result, detail = "skipped", "deadline reached"
+            elif error is not None:
+                result, detail = "error", str(error)
+            else:
+                result = "ok"
+            counts[result] += 1
+            writer.writerow((item[0], result,
+                             detail if detail is not None else "",
+                             operation))
+            fh.flush()
+    rv = (f"{counts['ok']} ok, {counts['error']} errors, "
+          f"{counts['skipped']} skipped - {output}")
+    if counts["skipped"] or progress["stopped"]:
+        print(rv)
+        raise DeadlineExceeded(f"Deadline reached, continue with "
+                               f"'--resume {output}'.")
+    return rv
+
+
+@cli_pw.command(name="bulk-reset", context_settings=CONTEXT_SETTINGS)
+@click.option("-n", "--no-email", is_flag=True)
+@_bulk_user_options
+@_command_wrapper
+def pw_bulk_reset(no_email, user_file, search, output, resume, workers,
+                  max_workers, adaptive):
+    """Reset the passwords of many users
+
+    The users are read from a file (-f) or found with an Okta search
+    expression (--search). The results are written to a CSV file as they
+    come in; with -n it contains the reset URLs.
+
+    \b
+    okta-cli pw bulk-reset -f logins.txt -n -o reset-urls.csv
+    """
+    def reset(item):
+        rv = okta_manager.reset_password(item[0], send_email=not no_email)
+        return rv.get("resetPasswordUrl")
+
+    users = ((user,) for user in _bulk_users(user_file, search, resume,
+                                             "pw-reset"))
+    return _run_bulk("pw-reset", reset, users, output,
+                     workers, max_workers, adaptive)
+
+
+@cli_pw.command(name="bulk-expire", context_settings=CONTEXT_SETTINGS)
+@click.option("-t", "--temp-password", is_flag=True)
+@_bulk_user_options
+@_command_wrapper
+def pw_bulk_expire(temp_password, user_file, search, output, resume,
+                   workers, max_workers, adaptive):
+    """Expire the passwords of many users
+
+    The users are read from a file (-f) or found with an Okta search
+    expression (--search). The results are written to a CSV file as they
+    come in; with -t it contains the temporary passwords.
+
+    \b
+    okta-cli pw bulk-expire --search 'profile.department eq "IT"'
+    """
+    def expire(item):
+        rv = okta_manager.expire_password(item[0],
+                                          temp_password=temp_password)
+        return rv.get("tempPassword")
+
+    users = ((user,) for user in _bulk_users(user_file, search, resume,
+                                             "pw-expire"))
+    return _run_bulk("pw-expire", expire, users, output,
+                     workers, max_workers, adaptive)
+
+
+@cli_pw.command(name="bulk-set", context_settings=CONTEXT_SETTINGS)
+@click.option("-s", "--set", "set_password",
+              help="set all passwords to this")
+@click.option("-g", "--generate", is_flag=True,
+              help="generate a random password for every user")
+@click.option("-l", "--language", default="en",
+              help="use a word list from this language")
+@click.option("-m", "--min-length", type=int, default=14,
+              help="minimal password length")
+@_bulk_user_options
+@_command_wrapper
+def pw_bulk_set(set_password, generate, language, min_length, user_file,
+                search, output, resume, workers, max_workers, adaptive):
+    """Set the passwords of many users
+
+    The users are read from a file (-f) or found with an Okta search
+    expression (--search). The results file contains the passwords, it is
+    only readable by you.
+
+    \b
+    okta-cli pw bulk-set -g -f logins.txt -o new-passwords.csv
+    """
+    if not generate and not set_password:
+        raise ExitException("Either use -s or -g!")
+
+    def with_passwords(users):
+        num_words = _password_words(min_length)
+        for batch in batched(users, 500):
+            if generate:
+                passwords = [_passphrase(words, min_length) for words in
+                             generate_passwords(len(batch), num_words,
+                                                lang=language)]
+            else:
+                passwords = [set_password] * len(batch)
+            yield from zip(batch, passwords)
+
+    def set_one(item):
+        user, password = item
+        okta_manager.update_user(
+                user, {"credentials": {"password": {"value": password}}})
+        return password
+
+    users = with_passwords(_bulk_users(user_file, search, resume, "pw-set"))
+    return _run_bulk("pw-set", set_one, users, output,
+                     workers, max_workers, adaptive)
+
+
 @click.group(name="groups")
 def cli_groups():
     """Group operations"""
@@ -460,9 +1016,10 @@ def groups_removeuser(group, user, **kwargs):
 
     Note that you must use Okta's user and group IDs.
     """
+    # removing a member twice does no harm
     rsp = okta_manager.call_okta_raw(
             f"/groups/{group}/users/{user}",
-            REST.delete)
+            REST.delete, idempotent=True)
     return f"User {user} removed from group {group}"
 
 
@@ -496,7 +1053,7 @@ def groups_clear(name_or_id, use_id):
         user_login = user['profile']['login']
         print(f"Removing user {user_login} ... ", file=sys.stderr, end="")
         path = f"/groups/{name_or_id}/users/{user_id}"
-        okta_manager.call_okta_raw(path, REST.delete)
+        okta_manager.call_okta_raw(path, REST.delete, idempotent=True)
         print("ok", file=sys.stderr)
     return "All users removed"
 
@@ -670,22 +1227,99 @@ def apps_list(api_filter, partial_name, **kwargs):
 @cli_apps.command(name="users", context_settings=CONTEXT_SETTINGS)
 @click.argument("app_id")
 @click.option("-i", "--id", "use_id", is_flag=True,
-              help="Use Okta app ID instead of app name")
+              help="Use Okta app ID instead of app label or name")
 @_output_type_command_wrapper("id,syncState,credentials.userName")
 def apps_users(app_id, use_id, **kwargs):
-    """List all users for an application"""
+    """List all users for an application
+
+    The app is looked up by label (as shown in the Okta UI) or name, and
+    by regular expression if nothing matches exactly.
+    """
     if not use_id:
-        apps = okta_manager.call_okta("/apps", REST.get)
-        matcher = re.compile(app_id.lower())
-        apps = list(filter(lambda x: matcher.search(x["name"].lower()), apps))
-        if len(apps) != 1:
-            raise ExitException(f"Found {len(apps)} matching apps. Must be 1!")
-        use_app_id = apps[0]["id"]
+        use_app_id = _find_app(app_id)["id"]
     else:
         use_app_id = app_id
     return okta_manager.call_okta(f"/apps/{use_app_id}/users", REST.get)
 
 
+def _find_app(name_or_label):
+    apps = okta_manager.app_index().find(name_or_label)
+    if len(apps) != 1:
+        raise ExitException(f"Found {len(apps)} apps matching "
+                            f"'{name_or_label}'. Must be 1!")
+    return apps[0]
+
+
+@cli_apps.command(name="assignments", context_settings=CONTEXT_SETTINGS)
+@click.argument("apps", nargs=-1)
+@click.option("-f", "--file", "app_file", metavar="FILE", default=None,
+              help="Read app IDs, labels or names from FILE, one per line "
+                   "('-' for stdin)")
+@click.option("-a", "--all", "all_apps", is_flag=True,
+              help="List the assignments of all apps")
+@click.option("-j", "--json", "print_json", is_flag=True,
+              help="Print JSON objects (one per line) instead of CSV")
+@click.option("--csv-dialect", default="excel",
+              help="Use this CSV dialect, default: excel")
+@_parallel_options
+@_command_wrapper
+def apps_assignments(apps, app_file, all_apps, print_json, csv_dialect,
+                     workers, max_workers, adaptive):
+    """List the user assignments of many apps
+
+    The users of all apps are fetched in parallel and printed as CSV rows
+    (app, user, syncState, userName) as soon as an app is done (use -j
+    for JSON lines). Apps are given by ID, label or name. Apps which
+    failed are reported at the end, with a non-zero exit code.
+
+    \b
+    okta-cli apps assignments --all > assignments.csv
+    """
+    index = okta_manager.app_index()
+    if all_apps:
+        found = index.apps
+    else:
+        names = list(apps) + (list(_read_user_list(app_file))
+                              if app_file else [])
+        if not names:
+            raise ExitException("Give apps, use -f or --all.")
+        # each app once, in the given order
+        found = list({app["id"]: app for app in map(_find_app, names)}
+                     .values())
+
+    def fetch(app):
+        return list(okta_manager.call_okta_iter(f"/apps/{app['id']}/users",
+                                                params={"limit": 500}))
+
+    failed = collections.Counter()
+
+    def fetch_all():
+        limiter = _get_limiter(workers, max_workers, adaptive)
+        for app, users, error in run_parallel(fetch, found, limiter=limiter):
+            if isinstance(error, DeadlineExceeded):
+                failed["deadline"] += 1
+                continue
+            elif error is not None:
+                print(f"ERROR: app {app.get('label', app['id'])}: {error}",
+                      file=sys.stderr)
+                failed["error"] += 1
+                continue
+            for user in users:
+                yield (app.get("label", app["id"]), user["id"],
+                       user.get("syncState", ""),
+                       (user.get("credentials") or {}).get("userName", ""))
+
+    _stream_rows(("app", "user", "syncState", "userName"), fetch_all(),
+                 print_json=print_json, dialect=csv_dialect)
+    if failed["deadline"]:
+        raise DeadlineExceeded(f"Deadline reached, the assignments of "
+                               f"{failed['deadline']} of {len(found)} apps "
+                               f"are missing.")
+    if failed["error"]:
+        raise ExitException(f"{failed['error']} of {len(found)} apps "
+                            f"failed.")
+
+
 @click.group(name="users")
 def cli_users():
     """Add, update (etc.) users"""
@@ -698,20 +1332,51 @@ def cli_users():
               help="Accept partial matches for match queries.")
 @click.option("-f", "--filter", 'api_filter', default="")
 @click.option("-s", "--search", 'api_search', default="")
+@click.option("-w", "--where", default=None,
+              help="Filter expression, e.g. 'profile.department == \"IT\" "
+                   "and status in (\"ACTIVE\", \"SUSPENDED\")'")
+@click.option("--columnar", is_flag=True,
+              help="Evaluate filters column-wise using numpy, faster for "
+                   "very big user lists")
 @_output_type_command_wrapper("id,profile.login,profile.firstName,"
                               "profile.lastName,profile.email")
-def users_list(matches, partial, api_filter, api_search, **kwargs):
+def users_list(matches, partial, api_filter, api_search, where, columnar,
+               **kwargs):
     """Lists users (all or using various filters)
 
     NOTE: The simple 'users list' command will NOT contain DEPROVISIONED users,
     they are just not returned by the Okta API. If you want a list including
     those either use the 'dump' command, or use 'users list' twice, the 2nd
-    time adding this query: '-s "status eq \\"DEPROVISIONED\\""'."""
-    users = okta_manager.list_users(
-            filter_query=api_filter,
-            search_query=api_search)
+    time adding this query: '-s "status eq \\"DEPROVISIONED\\""'.
+
+    Simple match expressions ('-m department=IT', '-m title=Dev.*',
+    '-m city="Berlin|Paris"') are sent to Okta as search query, so only the
+    matching users are downloaded. Other regular expressions are checked
+    locally.
+
+    With '-w' you can use a more flexible filter expression, which is
+    checked locally. It supports dotted paths into the user object,
+    comparisons (==, !=, <, <=, >, >=), regex matches (~, !~), "in (...)"
+    and "not in (...)", combined with and, or, not and parentheses:
+
+    \b
+    okta-cli users list -w 'status != "ACTIVE" and
+        (profile.department in ("IT", "HR") or profile.title ~ "^Dev")'
+    """
     filters_dict = {k: v for k, v in map(lambda x: x.split("="), matches)}
-    return list(filter_users(users, filters=filters_dict, partial=partial))
+    planned_search = api_search
+    if not api_filter:
+        # let okta do as much of the filtering as possible
+        planned_search = plan_user_search(filters_dict, partial=partial,
+                                          search_query=api_search)
+    users = okta_manager.iter_users(
+            filter_query=api_filter,
+            search_query=planned_search)
+    if planned_search and not api_search:
+        # a search returns DEPROVISIONED users, a plain listing does not
+        users = filter(lambda x: x.get("status") != "DEPROVISIONED", users)
+    return list(filter_users(users, filters=filters_dict, partial=partial,
+                             where=where, columnar=columnar))
 
 
 @cli_users.command(name="get", context_settings=CONTEXT_SETTINGS)
@@ -741,12 +1406,120 @@ def users_get(lookup_value, field, **kwargs):
     return rv[0]
 
 
+def _read_user_list(file):
+    """
+    Reads user IDs or logins from a file ("-" for stdin), one per line.
+    Empty lines and lines starting with "#" are ignored.
+    """
+    if file == "-" and _current_profile():
+        # the profiles would each get some of the lines
+        raise ExitException("With --profiles read the list from a file, "
+                            "not from stdin.")
+
+    def lines():
+        with click.open_file(file, "r", encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+
+    return lines()
+
+
+def _stream_rows(headers, rows, *, print_json=False, dialect="excel"):
+    """
+    Prints rows as CSV (or JSON lines) as soon as they come in.
+
+    :param headers: The column names
+    :param rows: An iterable of row tuples
+    :param print_json: Print JSON objects, one per line, instead of CSV
+    :param dialect: The CSV dialect
+    """
+    writer = csv.writer(sys.stdout, dialect=dialect)
+    if not print_json:
+        writer.writerow(headers)
+    for row in rows:
+        if print_json:
+            print(json.dumps(dict(zip(headers, row)), sort_keys=True))
+        else:
+            writer.writerow(row)
+        sys.stdout.flush()
+
+
+def _groups_from_dump(dump_dir, users):
+    # invert the group -> user table of a 'dump' for the given users
+    users = list(users)
+    wanted = set(users)
+    ids = {}
+    with open(join(dump_dir, "users.csv"), "r", encoding="utf-8") as fh:
+        for row in csv.DictReader(fh):
+            for key in (row["id"], row.get("profile.login")):
+                if key in wanted:
+                    ids[key] = row["id"]
+    memberships = collections.defaultdict(list)
+    wanted = set(ids.values())
+    with open(join(dump_dir, "group_users.csv"), "r", encoding="utf-8") as fh:
+        for row in csv.DictReader(fh):
+            if row["user"] in wanted:
+                memberships[row["user"]].append(row["group"])
+    with open(join(dump_dir, "groups.csv"), "r", encoding="utf-8") as fh:
+        names = {row["id"]: row.get("profile.name", "")
+                 for row in csv.DictReader(fh)}
+    for user in users:
+        if user not in ids:
+            print(f"WARNING: user {user} not found in dump.", file=sys.stderr)
+            continue
+        for group_id in memberships[ids[user]]:
+            yield user, group_id, names.get(group_id, "")
+
+
 @cli_users.command(name="groups", context_settings=CONTEXT_SETTINGS)
-@click.argument("name-or-id")
+@click.argument("name-or-id", required=False)
+@click.option("-f", "--file", "user_file", metavar="FILE", default=None,
+              help="Read user IDs or logins from FILE, one per line "
+                   "('-' for stdin)")
+@click.option("--from-dump", metavar="DIR", default=None,
+              help="Use the group memberships of a 'dump' directory instead "
+                   "of asking Okta")
+@_parallel_options
 @_output_type_command_wrapper("id,profile.name,profile.description")
-def users_list_groups(name_or_id, **kwargs):
-    """List all users in a group"""
-    return okta_manager.call_okta(f"/users/{name_or_id}/groups", REST.get)
+def users_list_groups(name_or_id, user_file, from_dump, workers, max_workers,
+                      adaptive, **kwargs):
+    """List all groups of a user, or of many users
+
+    With -f the groups of all users in the file are fetched in parallel,
+    and printed as CSV rows (user, group_id, group_name) as soon as they
+    arrive (use -j for JSON lines). With --from-dump no requests are made
+    at all, the memberships are taken from the files of 'okta-cli dump'.
+
+    \b
+    okta-cli users groups -f user-ids.txt > memberships.csv
+    """
+    if not user_file:
+        if not name_or_id:
+            raise ExitException("Either give a user or use -f.")
+        return okta_manager.call_okta(f"/users/{name_or_id}/groups", REST.get)
+
+    users = _read_user_list(user_file)
+    if from_dump:
+        rows = _groups_from_dump(from_dump, users)
+    else:
+        def fetch(user):
+            return okta_manager.call_okta(f"/users/{user}/groups", REST.get)
+
+        def fetch_all():
+            limiter = _get_limiter(workers, max_workers, adaptive)
+            for user, groups, error in run_parallel(fetch, users,
+                                                    limiter=limiter):
+                if error is not None:
+                    print(f"ERROR: user {user}: {error}", file=sys.stderr)
+                    continue
+                for group in groups:
+                    yield user, group["id"], group["profile"]["name"]
+        rows = fetch_all()
+    _stream_rows(("user", "group_id", "group_name"), rows,
+                 print_json=kwargs["print_json"],
+                 dialect=kwargs["csv_dialect"])
 
 
 @cli_users.command(name="deactivate", context_settings=CONTEXT_SETTINGS)
@@ -759,11 +1532,9 @@ def users_list_groups(name_or_id, **kwargs):
 def users_deactivate(login_or_id, send_email, no_confirmation):
     """Deactivate a user (DESTRUCTIVE OPERATION)"""
     if not no_confirmation:
-        check = input("DANGER!! Do you REALLY want to do this "
-                      "(maybe use 'suspend' instead)?\n"
-                      f"Then enter '{login_or_id}': ")
-        if check != login_or_id:
-            raise ExitException("Aborted.")
+        _confirm("DANGER!! Do you REALLY want to do this "
+                 "(maybe use 'suspend' instead)?\n"
+                 f"Then enter '{login_or_id}': ", login_or_id)
     okta_manager.deactivate_user(login_or_id, send_email)
     return f"User {login_or_id} deactivated."
 
@@ -787,10 +1558,8 @@ def users_unlock(login_or_id):
 def users_delete(login_or_id, send_email, no_confirmation):
     """Delete a user (DESTRUCTIVE OPERATION)"""
     if not no_confirmation:
-        check = input("DANGER!! Do you REALLY want to do this?\n"
-                      f"Then enter '{login_or_id}': ")
-        if check != login_or_id:
-            raise ExitException("Aborted.")
+        _confirm("DANGER!! Do you REALLY want to do this?\n"
+                 f"Then enter '{login_or_id}': ", login_or_id)
     okta_manager.delete_user(login_or_id, send_email)
     # .delete_user() does not return anything
     return f"User {login_or_id} deleted."
@@ -806,6 +1575,77 @@ def users_suspend(login_or_id):
     return rv
 
 
+BULK_LIFECYCLE = {
+    # operation: destructive
+    "suspend":    False,
+    "unsuspend":  False,
+    "unlock":     False,
+    "deactivate": True,
+    "delete":     True,
+}
+
+
+@cli_users.command(name="bulk-lifecycle", context_settings=CONTEXT_SETTINGS)
+@click.argument("operation", type=click.Choice(list(BULK_LIFECYCLE)))
+@click.option("-e", "--send-email", is_flag=True,
+              help="Send email to admins if set (deactivate, delete)")
+@click.option("--dry-run", is_flag=True,
+              help="Only show which users would be affected")
+@click.option("--no-confirmation", is_flag=True,
+              help="Don't ask - DANGER!!")
+@_bulk_user_options
+@_command_wrapper
+def users_bulk_lifecycle(operation, send_email, dry_run, no_confirmation,
+                         user_file, search, output, resume, workers,
+                         max_workers, adaptive):
+    """Suspend, unsuspend, unlock, deactivate or delete many users
+
+    The users are read from a file (-f) or found with an Okta search
+    expression (--search). They are counted first, and you confirm the
+    whole run once. The operations run in parallel, the results are
+    written to a CSV file as they come in. Use --resume with that file to
+    skip the users which were done already.
+
+    Deleting a user which is not deactivated yet deactivates it (that's
+    how Okta works), so run 'delete' twice for active users.
+
+    \b
+    okta-cli users bulk-lifecycle deactivate -f leavers.txt --dry-run
+    okta-cli users bulk-lifecycle delete \\
+        --search 'status eq "DEPROVISIONED"'
+    """
+    if user_file == "-" and not no_confirmation and not dry_run:
+        raise ExitException("Reading the users from stdin needs "
+                            "--no-confirmation.")
+    if _current_profile() and not no_confirmation and not dry_run:
+        raise ExitException("With --profiles use --dry-run first, then "
+                            "--no-confirmation.")
+    users = list(_bulk_users(user_file, search, resume,
+                             f"users-{operation}"))
+    preview = ", ".join(users[:10]) + (", ..." if len(users) > 10 else "")
+    summary = f"{operation}: {len(users)} users ({preview or '-'})"
+    if dry_run or not users:
+        return summary
+    if not no_confirmation:
+        danger = "DANGER!! " if BULK_LIFECYCLE[operation] else ""
+        _confirm(f"{summary}\n{danger}Do you REALLY want to do this?\n"
+                 f"Then enter '{len(users)}': ", str(len(users)))
+
+    def run(item):
+        user = item[0]
+        if operation == "delete":
+            okta_manager.delete_user(user, send_email)
+        elif operation == "deactivate":
+            okta_manager.deactivate_user(user, send_email)
+        else:
+            okta_manager.call_okta_raw(f"/users/{user}/lifecycle/{operation}",
+                                       REST.post)
+
+    return _run_bulk(f"users-{operation}", run,
+                     ((user,) for user in users), output,
+                     workers, max_workers, adaptive)
+
+
 @cli_users.command(name="update", context_settings=CONTEXT_SETTINGS)
 @click.argument('user_id')
 @click.option('-s', '--set', 'set_fields', multiple=True)
@@ -850,6 +1690,46 @@ def users_update(user_id, set_fields, context):
     return okta_manager.update_user(user_id, nested_dict)
 
 
+def _bulk_prepare_row(row, defaults, specs=None):
+    """
+    Converts a row of a bulk-update file into the user ID and the JSON
+    encoded request body of the update.
+
+    :param row: The row dict, with flat (dotted) keys
+    :param defaults: Default values for the update (with flat keys)
+    :param specs: If given, validate and convert the profile fields using
+                  these field specifications (see schema.compile_schema())
+    :return: A tuple (user_id, body, error). user_id is None if the row has
+             neither a "profile.login" nor an "id" value, error is None if
+             the row is valid.
+    """
+    user_id = None
+    error = None
+    for field in ("profile.login", "id"):
+        if field in row:
+            user_id = row.pop(field)
+    # you can't set top-level fields. pop all of them.
+    flat = dict(defaults)
+    flat.update((k, v) for k, v in row.items() if k.find(".") > -1)
+    if specs is not None:
+        flat, errors = validate_row(specs, flat)
+        if errors:
+            error = "Invalid row: " + "; ".join(errors)
+    if not user_id:
+        user_id = None
+        error = "Row has neither a 'profile.login' nor an 'id'"
+    final_dict = _dict_flat_to_nested(flat)
+    # Excel cells can contain dates and such, send those as strings
+    body = json.dumps(final_dict, default=str).encode("utf-8")
+    return user_id, body, error
+
+
+def _bulk_prepare_batch(batch, defaults, specs):
+    # runs in a worker process if 'bulk-update -p' is used
+    return [(idx,) + _bulk_prepare_row(row, defaults, specs)
+            for idx, row in batch]
+
+
 @cli_users.command(name="bulk-update", context_settings=CONTEXT_SETTINGS)
 @click.argument('file')
 @click.option('-s', '--set', 'set_fields', multiple=True,
@@ -864,12 +1744,23 @@ def users_update(user_id, set_fields, context):
 @click.option('-l', '--limit', metavar="NUM",
               default=0,
               help="Stop after NUM updates")
-@click.option('-w', '--workers', metavar="NUM",
-              default=25,
-              help="use this many threads parallel, default:25")
+@_parallel_options
+@click.option('-p', '--processes', metavar="NUM",
+              default=0,
+              help="Prepare the update requests in NUM worker processes, "
+                   "default: 0 (prepare in the main process)")
+@click.option('--index/--no-index', 'use_index', default=True,
+              help="Use (and create) a FILE.okta-index file to jump into "
+                   "CSV files, default: True")
+@click.option('--validate/--no-validate', default=True,
+              help="Check the rows against the Okta user schema before "
+                   "sending them, default: True")
+@click.option('--dry-run', is_flag=True,
+              help="Only read and validate the file, don't update anything")
 @_command_wrapper
 def users_bulk_update(file, set_fields, jump_to_index, jump_to_user, limit,
-                      workers):
+                      workers, max_workers, adaptive, processes, use_index,
+                      validate, dry_run):
     """
     Bulk-update users from a CSV or Excel (.xlsx) file
 
@@ -878,88 +1769,109 @@ def users_bulk_update(file, set_fields, jump_to_index, jump_to_user, limit,
     All columns which do not contain a dot (".") are ignored. You can only
     update fields of sub-structures, not top level fields in okta (e.g. you
     *can* update "profile.site", but you *cannot* update "id").
+
+    When jumping into a CSV file (-i or -u) an index file FILE.okta-index
+    is created next to it, so the next resume is instant.
+
+    For very wide files converting the rows into requests can keep a CPU
+    core busy. Use -p to spread this work over several processes.
+
+    Unless --no-validate is given, all "profile." fields are checked against
+    the Okta user schema first (types, allowed values, lengths, ...) and
+    converted to the correct type (e.g. "true" becomes a boolean). Invalid
+    rows are reported as errors and not sent to Okta. Use --dry-run to
+    check a file without updating anything.
+
+    With --deadline no new updates are started after the deadline. The
+    results so far are saved, and the index to resume from is printed.
     """
 
-    def excel_reader():
-        wb = load_workbook(filename=file)
-        rows = wb.active.rows
-
-        # Get the header values as keys and move the iterator to the next item
-        keys = [c.value for c in next(rows)]
-        num_keys = len(keys)
-        for row in rows:
-            values = [c.value for c in row]
-            rv = dict(zip(keys, values[:num_keys]))
-            if any(rv.values()):
-                yield rv
-
-    def csv_reader():
-        with open(file, "r", encoding="utf-8") as infile:
-            dialect = csv.Sniffer().sniff(infile.read(4096))
-            infile.seek(0)
-            dr = csv.DictReader(infile, dialect=dialect)
-            for row in dr:
-                if any(row.values()):
-                    yield row
-
-    def file_reader():
-        dr = excel_reader() \
-            if splitext(file)[1].lower() == ".xlsx" else csv_reader()
-        if jump_to_user:
-            tmp = next(dr)
-            while jump_to_user not in (tmp.get("profile.login", ""), tmp.get("id", "")):
-                tmp = next(dr)
-        elif jump_to_index:
-            # prevent both being used at the same time :)
-            for _ in range(jump_to_index):
-                next(dr)
-        _cnt = 0
-        for row in dr:
-            if limit and _cnt == limit:
+    def prepared_rows():
+        rows = enumerate(dr)
+        if not processes:
+            for idx, row in rows:
+                yield (idx,) + _bulk_prepare_row(row, fields_dict, specs)
+            return
+        with ProcessPoolExecutor(max_workers=processes) as pp:
+            for batch in ordered_map(pp, _bulk_prepare_batch,
+                                     batched(rows, 500), fields_dict, specs,
+                                     max_pending=processes * 2):
+                yield from batch
+
+    def until_deadline(prepared):
+        for item in prepared:
+            if okta_manager.deadline_reached():
+                progress["stopped"] = True
                 break
-            yield row
-            _cnt += 1
+            progress["next"] = item[0] + 1
+            yield item
 
-    def update_user_parallel(_row, index):
+    def update_user_parallel(prepared):
         # this is a closure, let's use the outer scope's variables
-        for field in ("profile.login", "id"):
-            if field in _row:
-                user_id = _row.pop(field)
-        # you can't set top-level fields. pop all of them.
-        _row = {k: v for k, v in _row.items() if k.find(".") > -1}
-        # fields_dict - from outer scope.
-        final_dict = _dict_flat_to_nested(_row, defaults=fields_dict)
+        index, user_id, body, error = prepared
+        if error is not None:
+            upd_err.append((index + start_index, json.loads(body), error))
+            return
+        if dry_run:
+            upd_ok.append({"id": user_id, "update": json.loads(body)})
+            return
         try:
-            upd_ok.append(okta_manager.update_user(user_id, final_dict))
+            upd_ok.append(okta_manager.update_user(user_id, body_data=body))
         except RequestsHTTPError as e:
-            upd_err.append((index + jump_to_index, final_dict, str(e)))
+            upd_err.append((index + start_index, json.loads(body), str(e)))
 
     print("Bulk update might take a while. Please be patient.", flush=True)
 
     upd_ok = []
     upd_err = []
     fields_dict = {k: v for k, v in map(lambda x: x.split("="), set_fields)}
-    dr = file_reader()
-
-    with ThreadPoolExecutor(max_workers=workers) as ex:
-        runs = {idx: ex.submit(update_user_parallel, row, idx)
-                for idx, row in enumerate(dr)}
-        for job in as_completed(runs.values()):
-            pass
-
-    print(f"{len(runs)} - done.", file=sys.stderr)
+    specs = None
+    if validate:
+        # one request for the whole run
+        specs = compile_schema(okta_manager.get_profile_schema())
+    start_index, dr = read_rows(file,
+                                jump_to_index=jump_to_index,
+                                jump_to_user=jump_to_user,
+                                use_index=use_index)
+    if limit:
+        dr = islice(dr, limit)
+
+    count = 0
+    progress = {"next": 0, "stopped": False}
+    unfinished = []
+    limiter = _get_limiter(workers, max_workers, adaptive)
+    for prepared, _, error in run_parallel(update_user_parallel,
+                                           until_deadline(prepared_rows()),
+                                           limiter=limiter):
+        if isinstance(error, DeadlineExceeded):
+            unfinished.append(prepared[0])
+            continue
+        count += 1
+        if error is not None:
+            # something unexpected, e.g. a connection error
+            upd_err.append((prepared[0] + start_index,
+                            json.loads(prepared[2]), str(error)))
+
+    print(f"{count} - done.", file=sys.stderr)
     tmp = {"ok": upd_ok, "errors": upd_err}
     timestamp_str = dt.now().strftime("%Y%m%d_%H%M%S")
     rv = ""
     for name, results in tmp.items():
         if len(results):
-            file_name = f"okta-bulk-update-{timestamp_str}-{name}.json"
+            file_name = (f"okta-bulk-update{_profile_suffix()}-"
+                         f"{timestamp_str}-{name}.json")
             with open(file_name, "w") as outfile:
                 outfile.write(json.dumps(results, indent=2, sort_keys=True))
                 rv += f"{len(results):>4} {name:6} - {file_name}\n"
         else:
             rv += f"{len(results):>4} {name:6}\n"
-    return rv + f"{len(upd_ok) + len(upd_err)} total"
+    rv += f"{len(upd_ok) + len(upd_err)} total"
+    if unfinished or progress["stopped"]:
+        print(rv)
+        resume = min(unfinished + [progress["next"]]) + start_index
+        raise DeadlineExceeded(f"Deadline reached, continue with "
+                               f"'-i {resume}'.")
+    return rv
 
 
 @cli_users.command(name="add", context_settings=CONTEXT_SETTINGS)
@@ -1018,15 +1930,54 @@ def users_add(set_fields, profile_fields, groups, read_csv, activate, provider,
 
 
 @click.group(context_settings=CONTEXT_SETTINGS)
-def cli_main():
+@click.option("--connect-timeout", metavar="SECONDS", type=float,
+              help="Timeout for connecting to Okta, default: from the "
+                   "profile or 10")
+@click.option("--read-timeout", metavar="SECONDS", type=float,
+              help="Timeout for waiting for a response, default: from the "
+                   "profile or 60")
+@click.option("--deadline", metavar="SECONDS", type=float,
+              help="Stop sending requests after SECONDS. Long running "
+                   "commands save what they have so far")
+@click.option("--cache/--no-cache", default=None,
+              help="Cache responses of read requests (schema, apps, "
+                   "groups, users) on disk, default: from the profile")
+@click.option("--stats", is_flag=True,
+              help="Print request statistics (by endpoint) at the end")
+@click.option("--stats-file", metavar="FILE",
+              help="Save request statistics in FILE, in the Prometheus "
+                   "text format if FILE ends with .prom, JSON otherwise")
+@click.option("--trace", metavar="FILE",
+              help="Record all requests in FILE (JSON lines, without "
+                   "tokens and bodies), see 'trace analyze'")
+@click.option("--profiles", metavar="NAME,NAME,...",
+              help="Run the command for these config profiles at the same "
+                   "time and merge the output")
+@click.option("--all-profiles", is_flag=True,
+              help="Same as --profiles with all config profiles")
+def cli_main(connect_timeout, read_timeout, deadline, cache, stats,
+             stats_file, trace, profiles, all_profiles):
     """
     Okta CLI helper.
 
     See subcommands for help: "okta-cli users --help" etc.
 
     If in doubt start with: "okta-cli config new --help"
+
+    With --profiles or --all-profiles a command runs for several Okta orgs
+    at once. Lists are merged, with the profile name in the column
+    "config_profile"; other output is printed per profile.
     """
-    pass
+    client_options["timeouts"] = {"connect": connect_timeout,
+                                  "read": read_timeout}
+    client_options["deadline"] = deadline
+    client_options["cache"] = cache
+    client_options["stats"] = stats
+    client_options["stats_file"] = stats_file
+    client_options["trace"] = trace
+    client_options["profiles"] = True if all_profiles else \
+        [x.strip() for x in profiles.split(",") if x.strip()] \
+        if profiles else None
 
 
 @cli_main.command(name="dump", context_settings=CONTEXT_SETTINGS)
@@ -1035,81 +1986,240 @@ def cli_main():
 @click.option("--no-user-list", is_flag=True)
 @click.option("--no-app-users", is_flag=True)
 @click.option("--no-group-users", is_flag=True)
+@_parallel_options
 @_command_wrapper
-def dump(target_dir, no_user_list, no_app_users, no_group_users):
+def dump(target_dir, no_user_list, no_app_users, no_group_users,
+         workers, max_workers, adaptive):
     """
     Dump basically everything into CSV files for further processing
 
     NOTE: In contrast to 'users list' the 'dump' command will include
     users in the DEPROVISIONED state by default.
+
+    With --deadline the files saved before the deadline are kept.
+    """
+    if target_dir is None:
+        target_dir = dt.strftime(dt.now(), "okta-dump-%Y%m%d%H%M%S")
+    if _current_profile():
+        target_dir = join(target_dir, _current_profile())
+    _dump_org(okta_manager, target_dir,
+              no_user_list=no_user_list, no_app_users=no_app_users,
+              no_group_users=no_group_users,
+              limiter=_get_limiter(workers, max_workers, adaptive))
+
+
+def _dump_org(manager, target_dir, *, no_user_list=False, no_app_users=False,
+              no_group_users=False, limiter=None, out=None):
     """
+    Saves users, groups, apps and their users of an Okta org as CSV files.
+
+    :param manager: The Okta client
+    :param target_dir: The directory for the files
+    :param limiter: The concurrency limiter for the group and app users
+    :param out: Where the progress goes, default: stdout
+    """
+    out = out or sys.stdout
 
     def save_in(save_dir, save_file, obj):
         if not isdir(save_dir):
-            mkdir(save_dir)
+            os.makedirs(save_dir, exist_ok=True)
         final_file = join(save_dir, save_file)
         with open(final_file, "w") as outfile:
             _dump_csv(obj, out=outfile)
 
-    def save_in_csv(save_dir, save_file, obj, headers):
+    def save_users_for(save_dir, obj_list, what):
+        # every user list is written as soon as it is complete, so only
+        # those of the running requests are in memory
+        def fetch(obj):
+            return [u["id"] for u in manager.call_okta_iter(
+                    f"/{what}s/{obj['id']}/users", params={"limit": 1000})]
+
         if not isdir(save_dir):
-            mkdir(save_dir)
-        final_file = join(save_dir, save_file)
-        with open(final_file, "w") as outfile:
+            os.makedirs(save_dir, exist_ok=True)
+        missing = 0
+        with open(join(save_dir, f"{what}_users.csv"), "w") as outfile:
             writer = csv.writer(outfile)
-            writer.writerow(headers)
-            for row in obj:
-                writer.writerow(row)
-
-    def get_users_for(obj_list, rest_path, workers=1):
-        table = []
-        with ThreadPoolExecutor(max_workers=workers) as ex:
-            runs = {
-                ex.submit(okta_manager.call_okta,
-                          f"/{rest_path}/{obj['id']}/users",
-                          REST.get,
-                          params={"limit": 1000}):
-                obj["id"]
-                for obj in obj_list}
-            for result in runs:
-                gid = runs[result]
-                table += [(gid, u["id"]) for u in result.result()]
-        return table
-
-    default_workers = 25
-
-    if target_dir is None:
-        target_dir = dt.strftime(dt.now(), "okta-dump-%Y%m%d%H%M%S")
+            writer.writerow((what, "user"))
+            for obj, user_ids, error in run_parallel(fetch, obj_list,
+                                                     limiter=limiter):
+                if isinstance(error, DeadlineExceeded):
+                    missing += 1
+                elif error is not None:
+                    raise error
+                else:
+                    writer.writerows((obj["id"], x) for x in user_ids)
+        return missing
 
-    print("Please be patient, this can several minutes.")
+    print("Please be patient, this can several minutes.", file=out)
 
     if no_user_list:
-        print("Skipping list of users.")
+        print("Skipping list of users.", file=out)
     else:
-        print("Saving user list ... ", end="", flush=True)
-        dump_me = okta_manager.list_users()
+        print("Saving user list ... ", end="", flush=True, file=out)
         # deprovisioned users are NOT included in the listing by default
         tmp_str = "status eq \"DEPROVISIONED\""
-        dump_me += okta_manager.list_users(search_query=tmp_str)
-        save_in(target_dir, "users.csv", dump_me)
-        print("done.")
+        if not isdir(target_dir):
+            os.makedirs(target_dir, exist_ok=True)
+        _dump_csv_spooled(
+                chain(manager.iter_users(),
+                      manager.iter_users(search_query=tmp_str)),
+                join(target_dir, "users.csv"))
+        print("done.", file=out)
 
     for func, what, no_detail in (
-            (okta_manager.list_groups, "group", no_group_users),
-            (okta_manager.list_apps, "app", no_app_users)
+            (manager.list_groups, "group", no_group_users),
+            (manager.list_apps, "app", no_app_users)
     ):
-        print(f"Saving {what} list ... ", end="", flush=True)
+        print(f"Saving {what} list ... ", end="", flush=True, file=out)
         dump_me = func()
         save_in(target_dir, f"{what}s.csv", dump_me)
-        print("done.")
+        print("done.", file=out)
 
         if no_detail:
-            print(f"Skipping list of {what} users.")
+            print(f"Skipping list of {what} users.", file=out)
         else:
-            print(f"Saving {what} users ... ", end="", flush=True)
-            table = get_users_for(dump_me, f"{what}s", workers=default_workers)
-            save_in_csv(target_dir, f"{what}_users.csv", table, (what, "user"))
-            print("done.")
+            print(f"Saving {what} users ... ", end="", flush=True, file=out)
+            missing = save_users_for(target_dir, dump_me, what)
+            if missing:
+                raise DeadlineExceeded(f"Deadline reached, {what}_users.csv "
+                                       f"is missing {missing} {what}s. "
+                                       f"Partial dump in {target_dir}.")
+            print("done.", file=out)
+
+
+@cli_main.command(name="diff", context_settings=CONTEXT_SETTINGS)
+@click.option("--left", required=True, metavar="PROFILE_OR_DIR",
+              help="A config profile or a directory created by 'dump'")
+@click.option("--right", required=True, metavar="PROFILE_OR_DIR",
+              help="A config profile or a directory created by 'dump'")
+@click.option("-t", "--table", "tables", multiple=True,
+              type=click.Choice(TABLES),
+              help="Compare only this table (repeatable), default: all")
+@click.option("-f", "--field", "fields", multiple=True,
+              help="Compare only this user field (repeatable), e.g. "
+                   "profile.department")
+@click.option("--chunk-size", type=int, default=CHUNK_SIZE,
+              help=f"Rows sorted in memory at once, default: {CHUNK_SIZE}")
+@click.option("-j", "--json", "print_json", is_flag=True,
+              help="Print JSON objects (one per line) instead of CSV")
+def diff_orgs(left, right, tables, fields, chunk_size, print_json):
+    """
+    Compare the users, groups and apps of two orgs (or dumps)
+
+    Users are matched by login, groups by name and apps by label. Every
+    record only on the left side is "removed", every record only on the
+    right side "added", and every differing field of a record on both
+    sides one "changed" line. Group and app memberships are compared as
+    "GROUP / LOGIN" pairs. Groups (apps) with the same name (label) are
+    told apart by their type (app name); those which are still not unique
+    are listed as "duplicate" and never matched.
+
+    A config profile is dumped into a temporary directory first (see
+    'dump'); both sides are dumped at the same time. Dumps are compared
+    with a sort-merge join in bounded memory, so orgs of any size can be
+    compared.
+    """
+    managers = []
+    tracer = None
+
+    def dumped(source, tmp_dir):
+        if isdir(source):
+            return source
+        manager = _configured_manager(source, tracer)
+        managers.append((source, manager))
+        print(f"Dumping profile {source} ...", file=sys.stderr)
+        _dump_org(manager, tmp_dir, limiter=manager.get_limiter(),
+                  out=io.StringIO())
+        return tmp_dir
+
+    try:
+        with _handled_errors(), \
+                tempfile.TemporaryDirectory(prefix="okta-diff-") as tmp_dir:
+            if client_options["profiles"]:
+                raise ExitException("'diff' cannot be used with --profiles, "
+                                    "use --left and --right.")
+            if client_options["stats_file"] and \
+                    not (isdir(left) or isdir(right)):
+                raise ExitException("--stats-file cannot be used for two "
+                                    "profiles.")
+            if client_options["trace"]:
+                tracer = Tracer(client_options["trace"])
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                left_dir, right_dir = ex.map(
+                        dumped, (left, right),
+                        (join(tmp_dir, "left"), join(tmp_dir, "right")))
+            _stream_rows(("table", "change", "key", "field", "left",
+                          "right"),
+                         diff_dumps(left_dir, right_dir,
+                                    tables=tables or TABLES,
+                                    fields=fields or None,
+                                    chunk_size=chunk_size),
+                         print_json=print_json)
+    finally:
+        if tracer is not None:
+            tracer.close()
+        for profile, manager in managers:
+            if client_options["stats"]:
+                print(f"==> {profile} <==", file=sys.stderr)
+            _report_stats(manager, close_tracer=False)
+
+
+@cli_main.command(name="dump-diff", context_settings=CONTEXT_SETTINGS)
+@click.argument("old_dir")
+@click.argument("new_dir")
+@click.option("-t", "--table", "tables", multiple=True,
+              type=click.Choice(TABLES),
+              help="Compare only this table (repeatable), default: all")
+@click.option("-f", "--field", "fields", multiple=True,
+              help="Compare only this user field (repeatable), e.g. "
+                   "status")
+@click.option("--chunk-size", type=int, default=CHUNK_SIZE,
+              help=f"Rows sorted in memory at once, default: {CHUNK_SIZE}")
+@click.option("-j", "--json", "print_json", is_flag=True,
+              help="Print JSON objects (one per line)")
+@click.option("--csv", "print_csv", is_flag=True,
+              help="Print CSV")
+def dump_diff(old_dir, new_dir, tables, fields, chunk_size, print_json,
+              print_csv):
+    """
+    Show what changed between two dumps of the same org
+
+    Prints one line per added or removed user, group, app or membership,
+    and per changed field, e.g.
+
+    \b
+    users        changed  jdoe@example.com  profile.title: "Dev" -> "Lead"
+    group_users  added    Admins / jdoe@example.com
+
+    Records are matched by ID, so renamed users and groups show up as
+    changed. Both dumps are compared with a sort-merge join in bounded
+    memory. A summary goes to stderr.
+    """
+    headers = ("table", "change", "id", "name", "field", "old", "new")
+    counts = collections.Counter()
+
+    def counted(changes):
+        for change in changes:
+            counts[change[:2]] += 1
+            yield change
+
+    with _handled_errors():
+        changes = counted(diff_snapshots(old_dir, new_dir,
+                                         tables=tables or TABLES,
+                                         fields=fields or None,
+                                         chunk_size=chunk_size))
+        if print_json or print_csv:
+            _stream_rows(headers, changes, print_json=print_json)
+        else:
+            for table, change, _, name, field, old, new in changes:
+                line = f"{table:12} {change:8} {name}"
+                if field:
+                    line += f"  {field}: {json.dumps(old)} -> " \
+                            f"{json.dumps(new)}"
+                print(line, flush=True)
+    summary = [f"{count} {table} {change}" for (table, change), count
+               in sorted(counts.items())]
+    print(", ".join(summary) or "No changes.", file=sys.stderr)
 
 
 @click.group(name="raw")
@@ -1134,6 +2244,154 @@ def raw_get(api_endpoint, params, limit, **kwargs):
     return rv
 
 
+def _raw_batch_requests(file):
+    """
+    Reads the requests of 'raw batch', one JSON object per line.
+
+    :return: A generator of (line number, request dict or None, error)
+    """
+    with click.open_file(file, "r", encoding="utf-8") as fh:
+        for num, line in enumerate(fh, start=1):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict) or "path" not in request:
+                    raise ValueError("not an object with a 'path'")
+                method = str(request.get("method", "get")).lower()
+                if method not in REST.__members__:
+                    raise ValueError(f"unknown method '{method}'")
+            except ValueError as e:
+                yield num, None, f"Invalid request: {e}"
+                continue
+            yield num, dict(request, method=method), None
+
+
+def _raw_batch_call(request):
+    """
+    Sends one request of 'raw batch'.
+
+    :return: (HTTP status, response body)
+    """
+    path = request["path"]
+    if not path.startswith("/"):
+        path = "/" + path
+    params = request.get("params") or {}
+    method = REST[request["method"]]
+    if method == REST.get:
+        # all pages of a list
+        return 200, okta_manager.call_okta(path, method, params=params)
+    body = request.get("body")
+    # a repeated DELETE may do more than the first one (users: deactivate,
+    # then delete), so DELETEs are never repeated after errors
+    rsp = okta_manager.call_okta_raw(
+            path, method, params=params,
+            body_data=json.dumps(body) if body is not None else None,
+            idempotent=False if method == REST.delete else None)
+    return rsp.status_code, rsp.json() if rsp.content else None
+
+
+@cli_raw.command(name="batch", context_settings=CONTEXT_SETTINGS)
+@click.option("-f", "--file", "request_file", metavar="FILE", default="-",
+              help="Read the requests from FILE, default: stdin")
+@click.option("--ordered", is_flag=True,
+              help="Print the responses in input order, default: as soon "
+                   "as they arrive")
+@_parallel_options
+@_command_wrapper
+def raw_batch(request_file, ordered, workers, max_workers, adaptive):
+    """Send many requests in parallel, read as JSON lines
+
+    Every input line is one request, e.g.
+
+    \b
+    {"method": "post", "path": "/users/ID/lifecycle/unlock"}
+    {"method": "get", "path": "/groups", "params": {"q": "Staff"}}
+    {"method": "put", "path": "/groups/GID/users/UID"}
+
+    "method" defaults to GET, "params" and "body" (an object) are optional.
+    For every request one JSON line with "line", "method", "path",
+    "status" and "body" (or "error") is printed. POST requests are not
+    repeated after network errors, and GET requests return all pages.
+    """
+    if request_file == "-" and _current_profile():
+        # the profiles would each get some of the lines
+        raise ExitException("With --profiles read the requests from a "
+                            "file (-f).")
+    limiter = _get_limiter(workers, max_workers, adaptive)
+
+    def call(item):
+        num, request, error = item
+        record = {"line": num}
+        if request is not None:
+            record.update(method=request["method"], path=request["path"])
+            try:
+                status, body = _raw_batch_call(request)
+                record.update(status=status, body=body)
+            except Exception as e:
+                response = getattr(e, "response", None)
+                if response is not None:
+                    record["status"] = response.status_code
+                error = e
+        if error is not None:
+            record["error"] = str(error)
+        return record
+
+    def limited(item):
+        limiter.acquire()
+        try:
+            return call(item)
+        finally:
+            limiter.release()
+
+    def print_all(records):
+        total = errors = 0
+        for record in records:
+            total += 1
+            errors += "error" in record
+            print(json.dumps(record, sort_keys=True), flush=True)
+        if errors:
+            raise ExitException(f"{errors} of {total} requests failed.")
+
+    items = _raw_batch_requests(request_file)
+    if ordered:
+        # at most max_limit requests run or wait for an earlier, slower
+        # one to be printed
+        with ThreadPoolExecutor(max_workers=limiter.max_limit) as ex:
+            print_all(ordered_map(ex, inheriting(limited), items,
+                                  max_pending=limiter.max_limit))
+    else:
+        print_all(record for _, record, _ in
+                  run_parallel(call, items, limiter=limiter))
+
+
+@click.group(name="trace")
+def cli_trace():
+    """Analyze request traces (see 'okta-cli --trace')"""
+    pass
+
+
+@cli_trace.command(name="analyze", context_settings=CONTEXT_SETTINGS)
+@click.argument("trace_file")
+@click.option("-i", "--interval", metavar="SECONDS", default=1.0,
+              help="Time slot length for the concurrency timeline, "
+                   "default: 1")
+def trace_analyze(trace_file, interval):
+    """
+    Show request rate, concurrency over time and the critical path
+
+    The critical path is the chain of requests (and the gaps between them)
+    which determined the run time: if it consists of one paginated listing,
+    more workers won't help; big gaps mean the client was busy or sleeping.
+    """
+    try:
+        requests_, sleeps = read_trace(trace_file)
+    except ExitException as e:
+        print("ERROR: {}".format(str(e)), file=sys.stderr)
+        sys.exit(-1)
+    print(analyze(requests_, sleeps, interval=interval))
+
+
 @cli_main.command(name="version", context_settings=CONTEXT_SETTINGS)
 def cli_version():
     """Print version number and exit"""
@@ -1146,3 +2404,4 @@ cli_main.add_command(cli_users)
 cli_main.add_command(cli_pw)
 cli_main.add_command(cli_groups)
 cli_main.add_command(cli_apps)
+cli_main.add_command(cli_trace)
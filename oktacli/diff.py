@@ -0,0 +1,426 @@
+import collections
+import csv
+import heapq
+import json
+import sys
+import tempfile
+from os.path import join, isfile
+
+from .exceptions import ExitException
+from .parallel import batched
+
+
+# columns which always differ between orgs (or snapshots), and say
+# nothing about the user, group or app
+IGNORED_FIELDS = {
+    "id", "created", "activated", "statusChanged", "lastLogin",
+    "lastUpdated", "lastMembershipUpdated", "passwordChanged",
+    "transitioningToStatus",
+}
+IGNORED_PREFIXES = ("_links.", "_embedded.", "credentials.", "type.")
+
+# the tables which can be compared
+TABLES = ("users", "groups", "apps", "group_users", "app_users")
+
+# the columns diff_dumps() and diff_snapshots() need
+REQUIRED_COLUMNS = {
+    "users": ("id",),
+    "groups": ("id",),
+    "apps": ("id",),
+    "group_users": ("group", "user"),
+    "app_users": ("app", "user"),
+}
+
+# rows per sorted run kept in memory by external_sort()
+CHUNK_SIZE = 200000
+
+
+def external_sort(rows, key, *, chunk_size=CHUNK_SIZE, tmp_dir=None):
+    """
+    Sorts rows of any size in bounded memory: sorted runs of chunk_size
+    rows are written to temporary files (JSON lines) and merged. If all
+    rows fit into one chunk no files are written.
+
+    :param rows: An iterable of JSON-serializable rows
+    :param key: The sort key function
+    :param chunk_size: The maximum number of rows in memory
+    :param tmp_dir: The directory for the temporary files
+    :return: A generator of the sorted rows
+    """
+    runs = []
+    current = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir,
+                                     prefix="okta-sort-") as tmp:
+        for batch in batched(rows, chunk_size):
+            if current:
+                runs.append(_write_run(tmp, len(runs), current))
+            current = sorted(batch, key=key)
+        files = [open(x, "r", encoding="utf-8") for x in runs]
+        try:
+            readers = [(json.loads(line) for line in fh) for fh in files]
+            yield from heapq.merge(*readers, current, key=key)
+        finally:
+            for fh in files:
+                fh.close()
+
+
+def _write_run(tmp, num, rows):
+    file = join(tmp, f"run-{num}.jsonl")
+    with open(file, "w", encoding="utf-8") as fh:
+        for row in rows:
+            fh.write(json.dumps(row) + "\n")
+    return file
+
+
+def _unique(rows, key):
+    # rows with the same key could not be paired reliably
+    last = object()
+    for row in rows:
+        row_key = key(row)
+        if row_key == last:
+            raise ValueError(f"Duplicate key {row_key!r}")
+        last = row_key
+        yield row
+
+
+def merge_join(left, right, key):
+    """
+    Full outer join of two iterables which are sorted by key, with unique
+    keys on each side (raises ValueError otherwise).
+
+    :return: A generator of (key, left row or None, right row or None)
+    """
+    left, right = iter(_unique(left, key)), iter(_unique(right, key))
+    a, b = next(left, None), next(right, None)
+    while a is not None or b is not None:
+        key_a = key(a) if a is not None else None
+        key_b = key(b) if b is not None else None
+        if b is None or (a is not None and key_a < key_b):
+            yield key_a, a, None
+            a = next(left, None)
+        elif a is None or key_b < key_a:
+            yield key_b, None, b
+            b = next(right, None)
+        else:
+            yield key_a, a, b
+            a, b = next(left, None), next(right, None)
+
+
+def _compared(row, ignore):
+    return {k: v for k, v in row.items()
+            if k not in ignore and not k.startswith(IGNORED_PREFIXES)}
+
+
+def diff_tables(left, right, key, *, ignore=(), fields=None, label=None):
+    """
+    Compares two tables (sorted by key, see external_sort()).
+
+    :param left: An iterable of dicts
+    :param right: An iterable of dicts
+    :param key: A function row -> key
+    :param ignore: Columns which are not compared
+    :param fields: Compare only these columns, default: all
+    :param label: A function row -> what is reported instead of the key
+                  (of the right row if there is one)
+    :return: A generator of (change, key, field, left value, right value),
+             change being "added" (only right), "removed" (only left) or
+             "changed" (one tuple per changed field)
+    """
+    for row_key, a, b in merge_join(left, right, key):
+        if label is not None:
+            row_key = label(b if b is not None else a)
+        if a is None:
+            yield "added", row_key, "", "", ""
+        elif b is None:
+            yield "removed", row_key, "", "", ""
+        else:
+            a, b = _compared(a, ignore), _compared(b, ignore)
+            for field in sorted(fields or set(a) | set(b)):
+                # missing columns (other schemas) count as empty
+                if a.get(field, "") != b.get(field, ""):
+                    yield ("changed", row_key, field, a.get(field, ""),
+                           b.get(field, ""))
+
+
+def read_table(dump_dir, table):
+    """
+    :return: A generator of dicts, the rows of a CSV file of 'dump'
+    """
+    file = join(dump_dir, f"{table}.csv")
+    if not isfile(file):
+        raise ExitException(f"{file} not found. Is {dump_dir} a directory "
+                            f"created by 'okta-cli dump'?")
+    csv.field_size_limit(sys.maxsize)
+    with open(file, "r", encoding="utf-8", newline="") as fh:
+        reader = csv.DictReader(fh)
+        try:
+            missing = [x for x in REQUIRED_COLUMNS[table]
+                       if x not in (reader.fieldnames or [])]
+            if missing:
+                raise ExitException(f"{file} has no column "
+                                    f"{', '.join(missing)}.")
+            yield from reader
+        except csv.Error as e:
+            raise ExitException(f"{file}, line {reader.line_num}: {e}")
+
+
+# the column which names a user, group or app
+NAME_FIELDS = {
+    "users": "profile.login",
+    "groups": "profile.name",
+    "apps": "label",
+}
+
+
+# the column which tells apart groups or apps with the same name
+QUALIFIER_FIELDS = {
+    "groups": "type",
+    "apps": "name",
+}
+
+# the column of the key by which diff_dumps() matches groups and apps
+KEY_FIELD = "__key"
+
+
+def _names(dump_dir, table, name_field):
+    # groups and apps are few, their names are kept in memory
+    return {row["id"]: row.get(name_field, "")
+            for row in read_table(dump_dir, table)}
+
+
+def match_keys(left_dir, right_dir, table):
+    """
+    Chooses the keys by which the groups or apps of two dumps are matched:
+    the name (app label) if it is unique on both sides, otherwise the name
+    and the group type (app name), e.g. "Staff / APP_GROUP". If that is
+    still not unique the ID is added, so those never match between orgs;
+    they are returned as ambiguous.
+
+    :param table: "groups" or "apps"
+    :return: ({ID: key} of the left dump, {ID: key} of the right dump,
+             sorted list of the ambiguous "NAME / QUALIFIER" keys)
+    """
+    name_field, qualifier = NAME_FIELDS[table], QUALIFIER_FIELDS[table]
+    sides = [[(row["id"], row.get(name_field, ""), row.get(qualifier, ""))
+              for row in read_table(dump_dir, table)]
+             for dump_dir in (left_dir, right_dir)]
+
+    def duplicates(key):
+        rv = set()
+        for rows in sides:
+            counts = collections.Counter(key(x) for x in rows)
+            rv.update(k for k, count in counts.items() if count > 1)
+        return rv
+
+    names = duplicates(lambda x: x[1])
+    qualified = duplicates(lambda x: x[1:])
+
+    def key(row_id, name, qual):
+        if (name, qual) in qualified:
+            return f"{name} / {qual} / {row_id}"
+        if name in names:
+            return f"{name} / {qual}"
+        return name
+
+    left, right = ({x[0]: key(*x) for x in rows} for rows in sides)
+    return left, right, sorted(f"{name} / {qual}" for name, qual in qualified)
+
+
+def _logins(dump_dir, chunk_size):
+    # (user ID, login), sorted by ID
+    return external_sort(
+            ([row["id"], row.get("profile.login", "")]
+             for row in read_table(dump_dir, "users")),
+            key=lambda x: x[0], chunk_size=chunk_size)
+
+
+def _with_logins(rows, logins):
+    """
+    Merge join of rows sorted by user ID (the first item) with (user ID,
+    login) pairs sorted by ID.
+
+    :return: A generator of (row, login), users which are not in logins
+             keep their ID as login
+    """
+    it = iter(logins)
+    user = next(it, None)
+    for row in rows:
+        while user is not None and user[0] < row[0]:
+            user = next(it, None)
+        yield row, user[1] if user is not None and user[0] == row[0] \
+            else row[0]
+
+
+def resolved_members(dump_dir, what, *, names=None, chunk_size=CHUNK_SIZE):
+    """
+    Translates the (group ID, user ID) table of a dump (group_users.csv,
+    app_users.csv) into (group name, login) pairs, which can be compared
+    between orgs. The user IDs are resolved with a sort-merge join against
+    users.csv, so the number of users does not matter.
+
+    :param what: "group" or "app"
+    :param names: The names of the groups or apps by ID, default: from the
+                  dump (see match_keys())
+    :return: A generator of dicts {"name", "login"}, sorted by name and
+             login
+    """
+    if names is None:
+        names = _names(dump_dir, f"{what}s", NAME_FIELDS[f"{what}s"])
+    members = external_sort(
+            ([row["user"], row[what]]
+             for row in read_table(dump_dir, f"{what}_users")),
+            key=lambda x: x[0], chunk_size=chunk_size)
+    joined = ({"name": names.get(owner, owner), "login": login}
+              for (_, owner), login in
+              _with_logins(members, _logins(dump_dir, chunk_size)))
+    rows = external_sort(joined, key=lambda x: (x["name"], x["login"]),
+                         chunk_size=chunk_size)
+    # the same membership twice in a dump
+    last = None
+    for row in rows:
+        if row != last:
+            yield row
+        last = row
+
+
+def _sorted_table(dump_dir, table, key, chunk_size):
+    return external_sort(read_table(dump_dir, table), key=key,
+                         chunk_size=chunk_size)
+
+
+def diff_dumps(left_dir, right_dir, *, tables=TABLES, fields=None,
+               chunk_size=CHUNK_SIZE):
+    """
+    Compares two dump directories.
+
+    Users are matched by login, groups by name and apps by label, so dumps
+    of different orgs can be compared. Groups and apps whose names are not
+    unique are matched as described in match_keys(), the ambiguous ones
+    are reported as "duplicate".
+
+    :param tables: The tables to compare
+    :param fields: Compare only these user fields
+    :return: A generator of (table, change, key, field, left value, right
+             value)
+    """
+    keys = {}
+
+    def keys_of(table):
+        if table not in keys:
+            keys[table] = match_keys(left_dir, right_dir, table)
+        return keys[table]
+
+    for table in tables:
+        if table == "users":
+            def key(row):
+                return row.get("profile.login", "")
+
+            left = _sorted_table(left_dir, table, key, chunk_size)
+            right = _sorted_table(right_dir, table, key, chunk_size)
+            changes = diff_tables(left, right, key, ignore=IGNORED_FIELDS,
+                                  fields=fields)
+        elif table in NAME_FIELDS:
+            def key(row):
+                return row[KEY_FIELD]
+
+            def keyed(dump_dir, row_keys):
+                return external_sort(
+                        (dict(row, **{KEY_FIELD: row_keys[row["id"]]})
+                         for row in read_table(dump_dir, table)),
+                        key=key, chunk_size=chunk_size)
+
+            left_keys, right_keys, ambiguous = keys_of(table)
+            for name in ambiguous:
+                yield table, "duplicate", name, "", "", ""
+            changes = diff_tables(keyed(left_dir, left_keys),
+                                  keyed(right_dir, right_keys), key,
+                                  ignore=IGNORED_FIELDS | {KEY_FIELD})
+        else:
+            what = table.split("_")[0]
+
+            def key(row):
+                return row["name"], row["login"]
+
+            left_keys, right_keys, _ = keys_of(f"{what}s")
+            left = resolved_members(left_dir, what, names=left_keys,
+                                    chunk_size=chunk_size)
+            right = resolved_members(right_dir, what, names=right_keys,
+                                     chunk_size=chunk_size)
+            changes = ((change, f"{k[0]} / {k[1]}", "", "", "")
+                       for change, k, *_ in diff_tables(left, right, key))
+        for change in changes:
+            yield (table,) + tuple(change)
+
+
+def _all_logins(old_dir, new_dir, chunk_size):
+    # (user ID, login) of both snapshots sorted by ID, the new login wins
+    def ranked(dump_dir, rank):
+        return ([user_id, rank, login] for user_id, login in
+                _logins(dump_dir, chunk_size))
+
+    last = None
+    for user_id, _, login in heapq.merge(ranked(new_dir, 0),
+                                         ranked(old_dir, 1)):
+        if user_id != last:
+            last = user_id
+            yield user_id, login
+
+
+def _member_changes(old_dir, new_dir, what, chunk_size):
+    names = _names(old_dir, f"{what}s", NAME_FIELDS[f"{what}s"])
+    names.update(_names(new_dir, f"{what}s", NAME_FIELDS[f"{what}s"]))
+
+    def members(dump_dir):
+        return external_sort(
+                ({"user": row["user"], what: row[what]}
+                 for row in read_table(dump_dir, f"{what}_users")),
+                key=lambda x: (x["user"], x[what]), chunk_size=chunk_size)
+
+    # sorted by user ID, to look up the logins with a merge join
+    changes = ([k[0], k[1], change] for change, k, *_ in diff_tables(
+            members(old_dir), members(new_dir),
+            lambda x: (x["user"], x[what])))
+    resolved = (
+            [names.get(owner, owner), login, change, f"{owner}/{user_id}"]
+            for (user_id, owner, change), login in _with_logins(
+                changes, _all_logins(old_dir, new_dir, chunk_size)))
+    for name, login, change, ids in external_sort(
+            resolved, key=lambda x: x[:2], chunk_size=chunk_size):
+        yield change, ids, f"{name} / {login}", "", "", ""
+
+
+def diff_snapshots(old_dir, new_dir, *, tables=TABLES, fields=None,
+                   chunk_size=CHUNK_SIZE):
+    """
+    Compares two dumps of the same org, e.g. of last week and today.
+
+    In contrast to diff_dumps() users, groups and apps are matched by ID,
+    so a renamed user or group is one "changed" record (and not one
+    "removed" and one "added").
+
+    :param tables: The tables to compare
+    :param fields: Compare only these user fields
+    :return: A generator of (table, change, ID, name, field, old value,
+             new value), name being the login, group name or app label
+             (the new one if it changed)
+    """
+    for table in tables:
+        if table in NAME_FIELDS:
+            name_field = NAME_FIELDS[table]
+
+            def key(row):
+                return row["id"]
+
+            old = _sorted_table(old_dir, table, key, chunk_size)
+            new = _sorted_table(new_dir, table, key, chunk_size)
+            changes = (
+                    (change, row_id, name, field, a, b)
+                    for change, (row_id, name), field, a, b in diff_tables(
+                        old, new, key, ignore=IGNORED_FIELDS,
+                        fields=fields if table == "users" else None,
+                        label=lambda x: (x["id"], x.get(name_field, ""))))
+        else:
+            changes = _member_changes(old_dir, new_dir, table.split("_")[0],
+                                      chunk_size)
+        for change in changes:
+            yield (table,) + tuple(change)
@@ -1,2 +1,7 @@
 class ExitException(Exception):
     pass
+
+
+class DeadlineExceeded(ExitException):
+    """Raised when the --deadline of a command is reached"""
+    pass
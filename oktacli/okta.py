@@ -1,9 +1,22 @@
 import enum
 import json
+import re
+import threading
 import time
+from urllib.parse import urlsplit
 
 import requests
 
+from .cache import ResponseCache
+from .exceptions import DeadlineExceeded
+from .parallel import AdaptiveLimiter, SingleFlight
+from .retry import RetryPolicy
+from .stats import ClientStats
+
+
+# a path segment containing an ID or a login, e.g. "00u1ab2c3d4e5f6g7h8i"
+ID_SEGMENT = re.compile(r"[^/]*[\d@][^/]*")
+
 
 class REST(enum.Enum):
     get = "get"
@@ -12,14 +25,94 @@ class REST(enum.Enum):
     delete = "delete"
 
 
+class AppIndex:
+    """
+    The apps of an org by ID, label and name, to find the app(s) a user
+    means on the command line.
+    """
+
+    def __init__(self, apps):
+        """
+        :param apps: The result of Okta.list_apps()
+        """
+        self.apps = apps
+        self.by_id = {app["id"]: app for app in apps}
+        self.by_label = {}
+        self.by_name = {}
+        for app in apps:
+            self.by_label.setdefault(app.get("label", "").lower(),
+                                     []).append(app)
+            self.by_name.setdefault(app.get("name", "").lower(),
+                                    []).append(app)
+
+    def find(self, name_or_label):
+        """
+        Looks up apps by ID, then by label or name (case insensitive), and
+        finally by a regular expression on label and name.
+
+        :return: A list of the matching apps
+        """
+        if name_or_label in self.by_id:
+            return [self.by_id[name_or_label]]
+        lowered = name_or_label.lower()
+        exact = self.by_label.get(lowered) or self.by_name.get(lowered)
+        if exact:
+            return list(exact)
+        try:
+            matcher = re.compile(lowered)
+        except re.error:
+            matcher = re.compile(re.escape(lowered))
+        return [app for app in self.apps
+                if matcher.search(app.get("label", "").lower()) or
+                matcher.search(app.get("name", "").lower())]
+
+
 class Okta:
 
-    def __init__(self, url, token):
+    # start waiting for the rate limit reset when fewer requests are left
+    rate_limit_reserve = 5
+    # default timeouts in seconds
+    connect_timeout = 10.0
+    read_timeout = 60.0
+    # seconds a GET result is re-used within the process (0 to disable),
+    # any write request clears it
+    memo_ttl = 5.0
+
+    def __init__(self, url, token, *, retries=None, timeouts=None,
+                 cache=None):
+        """
+        :param url: The Okta URL, e.g. "https://example.okta.com"
+        :param token: The API token
+        :param retries: Retry settings, see RetryPolicy (a dict, e.g.
+                        {"server": 10, "base_delay": 1})
+        :param timeouts: Timeouts in seconds, a dict like
+                         {"connect": 10, "read": 60}
+        :param cache: Cache GET responses on disk, see set_cache()
+        """
         self.token = token
+        self.retry = RetryPolicy(**(retries or {}))
+        self.set_timeouts(**(timeouts or {}))
+        # time.monotonic() value after which no requests are made
+        self.deadline = None
         self.path_base = "/api/v1"
+        # endpoint -> (remaining requests, reset time)
+        self.rate_limits = {}
+        self._lock = threading.Lock()
+        # functions (endpoint, response) called for every response
+        self.observers = []
+        self.limiter = None
+        self.stats = ClientStats()
+        self.tracer = None
+        self.flights = SingleFlight(memo_ttl=self.memo_ttl,
+                                    on_merged=self.stats.record_merged)
+        # see app_index()
+        self._app_index = None
+        self._app_index_lock = threading.Lock()
 
         # TODO: use urljoin or something for this
         self.url = url + self.path_base
+        self.cache = None
+        self.set_cache(cache)
 
         self.session = requests.Session()
         self.session.headers.update({
@@ -28,35 +121,269 @@ class Okta:
             'Authorization': 'SSWS ' + token,
         })
 
+    def set_timeouts(self, connect=None, read=None):
+        """
+        Sets the connect and/or read timeout (seconds) for all requests.
+        """
+        if connect is not None:
+            self.connect_timeout = float(connect)
+        if read is not None:
+            self.read_timeout = float(read)
+
+    def set_cache(self, cache):
+        """
+        Enables or disables the response cache (see ResponseCache).
+
+        :param cache: False or None to disable, True for the default
+                      settings, or a dict with the optional keys "file"
+                      (the cache database) and "ttls" (TTL in seconds by
+                      endpoint, e.g. {"/users/{id}": 300})
+        """
+        if not cache:
+            self.cache = None
+            return
+        settings = cache if isinstance(cache, dict) else {}
+        self.cache = ResponseCache(settings.get("file"),
+                                   ttls=settings.get("ttls"),
+                                   scope=self.url + " " + self.token)
+
+    def set_tracer(self, tracer):
+        """
+        Records all requests with a trace.Tracer from now on.
+        """
+        tracer.install(self.session)
+        self.tracer = tracer
+
+    def set_deadline(self, seconds):
+        """
+        Sets a deadline: after this many seconds from now every request
+        raises DeadlineExceeded instead of being sent. Running requests
+        time out at the deadline, waits for retries or rate limit resets
+        which would last beyond it are skipped.
+
+        :param seconds: The time left, None for no deadline
+        """
+        self.deadline = time.monotonic() + seconds \
+            if seconds is not None else None
+
+    def time_left(self):
+        """
+        :return: The seconds until the deadline, None if there is none
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def deadline_reached(self):
+        left = self.time_left()
+        return left is not None and left <= 0
+
+    def _sleep(self, delay, *, throttle=False):
+        left = self.time_left()
+        if left is not None and delay >= left:
+            raise DeadlineExceeded("Deadline reached.")
+        start = time.time()
+        time.sleep(delay)
+        self.stats.record_sleep(delay, throttle=throttle)
+        if self.tracer is not None:
+            self.tracer.sleep(start, delay, throttle=throttle)
+
+    def _timeout(self):
+        connect, read = self.connect_timeout, self.read_timeout
+        left = self.time_left()
+        if left is not None:
+            if left <= 0:
+                raise DeadlineExceeded("Deadline reached.")
+            connect, read = min(connect, left), min(read, left)
+        return connect, read
+
+    def endpoint_of(self, path):
+        """
+        Returns the endpoint of a path or URL with IDs and logins replaced,
+        e.g. "/users/{id}/groups". Okta's rate limits are per endpoint.
+        """
+        path = urlsplit(path).path
+        if path.startswith(self.path_base):
+            path = path[len(self.path_base):]
+        return "/".join("{id}" if ID_SEGMENT.fullmatch(x) else x
+                        for x in path.rstrip("/").split("/"))
+
+    def _pace(self, endpoint):
+        # don't run into a 429 if we know we're about to
+        with self._lock:
+            remaining, reset = self.rate_limits.get(endpoint, (None, 0))
+        if remaining is not None and remaining <= self.rate_limit_reserve:
+            delay = reset - time.time()
+            if delay > 0:
+                self._sleep(delay, throttle=True)
+
+    def _track_rate_limit(self, endpoint, rsp):
+        try:
+            remaining = int(rsp.headers["X-Rate-Limit-Remaining"])
+            reset = int(rsp.headers["X-Rate-Limit-Reset"])
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            self.rate_limits[endpoint] = (remaining, reset)
+
+    def get_limiter(self, workers=25, *, max_workers=100, adaptive=True):
+        """
+        Returns the concurrency limiter of this client, which is shared by
+        all parallel operations. It is created on the first call, later
+        calls return the same one.
+
+        :param workers: The initial concurrency
+        :param max_workers: The maximum concurrency
+        :param adaptive: Adapt the concurrency to the responses
+        :return: An AdaptiveLimiter
+        """
+        with self._lock:
+            if self.limiter is None:
+                self.limiter = AdaptiveLimiter(workers,
+                                               max_limit=max_workers,
+                                               adaptive=adaptive)
+                self.observers.append(self._feed_limiter)
+            return self.limiter
+
+    def _feed_limiter(self, endpoint, rsp):
+        def header(name):
+            try:
+                return int(rsp.headers[name])
+            except (KeyError, ValueError):
+                return None
+        self.limiter.observe(rsp.status_code,
+                             rsp.elapsed.total_seconds(),
+                             header("X-Rate-Limit-Remaining"),
+                             header("X-Rate-Limit-Limit"))
+
     def call_okta_raw(self, path, method, *, params=None, body_obj=None,
-                      implicit_url=True):
+                      body_data=None, implicit_url=True, idempotent=None,
+                      page=None):
+        """
+        Calls the Okta API. Throttled requests, server errors and network
+        errors are retried according to the retry policy (see RetryPolicy).
+        Raises DeadlineExceeded if the deadline is reached (see
+        set_deadline()). GET requests may be answered from the cache (see
+        set_cache()), identical concurrent GETs are merged into one request
+        and their results are re-used for memo_ttl seconds.
+
+        :param idempotent: True if the request may be repeated safely,
+                           default: True for GET and PUT
+        :param page: The page number when following "next" links (only
+                     used for tracing)
+        """
         call_method = getattr(self.session, method.value)
         call_params = {"params": params if params is not None else {}}
         call_path = self.url + path if implicit_url else path
-        if method == REST.post and body_obj:
+        if body_data is not None:
+            # already JSON encoded
+            call_params["data"] = body_data
+        elif method == REST.post and body_obj:
             call_params["data"] = json.dumps(body_obj)
+        if idempotent is None:
+            idempotent = method in (REST.get, REST.put)
 
-        while True:
-            rsp = call_method(call_path, **call_params)
+        endpoint = self.endpoint_of(call_path)
+        if method != REST.get:
+            # later reads must not see results from before the write
+            self.flights.forget()
+            if self.cache is not None:
+                self.cache.invalidate(endpoint)
+            if endpoint.startswith("/apps"):
+                self._app_index = None
+            rsp = self._send(call_method, call_path, call_params,
+                             endpoint, idempotent, page)
+            self._raise_for_status(rsp)
+            return rsp
+        url = requests.Request("GET", call_path,
+                               params=call_params["params"]).prepare().url
+        return self.flights.do(url, lambda: self._get(
+                url, call_path, call_params, endpoint, idempotent, page))
 
-            if rsp.status_code != 429:
-                # not throttled? break the loop.
-                break
+    def _get(self, url, call_path, call_params, endpoint, idempotent, page):
+        entry = None
+        ttl = self.cache.ttl_of(endpoint) if self.cache is not None else None
+        if ttl is not None:
+            entry = self.cache.get(url)
+            if entry is not None:
+                if entry.age() < ttl:
+                    self.stats.record_cache_hit()
+                    return entry.response()
+                call_params["headers"] = entry.conditional_headers()
+        rsp = self._send(self.session.get, call_path, call_params,
+                         endpoint, idempotent, page)
+        if ttl is not None:
+            if rsp.status_code == 304 and entry is not None:
+                self.cache.touch(url)
+                return entry.response()
+            if rsp.status_code == 200:
+                self.cache.put(url, endpoint, rsp)
+        self._raise_for_status(rsp)
+        return rsp
+
+    def _send(self, call_method, call_path, call_params, endpoint,
+              idempotent, page=None):
+        attempts = {}
+        sent = len(call_params.get("data") or "")
+        attempt = 0
+        while True:
+            self._pace(endpoint)
+            attempt += 1
+            start, wall_start = time.monotonic(), time.time()
+            try:
+                rsp = call_method(call_path, timeout=self._timeout(),
+                                  **call_params)
+            except requests.RequestException as e:
+                self.stats.record(endpoint, time.monotonic() - start,
+                                  sent=sent)
+                if self.tracer is not None:
+                    self.tracer.request(
+                            method=call_method.__name__, endpoint=endpoint,
+                            path=call_path, params=call_params["params"],
+                            start=wall_start,
+                            total=time.monotonic() - start, page=page,
+                            attempt=attempt, sent=sent, error=e)
+                if self.deadline_reached():
+                    raise DeadlineExceeded("Deadline reached.") from e
+                delay = self.retry.next_delay(attempts, exc=e,
+                                              idempotent=idempotent)
+                if delay is None:
+                    raise
+                self.stats.record_retry(endpoint)
+                self._sleep(delay)
+                continue
+            self.stats.record(endpoint, time.monotonic() - start,
+                              rsp=rsp, sent=sent)
+            if self.tracer is not None:
+                self.tracer.request(
+                        method=call_method.__name__, endpoint=endpoint,
+                        path=call_path, params=call_params["params"],
+                        start=wall_start, total=time.monotonic() - start,
+                        page=page, attempt=attempt, sent=sent, rsp=rsp)
+            self._track_rate_limit(endpoint, rsp)
+            for observer in self.observers:
+                observer(endpoint, rsp)
 
-            # get header with "we're good again" date (epoch time)
-            until = int(rsp.headers.get("X-Rate-Limit-Reset"))
-            delay = max(1, int(until - time.time()))
-            time.sleep(delay)
+            delay = self.retry.next_delay(attempts, rsp=rsp,
+                                          idempotent=idempotent)
+            if delay is None:
+                return rsp
+            self.stats.record_retry(endpoint)
+            self._sleep(delay, throttle=rsp.status_code == 429)
             # now try again
 
+    @staticmethod
+    def _raise_for_status(rsp):
         if rsp.status_code >= 400:
-            raise requests.HTTPError(json.dumps(rsp.json()))
-        return rsp
+            raise requests.HTTPError(json.dumps(rsp.json()), response=rsp)
 
     def call_okta(self, path, method, *,
-                  params=None, body_obj=None,
-                  result_limit=None):
-        rsp = self.call_okta_raw(path, method, params=params, body_obj=body_obj)
+                  params=None, body_obj=None, body_data=None,
+                  result_limit=None, idempotent=None):
+        page = 1
+        rsp = self.call_okta_raw(path, method, params=params,
+                                 body_obj=body_obj, body_data=body_data,
+                                 idempotent=idempotent, page=page)
         rv = rsp.json()
         # NOW, we either have a SINGLE DICT in the rv variable,
         #     *OR*
@@ -73,7 +400,9 @@ class Okta:
             if not url or last_url == url:
                 break
             last_url = url
-            rsp = self.call_okta_raw(url, REST.get, implicit_url=False)
+            page += 1
+            rsp = self.call_okta_raw(url, REST.get, implicit_url=False,
+                                     page=page)
             # now the += operation is safe, cause we have a list.
             # this is a liiiitle bit implicit, but should work smoothly.
             rv += rsp.json()
@@ -85,6 +414,30 @@ class Okta:
             rv.pop("_links", None)
         return rv
 
+    def call_okta_iter(self, path, *, params=None):
+        """
+        Like call_okta() for list results, but yields the items page by page
+        instead of collecting them all first.
+
+        :param path: The API path, e.g. "/users"
+        :param params: Query parameters
+        :return: A generator of result items
+        """
+        page = 1
+        rsp = self.call_okta_raw(path, REST.get, params=params, page=page)
+        last_url = None
+        while True:
+            for item in rsp.json():
+                item.pop("_links", None)
+                yield item
+            url = rsp.links.get("next", {"url": ""})["url"]
+            if not url or last_url == url:
+                break
+            last_url = url
+            page += 1
+            rsp = self.call_okta_raw(url, REST.get, implicit_url=False,
+                                     page=page)
+
     def list_groups(self, query_ex="", filter_ex=""):
         params = {}
         if query_ex:
@@ -93,7 +446,8 @@ class Okta:
             params["filter"] = filter_ex
         return self.call_okta("/groups", REST.get, params=params)
 
-    def list_users(self, filter_query="", search_query=""):
+    @staticmethod
+    def _list_users_params(filter_query, search_query):
         if filter_query:
             params = {"filter": filter_query}
         elif search_query:
@@ -101,23 +455,47 @@ class Okta:
         else:
             params = {}
         params.update({"limit": 1000})
+        return params
+
+    def list_users(self, filter_query="", search_query=""):
+        params = self._list_users_params(filter_query, search_query)
         return self.call_okta("/users", REST.get, params=params)
 
+    def iter_users(self, filter_query="", search_query=""):
+        params = self._list_users_params(filter_query, search_query)
+        return self.call_okta_iter("/users", params=params)
+
     def list_apps(self):
         return self.call_okta("/apps", REST.get)
 
+    def app_index(self):
+        """
+        Returns an AppIndex of all apps. The app list is downloaded once
+        per client (or taken from the response cache, see set_cache()), and
+        again after a write request to an /apps endpoint.
+        """
+        with self._app_index_lock:
+            if self._app_index is None:
+                self._app_index = AppIndex(self.list_apps())
+            return self._app_index
+
     def add_user(self, query_params, body_object):
         body = json.dumps(body_object).encode("utf-8")
-        rsp = self.session.post(self.url + "/users/",
-                                params=query_params,
-                                data=body)
-        if rsp.status_code >= 400:
-            raise requests.HTTPError(json.dumps(rsp.json()))
+        rsp = self.call_okta_raw("/users/", REST.post,
+                                 params=query_params, body_data=body)
         return rsp.json()
 
-    def update_user(self, user_id, body_object):
+    def update_user(self, user_id, body_object=None, *, body_data=None):
         path = "/users/" + user_id
-        return self.call_okta(path, REST.post, body_obj=body_object)
+        # a partial profile update sets the same values again if repeated,
+        # but setting the same password again can fail (password history)
+        if body_data is not None:
+            body = json.loads(body_data)
+        else:
+            body = body_object or {}
+        return self.call_okta(path, REST.post,
+                              body_obj=body_object, body_data=body_data,
+                              idempotent="credentials" not in body)
 
     def get_profile_schema(self):
         path = "/meta/schemas/user/default/"
@@ -143,24 +521,22 @@ class Okta:
         """
         path = "/users/" + user_id
         params = {"sendEmail": "true"} if send_email else {}
-        return self.call_okta_raw(path, REST.delete, params=params)
+        # the first call deactivates the user, a second one deletes it
+        return self.call_okta_raw(path, REST.delete, params=params,
+                                  idempotent=False)
 
     def reset_password(self, user_id, *, send_email=True):
-        url = self.url + f"/users/{user_id}/lifecycle/reset_password"
-        rsp = self.session.post(
-                url,
+        path = f"/users/{user_id}/lifecycle/reset_password"
+        rsp = self.call_okta_raw(
+                path, REST.post,
                 params={'sendEmail': f"{str(send_email).lower()}"}
         )
-        if rsp.status_code >= 400:
-            raise requests.HTTPError(json.dumps(rsp.json()))
         return rsp.json()
 
     def expire_password(self, user_id, *, temp_password=False):
-        url = self.url + f"/users/{user_id}/lifecycle/expire_password"
-        rsp = self.session.post(
-                url,
+        path = f"/users/{user_id}/lifecycle/expire_password"
+        rsp = self.call_okta_raw(
+                path, REST.post,
                 params={'tempPassword': f"{str(temp_password).lower()}"}
         )
-        if rsp.status_code >= 400:
-            raise requests.HTTPError(json.dumps(rsp.json()))
         return rsp.json()
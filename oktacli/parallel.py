@@ -0,0 +1,287 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+
+
+# per-thread values, inherited by the worker threads of run_parallel()
+_inherited = threading.local()
+
+
+def thread_values():
+    """
+    :return: A dict of values for the current thread. The worker threads of
+             run_parallel() see the values of the thread which started
+             them.
+    """
+    values = getattr(_inherited, "values", None)
+    if values is None:
+        values = _inherited.values = {}
+    return values
+
+
+def inheriting(func):
+    """
+    Wraps func so it sees the thread_values() of the current thread when
+    it is called in another thread, e.g. in a thread pool used with
+    ordered_map().
+    """
+    values = thread_values()
+
+    def call(*args, **kwargs):
+        _inherited.values = values
+        return func(*args, **kwargs)
+
+    return call
+
+
+def batched(iterable, size):
+    """
+    Splits an iterable into lists of (at most) size items.
+
+    :param iterable: The iterable to split
+    :param size: The maximum size of a batch
+    :return: A generator of lists
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def ordered_map(executor, func, iterable, *args, max_pending=4):
+    """
+    Like executor.map(), but only submits max_pending calls at a time, so
+    the iterable is consumed lazily and memory stays bounded even for huge
+    inputs. Results are yielded in input order.
+
+    :param executor: A concurrent.futures executor
+    :param func: The function to call with each item (and *args)
+    :param iterable: The input items
+    :param max_pending: The maximum number of submitted, unfinished calls
+    :return: A generator of results
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _outcome(item, future):
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
+
+
+class AdaptiveLimiter:
+    """
+    An AIMD ("additive increase, multiplicative decrease") concurrency
+    limit, like TCP congestion control:
+
+    * every healthy response (fast enough, and enough requests left
+      according to X-Rate-Limit-Remaining) raises the limit by 1/limit,
+      i.e. by about one per round of requests
+    * a 429, a 5xx or an almost exhausted rate limit halves it (at most
+      once per cooldown period, so one burst of 429s counts only once)
+    * slow responses (latency_factor times the long-term average) keep
+      the limit where it is
+
+    With adaptive=False the limit simply stays at its initial value.
+
+    Register observe() with Okta.observers to feed it, or use
+    Okta.get_limiter().
+    """
+
+    backoff = 0.5
+    cooldown = 1.0
+    latency_factor = 2.0
+    # fractions of the rate limit left: below "low" we back off, above
+    # "healthy" we may grow
+    remaining_low = 0.1
+    remaining_healthy = 0.25
+
+    def __init__(self, limit=25, *, min_limit=1, max_limit=100,
+                 adaptive=True):
+        self.adaptive = adaptive
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, limit) if adaptive else limit
+        self.limit = float(limit)
+        self.in_flight = 0
+        self._latency = None
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    @property
+    def current(self):
+        return max(self.min_limit, int(self.limit))
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.current:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+    def observe(self, status, latency, remaining=None, rate_limit=None):
+        """
+        Feeds one response into the controller.
+
+        :param status: The HTTP status code
+        :param latency: The response time in seconds
+        :param remaining: The X-Rate-Limit-Remaining header value, if any
+        :param rate_limit: The X-Rate-Limit-Limit header value, if any
+        """
+        if not self.adaptive:
+            return
+        with self._cond:
+            ratio = remaining / rate_limit \
+                if remaining is not None and rate_limit else 1.0
+            if status == 429 or status >= 500 or ratio < self.remaining_low:
+                self._decrease()
+            elif ratio >= self.remaining_healthy and (
+                    self._latency is None or
+                    latency <= self._latency * self.latency_factor):
+                self.limit = min(self.max_limit,
+                                 self.limit + 1.0 / self.limit)
+            if status < 400:
+                self._latency = latency if self._latency is None \
+                    else 0.95 * self._latency + 0.05 * latency
+            self._cond.notify_all()
+
+
+def run_parallel(func, items, *, workers=25, limiter=None):
+    """
+    Calls func(item) for all items in a thread pool, and yields the outcomes
+    as soon as the calls complete (i.e. not in input order). Items are
+    consumed lazily, only as many as allowed by the limiter run at the
+    same time.
+
+    Exceptions do not stop the run, they are yielded like results.
+
+    :param func: The function to call for each item
+    :param items: The input items, any iterable
+    :param workers: The number of threads, if no limiter is given
+    :param limiter: An AdaptiveLimiter which controls the concurrency
+    :return: A generator of tuples (item, result, exception)
+    """
+    if limiter is None:
+        limiter = AdaptiveLimiter(workers, adaptive=False)
+    func = inheriting(func)
+
+    def call(item):
+        try:
+            return func(item)
+        finally:
+            limiter.release()
+
+    with ThreadPoolExecutor(max_workers=limiter.max_limit) as ex:
+        pending = {}
+        for item in items:
+            limiter.acquire()
+            pending[ex.submit(call, item)] = item
+            for future in [x for x in pending if x.done()]:
+                yield _outcome(pending.pop(future), future)
+        for future in as_completed(list(pending)):
+            yield _outcome(pending.pop(future), future)
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Merges concurrent calls with the same key: the first caller does the
+    work, all others arriving while it runs wait for it and get the same
+    result (or exception). Successful results can be kept for memo_ttl
+    seconds, so callers shortly after get them without any work.
+    """
+
+    def __init__(self, *, memo_ttl=0, memo_size=1024, on_merged=None):
+        """
+        :param memo_ttl: Seconds to keep results, 0 for no memo
+        :param memo_size: The maximum number of results kept
+        :param on_merged: Called without arguments for every call which
+                          was answered by another call or from the memo
+        """
+        self.memo_ttl = memo_ttl
+        self.memo_size = memo_size
+        self.on_merged = on_merged
+        self._flights = {}
+        self._memo = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        :param key: Identifies the call, e.g. a URL
+        :param func: Does the work, called without arguments
+        :return: The result of func()
+        """
+        with self._lock:
+            memo = self._memo.get(key)
+            if memo is None or memo[0] <= time.monotonic():
+                memo = None
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+        if memo is not None or not leader:
+            if self.on_merged is not None:
+                self.on_merged()
+        if memo is not None:
+            return memo[1]
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                    if flight.error is None and self.memo_ttl > 0:
+                        self._remember(key, flight.result)
+            flight.done.set()
+        return flight.result
+
+    def _remember(self, key, result):
+        self._memo[key] = (time.monotonic() + self.memo_ttl, result)
+        self._memo.move_to_end(key)
+        while len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+
+    def forget(self):
+        """
+        Drops the memo, and makes sure later calls don't join calls which
+        are already running.
+        """
+        with self._lock:
+            self._memo.clear()
+            self._flights = {}
@@ -0,0 +1,397 @@
+import operator
+import re
+
+from .exceptions import ExitException
+
+
+# Expressions look like this:
+#
+#   profile.department == "IT" and not (status in ("SUSPENDED", "LOCKED_OUT")
+#       or profile.title ~ "^Intern")
+#
+# They are parsed into a small tree of tuples:
+#
+#   ("and", [node, ...])
+#   ("or", [node, ...])
+#   ("not", node)
+#   ("cmp", op, path, value)   -- path is a tuple of keys
+#
+# which is then compiled into closures (compile_predicate()) or evaluated
+# column by column with numpy (filter_columnar()).
+
+
+TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+   |(?P<num>-?\d+(?:\.\d+)?(?![\w.]))
+   |(?P<op>==|!=|<=|>=|<|>|!~|~|\(|\)|,)
+   |(?P<word>[A-Za-z_][\w.\-]*)
+)""", re.X)
+
+KEYWORDS = {"true": True, "false": False, "null": None}
+
+COMPARE_OPS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<":  operator.lt,
+    "<=": operator.le,
+    ">":  operator.gt,
+    ">=": operator.ge,
+}
+
+
+def _unquote(token):
+    # only quotes and backslashes are escaped, "\d" stays a regex "\d"
+    return re.sub(r"\\([\\\"'])", r"\1", token[1:-1])
+
+
+def tokenize(expr):
+    rv = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = TOKEN_RE.match(expr, pos)
+        if not match or match.end() == pos:
+            raise ExitException(f"Invalid expression at position {pos}: "
+                                f"'{expr[pos:]}'")
+        pos = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "str":
+            rv.append(("value", _unquote(text)))
+        elif kind == "num":
+            rv.append(("value", float(text) if "." in text else int(text)))
+        elif kind == "word" and text.lower() in KEYWORDS:
+            rv.append(("value", KEYWORDS[text.lower()]))
+        elif kind == "word" and text.lower() in ("and", "or", "not", "in"):
+            rv.append(("op", text.lower()))
+        else:
+            rv.append((kind, text))
+    return rv
+
+
+class _Parser:
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.pos = 0
+
+    def error(self, msg):
+        raise ExitException(f"Invalid expression '{self.expr}': {msg}")
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) \
+            else (None, None)
+
+    def take(self, kind=None, text=None):
+        tok = self.peek()
+        if (kind and tok[0] != kind) or (text and tok[1] != text):
+            self.error(f"expected {text or kind}, got {tok[1]!r}")
+        self.pos += 1
+        return tok
+
+    def parse(self):
+        rv = self.parse_or()
+        if self.pos != len(self.tokens):
+            self.error(f"unexpected {self.peek()[1]!r}")
+        return rv
+
+    def parse_or(self):
+        items = [self.parse_and()]
+        while self.peek() == ("op", "or"):
+            self.take()
+            items.append(self.parse_and())
+        return items[0] if len(items) == 1 else ("or", items)
+
+    def parse_and(self):
+        items = [self.parse_not()]
+        while self.peek() == ("op", "and"):
+            self.take()
+            items.append(self.parse_not())
+        return items[0] if len(items) == 1 else ("and", items)
+
+    def parse_not(self):
+        if self.peek() == ("op", "not"):
+            self.take()
+            return ("not", self.parse_not())
+        if self.peek() == ("op", "("):
+            self.take()
+            rv = self.parse_or()
+            self.take("op", ")")
+            return rv
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        path = tuple(self.take("word")[1].split("."))
+        kind, op = self.take("op")
+        if op == "not":
+            self.take("op", "in")
+            return ("not", ("cmp", "in", path, self.parse_set()))
+        if op == "in":
+            return ("cmp", "in", path, self.parse_set())
+        if op not in COMPARE_OPS and op not in ("~", "!~"):
+            self.error(f"unknown operator {op!r}")
+        value = self.take("value")[1]
+        if op in ("~", "!~"):
+            if not isinstance(value, str):
+                self.error(f"regex must be a string, got {value!r}")
+            node = ("cmp", "search", path, value)
+            return ("not", node) if op == "!~" else node
+        return ("cmp", op, path, value)
+
+    def parse_set(self):
+        self.take("op", "(")
+        values = [self.take("value")[1]]
+        while self.peek() == ("op", ","):
+            self.take()
+            values.append(self.take("value")[1])
+        self.take("op", ")")
+        return frozenset(values)
+
+
+def parse(expr):
+    """
+    Parses a filter expression into a predicate tree.
+
+    Supported are dotted paths into the user object ("status",
+    "profile.department", "credentials.provider.type"), the comparisons
+    ==, !=, <, <=, >, >=, regex matches ~ and !~ (re.search), set
+    membership "in (...)" and "not in (...)", combined with and, or, not
+    and parentheses. Values are strings in single or double quotes,
+    numbers, true, false and null.
+
+    :param expr: The expression string
+    :return: A predicate tree (nested tuples)
+    """
+    return _Parser(expr).parse()
+
+
+def match_node(path, regex, *, partial=False):
+    """
+    :return: A predicate node for a regex match on a path. For partial=False
+             the whole value must match (re.fullmatch).
+    """
+    return ("cmp", "search" if partial else "fullmatch", tuple(path), regex)
+
+
+def _make_getter(path):
+    if len(path) == 1:
+        key = path[0]
+        return lambda obj: obj.get(key)
+
+    def getter(obj):
+        for key in path:
+            if not isinstance(obj, dict):
+                return None
+            obj = obj.get(key)
+        return obj
+
+    return getter
+
+
+def _make_check(op, value):
+    """
+    :return: A function value -> bool for one comparison. Missing values
+             (None) never match, except for "== null" / "!= null".
+    """
+    if op in ("search", "fullmatch"):
+        matcher = getattr(re.compile(value), op)
+
+        def check(v):
+            if v is None:
+                return False
+            return matcher(v if isinstance(v, str) else str(v)) is not None
+        return check
+    if op == "in":
+        def check(v):
+            try:
+                return v in value
+            except TypeError:
+                # unhashable, e.g. a list
+                return False
+        return check
+    if value is None and op in ("==", "!="):
+        return (lambda v: v is None) if op == "==" \
+            else (lambda v: v is not None)
+    compare = COMPARE_OPS[op]
+
+    def check(v):
+        if v is None:
+            return False
+        try:
+            return compare(v, value)
+        except TypeError:
+            return False
+    return check
+
+
+def _make_multi_check(getter, checks):
+    def pred(obj):
+        value = getter(obj)
+        for check in checks:
+            if not check(value):
+                return False
+        return True
+    return pred
+
+
+def _compile_and(nodes):
+    # comparisons on the same path share one lookup per object
+    by_path = {}
+    others = []
+    for node in nodes:
+        if node[0] == "cmp":
+            check = _make_check(node[1], node[3])
+            by_path.setdefault(node[2], []).append(check)
+        else:
+            others.append(compile_predicate(node))
+    preds = [_make_multi_check(_make_getter(path), tuple(checks))
+             for path, checks in by_path.items()]
+    preds = tuple(preds + others)
+
+    def pred(obj):
+        for p in preds:
+            if not p(obj):
+                return False
+        return True
+    return pred
+
+
+def compile_predicate(node):
+    """
+    Compiles a predicate tree into a function obj -> bool. The tree is
+    walked only once; regexes are compiled and paths are split up front.
+
+    :param node: A predicate tree, see parse()
+    :return: A function
+    """
+    kind = node[0]
+    if kind == "cmp":
+        _, op, path, value = node
+        getter = _make_getter(path)
+        check = _make_check(op, value)
+        return lambda obj: check(getter(obj))
+    if kind == "and":
+        return _compile_and(node[1])
+    if kind == "or":
+        preds = tuple(compile_predicate(x) for x in node[1])
+
+        def pred(obj):
+            for p in preds:
+                if p(obj):
+                    return True
+            return False
+        return pred
+    if kind == "not":
+        inner = compile_predicate(node[1])
+        return lambda obj: not inner(obj)
+    raise ValueError(f"Unknown predicate node: {node!r}")
+
+
+class ColumnBatch:
+    """
+    A batch of objects (e.g. users) for column-wise filtering with numpy.
+
+    Every path used in a filter is looked up only once per object and kept
+    as a numpy column; comparisons then run as vectorized operations, and
+    and/or/not become boolean array operations. Keep the batch around to
+    run many filters over the same (cached) records - after the first
+    filter touched a column, filtering millions of records on it takes
+    milliseconds.
+
+    Requires numpy.
+    """
+
+    def __init__(self, objects):
+        import numpy
+        self.np = numpy
+        self.objects = list(objects)
+        self._values = {}
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.objects)
+
+    def values(self, path):
+        # nested paths re-use the values of their parent path
+        if path not in self._values:
+            key = path[-1]
+            parent = self.values(path[:-1]) if len(path) > 1 \
+                else self.objects
+            self._values[path] = [x.get(key) if isinstance(x, dict) else None
+                                  for x in parent]
+        return self._values[path]
+
+    def column(self, path):
+        if path not in self._columns:
+            col = self.np.empty(len(self.objects), dtype=object)
+            col[:] = self.values(path)
+            self._columns[path] = col
+        return self._columns[path]
+
+    def mask(self, node):
+        """
+        :param node: A predicate tree, see parse()
+        :return: A boolean numpy array, True for matching objects
+        """
+        np = self.np
+        kind = node[0]
+        if kind in ("and", "or"):
+            rv = self.mask(node[1][0])
+            for x in node[1][1:]:
+                if kind == "and":
+                    rv &= self.mask(x)
+                else:
+                    rv |= self.mask(x)
+            return rv
+        if kind == "not":
+            return ~self.mask(node[1])
+        _, op, path, value = node
+        col = self.column(path)
+        if op in ("==", "!="):
+            # elementwise comparison in C, None simply compares unequal
+            rv = np.asarray(col == value, dtype=bool)
+            if op == "==":
+                return rv
+            rv = ~rv
+            if value is not None:
+                rv &= np.asarray(col != None, dtype=bool)  # noqa: E711
+            return rv
+        if op == "in" and len(value) < 32:
+            rv = np.zeros(len(self.objects), dtype=bool)
+            for v in value:
+                rv |= np.asarray(col == v, dtype=bool)
+            return rv
+        if op in COMPARE_OPS and value is not None:
+            try:
+                # works if all values are comparable with the value
+                return np.asarray(COMPARE_OPS[op](col, value), dtype=bool)
+            except TypeError:
+                pass
+        check = np.frompyfunc(_make_check(op, value), 1, 1)
+        return check(col).astype(bool)
+
+    def filter(self, node):
+        """
+        :param node: A predicate tree, see parse()
+        :return: A list with the matching objects
+        """
+        if not self.objects:
+            return []
+        return [obj for obj, keep in zip(self.objects, self.mask(node))
+                if keep]
+
+
+def filter_columnar(node, objects):
+    """
+    Filters a list column-wise using a ColumnBatch. Falls back to
+    compile_predicate() if numpy is not installed.
+
+    :param node: A predicate tree, see parse()
+    :param objects: A list of dicts
+    :return: A list with the matching objects
+    """
+    try:
+        return ColumnBatch(objects).filter(node)
+    except ImportError:
+        return list(filter(compile_predicate(node), objects))
@@ -1,25 +1,160 @@
+import mmap
+import os
+import secrets
+import sqlite3
+import struct
+import sys
+import threading
+from array import array
+
 from pkg_resources import resource_filename
 
-from pony.orm import Database, Required, db_session
+from .exceptions import ExitException
 
-# resources:
-#   * https://github.com/ponyorm/pony/issues/33
-#   * https://stackoverflow.com/a/24591688/902327
 
+# packed word list format (all integers little endian):
+#
+#   header   "OKWL", version (uint16), number of words N (uint32)
+#   offsets  N + 1 uint32 offsets into the blob, word i is
+#            blob[offsets[i]:offsets[i + 1]]
+#   blob     the UTF-8 encoded words, without separators
+#
+# so picking a random word is one randbelow() and two offset reads, and
+# the file is memory-mapped instead of read.
+MAGIC = b"OKWL"
+VERSION = 1
+HEADER = struct.Struct("<4sHI")
+OFFSET = struct.Struct("<I")
 
-db = Database()
+_wordlists = {}
+_lock = threading.Lock()
 
 
-class Word(db.Entity):
-    lang = Required(str)
-    word = Required(str)
+def pack_words(words):
+    """
+    :param words: An iterable of words
+    :return: The words in the packed word list format (bytes)
+    """
+    blob = bytearray()
+    offsets = array("I", [0])
+    for word in words:
+        blob += word.encode("utf-8")
+        offsets.append(len(blob))
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    header = HEADER.pack(MAGIC, VERSION, len(offsets) - 1)
+    return header + offsets.tobytes() + bytes(blob)
 
 
-def generate_password(num_words=3, lang="en"):
+class WordList:
+    """
+    A read-only list of words in the packed word list format.
+    """
+
+    def __init__(self, data):
+        """
+        :param data: The packed word list (bytes or an mmap)
+        """
+        magic, version, count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a packed word list (version "
+                             f"{VERSION})")
+        self.data = data
+        self.count = count
+        self._offsets = HEADER.size
+        self._blob = HEADER.size + (count + 1) * OFFSET.size
+
+    @classmethod
+    def open(cls, file):
+        with open(file, "rb") as infile:
+            return cls(mmap.mmap(infile.fileno(), 0,
+                                 access=mmap.ACCESS_READ))
+
+    @classmethod
+    def from_words(cls, words):
+        return cls(pack_words(words))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        pos = self._offsets + idx * OFFSET.size
+        start = OFFSET.unpack_from(self.data, pos)[0]
+        end = OFFSET.unpack_from(self.data, pos + OFFSET.size)[0]
+        return self.data[self._blob + start:self._blob + end].decode("utf-8")
+
+    def sample(self, num):
+        """
+        :return: num different random words (cryptographically secure)
+        """
+        if num > self.count:
+            raise ValueError(f"Cannot pick {num} different words from "
+                             f"{self.count}")
+        picked = set()
+        rv = []
+        while len(rv) < num:
+            idx = secrets.randbelow(self.count)
+            if idx not in picked:
+                picked.add(idx)
+                rv.append(self[idx])
+        return rv
+
+
+def wordlist_file(lang):
+    return resource_filename("oktacli", f"wordlist-{lang}.bin")
+
+
+def _load_from_sqlite(lang):
+    # word lists imported with older versions of tools/import-wordlist.py
     sqlfile = resource_filename("oktacli", "wordlist.sqlite")
-    db.bind("sqlite", sqlfile)
-    db.generate_mapping(create_tables=True)
-    with db_session:
-        rv = [p.word
-              for p in Word.select(lambda x: x.lang == lang).random(num_words)]
-    return rv
+    if not os.path.isfile(sqlfile):
+        return None
+    db = sqlite3.connect(sqlfile)
+    try:
+        words = [row[0].strip() for row in
+                 db.execute("SELECT word FROM Word WHERE lang = ?", (lang,))]
+    except sqlite3.Error:
+        return None
+    finally:
+        db.close()
+    return WordList.from_words(x for x in words if x) if words else None
+
+
+def load_wordlist(lang="en"):
+    """
+    Loads the word list of a language once per process.
+
+    :return: A WordList
+    """
+    with _lock:
+        if lang not in _wordlists:
+            file = wordlist_file(lang)
+            if os.path.isfile(file):
+                wordlist = WordList.open(file)
+            else:
+                wordlist = _load_from_sqlite(lang)
+            if wordlist is None:
+                raise ExitException(f"No word list for language '{lang}' "
+                                    f"found. Create it with "
+                                    f"tools/import-wordlist.py.")
+            _wordlists[lang] = wordlist
+        return _wordlists[lang]
+
+
+def generate_password(num_words=3, lang="en"):
+    """
+    :return: A list of num_words random words
+    """
+    return load_wordlist(lang).sample(num_words)
+
+
+def generate_passwords(count, num_words=3, lang="en"):
+    """
+    Like generate_password(), but for count passwords at once.
+
+    :return: A list of lists of words
+    """
+    wordlist = load_wordlist(lang)
+    return [wordlist.sample(num_words) for _ in range(count)]
@@ -0,0 +1,297 @@
+import csv
+import io
+import itertools
+import json
+import os
+import sqlite3
+from os.path import splitext
+
+from openpyxl import load_workbook
+
+from .exceptions import ExitException
+
+
+# the columns which identify a user in a bulk-update file
+KEY_FIELDS = ("profile.login", "id")
+
+# the dialect attributes we need to re-create a sniffed CSV dialect
+DIALECT_ATTRS = ("delimiter", "quotechar", "escapechar", "doublequote",
+                 "skipinitialspace", "quoting", "lineterminator")
+
+INDEX_SUFFIX = ".okta-index"
+INDEX_VERSION = "1"
+
+
+def excel_reader(file):
+    """
+    Yields the rows of the active sheet of an Excel (.xlsx) file as dicts,
+    using the values of the first row as keys. Empty rows are skipped.
+
+    The workbook is opened in read-only mode, so rows are streamed from the
+    file instead of building the whole object model in memory.
+
+    :param file: The path to the .xlsx file
+    :return: A generator of dicts
+    """
+    wb = load_workbook(filename=file, read_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        # Get the header values as keys and move the iterator to the next item
+        keys = next(rows, None)
+        if keys is None:
+            return
+        num_keys = len(keys)
+        for values in rows:
+            rv = dict(zip(keys, values[:num_keys]))
+            if any(rv.values()):
+                yield rv
+    finally:
+        # read-only workbooks keep the file handle open until closed
+        wb.close()
+
+
+def csv_reader(file):
+    """
+    Yields the rows of a CSV file as dicts. The CSV dialect is guessed from
+    the beginning of the file. Empty rows are skipped.
+
+    :param file: The path to the CSV file
+    :return: A generator of dicts
+    """
+    with open(file, "r", encoding="utf-8") as infile:
+        dialect = csv.Sniffer().sniff(infile.read(4096))
+        infile.seek(0)
+        dr = csv.DictReader(infile, dialect=dialect)
+        for row in dr:
+            if any(row.values()):
+                yield row
+
+
+class CsvIndex:
+    """
+    A sidecar index for a CSV file, stored in an SQLite database next to it
+    (FILE.okta-index). It maps the row number (0-based, empty rows are not
+    counted) and the values of the "profile.login" and "id" columns to byte
+    offsets in the file, so reading can start at any row with a single seek.
+
+    The index is rebuilt automatically if the CSV file changes.
+    """
+
+    def __init__(self, file, index_file=None):
+        self.file = file
+        self.index_file = index_file or file + INDEX_SUFFIX
+        self.db = None
+        self.meta = {}
+
+    @classmethod
+    def open(cls, file, index_file=None):
+        """
+        Opens the index for a CSV file, and (re-)builds it if it does not
+        exist yet or is outdated.
+
+        :param file: The path to the CSV file
+        :param index_file: The path of the index, default: FILE.okta-index
+        :return: A CsvIndex instance
+        """
+        index = cls(file, index_file)
+        try:
+            if not index._load():
+                index._build()
+                index._load()
+        except (sqlite3.Error, OSError) as e:
+            # e.g. a read-only directory
+            raise ExitException(f"Cannot create the index "
+                                f"{index.index_file} ({e}), use --no-index "
+                                f"to read {file} without it.")
+        return index
+
+    def _source_stat(self):
+        st = os.stat(self.file)
+        return {"size": str(st.st_size), "mtime": str(st.st_mtime_ns)}
+
+    def _load(self):
+        if not os.path.isfile(self.index_file):
+            return False
+        try:
+            db = sqlite3.connect(self.index_file, check_same_thread=False)
+            meta = dict(db.execute("SELECT name, value FROM meta"))
+        except sqlite3.DatabaseError:
+            return False
+        stat = self._source_stat()
+        if meta.get("version") != INDEX_VERSION or \
+                any(meta.get(k) != v for k, v in stat.items()):
+            db.close()
+            return False
+        self.db = db
+        self.meta = meta
+        return True
+
+    def _build(self):
+        with open(self.file, "r", encoding="utf-8") as infile:
+            dialect = csv.Sniffer().sniff(infile.read(4096))
+        fmtparams = {k: getattr(dialect, k) for k in DIALECT_ATTRS}
+        tmp_file = self.index_file + ".tmp"
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        db = sqlite3.connect(tmp_file)
+        db.executescript("""
+            CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE rows (idx INTEGER PRIMARY KEY, offset INTEGER);
+            CREATE TABLE keys (key TEXT PRIMARY KEY, idx INTEGER)
+                WITHOUT ROWID;
+        """)
+        # we must know the byte position of each row. the CSV reader pulls
+        # lines from this generator only when it needs them, so after it
+        # returned a row "pos" points to the beginning of the next one.
+        pos = [0]
+
+        def tracked_lines(fh):
+            for line in fh:
+                pos[0] += len(line)
+                yield line.decode("utf-8")
+
+        with open(self.file, "rb") as infile:
+            reader = csv.reader(tracked_lines(infile), **fmtparams)
+            fieldnames = next(reader, [])
+            key_cols = [fieldnames.index(k)
+                        for k in KEY_FIELDS if k in fieldnames]
+            rows, keys = [], []
+            idx, start = 0, pos[0]
+            for row in reader:
+                if any(row):
+                    rows.append((idx, start))
+                    keys += [(row[c], idx) for c in key_cols
+                             if c < len(row) and row[c]]
+                    idx += 1
+                    if len(rows) >= 10000:
+                        self._flush(db, rows, keys)
+                start = pos[0]
+            self._flush(db, rows, keys)
+
+        meta = dict(self._source_stat(),
+                    version=INDEX_VERSION,
+                    rows=str(idx),
+                    fieldnames=json.dumps(fieldnames),
+                    dialect=json.dumps(fmtparams))
+        db.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+        db.commit()
+        db.close()
+        os.replace(tmp_file, self.index_file)
+
+    @staticmethod
+    def _flush(db, rows, keys):
+        db.executemany("INSERT INTO rows VALUES (?, ?)", rows)
+        # first occurrence wins, same as when scanning the file
+        db.executemany("INSERT OR IGNORE INTO keys VALUES (?, ?)", keys)
+        rows.clear()
+        keys.clear()
+
+    def __len__(self):
+        return int(self.meta["rows"])
+
+    def find_row(self, idx):
+        """
+        :param idx: The row number
+        :return: The byte offset of the row, or None if out of range
+        """
+        rv = self.db.execute("SELECT offset FROM rows WHERE idx = ?",
+                             (idx,)).fetchone()
+        return rv[0] if rv else None
+
+    def find_key(self, key):
+        """
+        :param key: A "profile.login" or "id" value
+        :return: A tuple (row number, byte offset), or None if not found
+        """
+        rv = self.db.execute("SELECT rows.idx, rows.offset FROM keys "
+                             "JOIN rows ON keys.idx = rows.idx "
+                             "WHERE keys.key = ?", (key,)).fetchone()
+        return tuple(rv) if rv else None
+
+    def rows_from(self, offset):
+        """
+        Yields all (non-empty) rows as dicts, starting at the byte offset.
+
+        :param offset: A byte offset as returned by find_row() or find_key()
+        :return: A generator of dicts
+        """
+        fieldnames = json.loads(self.meta["fieldnames"])
+        fmtparams = json.loads(self.meta["dialect"])
+        with open(self.file, "rb") as raw:
+            raw.seek(offset)
+            infile = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            dr = csv.DictReader(infile, fieldnames=fieldnames, **fmtparams)
+            for row in dr:
+                if any(row.values()):
+                    yield row
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def _is_user_row(row, user):
+    return user in (row.get(k, "") for k in KEY_FIELDS)
+
+
+def skip_rows(rows, *, jump_to_index=0, jump_to_user=None):
+    """
+    Skips rows of a row iterator until the given index or user is reached.
+
+    :param rows: An iterator of row dicts
+    :param jump_to_index: Skip this many rows
+    :param jump_to_user: Skip until a row with this login or ID is found
+                         (takes precedence over jump_to_index)
+    :return: A tuple (index of the first row, iterator of remaining rows)
+    """
+    rows = iter(rows)
+    if jump_to_user:
+        for idx, row in enumerate(rows):
+            if _is_user_row(row, jump_to_user):
+                return idx, itertools.chain([row], rows)
+        raise ExitException(f"User '{jump_to_user}' not found in file.")
+    for idx in range(jump_to_index):
+        if next(rows, None) is None:
+            raise ExitException(f"Cannot jump to index {jump_to_index}, "
+                                f"file has only {idx} rows.")
+    return jump_to_index, rows
+
+
+def read_rows(file, *, jump_to_index=0, jump_to_user=None, use_index=True):
+    """
+    Reads the rows of a CSV or Excel file, optionally starting at a given
+    index or user. For CSV files a sidecar index (see CsvIndex) is used to
+    jump, so resuming near the end of a huge file does not parse it all.
+
+    :param file: The path to the CSV or .xlsx file
+    :param jump_to_index: Start at this row number (0-based)
+    :param jump_to_user: Start at the row with this login or ID
+    :param use_index: Use (and create if needed) the sidecar index for CSVs
+    :return: A tuple (index of the first row, iterator of row dicts)
+    """
+    if splitext(file)[1].lower() == ".xlsx":
+        return skip_rows(excel_reader(file),
+                         jump_to_index=jump_to_index,
+                         jump_to_user=jump_to_user)
+    if not use_index or not (jump_to_index or jump_to_user):
+        return skip_rows(csv_reader(file),
+                         jump_to_index=jump_to_index,
+                         jump_to_user=jump_to_user)
+    index = CsvIndex.open(file)
+    try:
+        if jump_to_user:
+            found = index.find_key(jump_to_user)
+            if found is None:
+                raise ExitException(f"User '{jump_to_user}' not found in "
+                                    f"{file}.")
+            start_index, offset = found
+        else:
+            start_index = jump_to_index
+            offset = index.find_row(jump_to_index)
+            if offset is None:
+                raise ExitException(f"Cannot jump to index {jump_to_index}, "
+                                    f"file has only {len(index)} rows.")
+    finally:
+        index.close()
+    return start_index, index.rows_from(offset)
@@ -0,0 +1,139 @@
+import random
+import time
+
+import requests
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+
+
+# error classes, each with its own retry budget
+THROTTLED = "throttled"
+SERVER = "server"
+CONNECTION = "connection"
+TIMEOUT = "timeout"
+
+
+def _request_not_sent(exc):
+    """
+    :return: True if the exception proves the request never reached the
+             server (so even a non-idempotent request can be repeated)
+    """
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    if not isinstance(exc, requests.ConnectionError) or not exc.args:
+        return False
+    reason = getattr(exc.args[0], "reason", exc.args[0])
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class RetryPolicy:
+    """
+    Decides if and when a failed Okta request is repeated.
+
+    Failures are sorted into classes, and every class has its own budget
+    (number of retries per request, None for unlimited):
+
+    * throttled: HTTP 429, we wait for X-Rate-Limit-Reset
+    * server: HTTP 502, 503 and 504 (honoring Retry-After)
+    * connection: connection refused, reset etc.
+    * timeout: read timeouts
+
+    Other errors are not retried. Delays grow exponentially with jitter,
+    so parallel workers don't hammer the API in lockstep.
+
+    Non-idempotent requests (POST and DELETE unless marked otherwise) are
+    only repeated if the server certainly did not process them: after a
+    429, or if the connection could not even be established.
+    """
+
+    budgets = {
+        THROTTLED:  None,
+        SERVER:     4,
+        CONNECTION: 3,
+        TIMEOUT:    2,
+    }
+    retry_statuses = (502, 503, 504)
+    base_delay = 0.5
+    max_delay = 30.0
+
+    def __init__(self, *, base_delay=None, max_delay=None, **budgets):
+        """
+        :param base_delay: The delay before the first retry (seconds), it
+                           doubles with every further retry
+        :param max_delay: The maximum delay (seconds)
+        :param budgets: Retry budgets by error class, e.g. server=10
+        """
+        unknown = set(budgets) - set(self.budgets)
+        if unknown:
+            raise ValueError(f"Unknown retry error classes: "
+                             f"{', '.join(sorted(unknown))}")
+        self.budgets = dict(self.budgets, **budgets)
+        if base_delay is not None:
+            self.base_delay = base_delay
+        if max_delay is not None:
+            self.max_delay = max_delay
+
+    def classify(self, *, rsp=None, exc=None):
+        """
+        :param rsp: A response
+        :param exc: An exception raised instead of a response
+        :return: The error class, or None if this is not to be retried
+        """
+        if exc is not None:
+            if isinstance(exc, requests.ConnectTimeout):
+                return CONNECTION
+            if isinstance(exc, requests.Timeout):
+                return TIMEOUT
+            if isinstance(exc, requests.ConnectionError):
+                return CONNECTION
+            return None
+        if rsp.status_code == 429:
+            return THROTTLED
+        if rsp.status_code in self.retry_statuses:
+            return SERVER
+        return None
+
+    def _backoff(self, attempt):
+        # "equal jitter": half of the delay is fixed, half random
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _server_delay(self, rsp, header, absolute):
+        try:
+            value = int(rsp.headers[header])
+        except (KeyError, ValueError, TypeError):
+            return None
+        delay = value - time.time() if absolute else value
+        # spread the workers waiting for the same moment a little
+        return max(1, delay) + random.uniform(0, 1)
+
+    def next_delay(self, attempts, *, idempotent=True, rsp=None, exc=None):
+        """
+        Checks if a failed request is to be retried, and counts the retry.
+
+        :param attempts: A dict error class -> retries so far, for one
+                         request; updated in place
+        :param idempotent: False if repeating the request could do harm
+        :param rsp: The response, if there is one
+        :param exc: The exception, if the request failed without response
+        :return: The number of seconds to wait before retrying, or None if
+                 the request must not be retried
+        """
+        error = self.classify(rsp=rsp, exc=exc)
+        if error is None:
+            return None
+        if not idempotent and error != THROTTLED and \
+                not _request_not_sent(exc):
+            return None
+        count = attempts.get(error, 0)
+        budget = self.budgets[error]
+        if budget is not None and count >= budget:
+            return None
+        attempts[error] = count + 1
+        delay = None
+        if error == THROTTLED:
+            delay = self._server_delay(rsp, "X-Rate-Limit-Reset", True)
+        elif rsp is not None:
+            delay = self._server_delay(rsp, "Retry-After", False)
+        if delay is None:
+            delay = self._backoff(count)
+        return min(delay, self.max_delay) if error != THROTTLED else delay
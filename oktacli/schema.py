@@ -0,0 +1,197 @@
+import collections
+import json
+import re
+
+
+FieldSpec = collections.namedtuple(
+        "FieldSpec",
+        "name type required enum min_length max_length pattern "
+        "item_type item_enum read_only")
+
+
+TRUE_VALUES = ("true", "yes", "y", "1", "on")
+FALSE_VALUES = ("false", "no", "n", "0", "off")
+
+
+def _enum_of(definition):
+    # okta uses either "enum": [...] or "oneOf": [{"const": ...}, ...]
+    if "enum" in definition:
+        return frozenset(definition["enum"])
+    if "oneOf" in definition:
+        return frozenset(x["const"] for x in definition["oneOf"]
+                         if "const" in x)
+    return None
+
+
+def compile_schema(schema, prefix="profile."):
+    """
+    Converts an Okta user schema (as returned by Okta.get_profile_schema())
+    into a dict of field specifications which can be used with
+    validate_row().
+
+    The result only contains plain data, so it can be sent to worker
+    processes.
+
+    :param schema: The user schema
+    :param prefix: The prefix of the flat field names
+    :return: A dict {"profile.FIELD": FieldSpec}
+    """
+    rv = {}
+    for definition in schema.get("definitions", {}).values():
+        required = set(definition.get("required", []))
+        for name, prop in definition.get("properties", {}).items():
+            items = prop.get("items", {})
+            pattern = prop.get("pattern")
+            rv[prefix + name] = FieldSpec(
+                    name=prefix + name,
+                    type=prop.get("type", "string"),
+                    required=prop.get("required", False) or name in required,
+                    enum=_enum_of(prop),
+                    min_length=prop.get("minLength"),
+                    max_length=prop.get("maxLength"),
+                    pattern=re.compile(pattern) if pattern else None,
+                    item_type=items.get("type", "string"),
+                    item_enum=_enum_of(items),
+                    read_only=prop.get("mutability") == "READ_ONLY",
+            )
+    return rv
+
+
+def _is_empty(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _coerce_string(value):
+    if isinstance(value, float) and value.is_integer():
+        # Excel likes to turn "12345" into 12345.0
+        value = int(value)
+    return value if isinstance(value, str) else str(value)
+
+
+def _coerce_integer(value):
+    if isinstance(value, bool):
+        raise ValueError("is not an integer")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError("is not an integer")
+        return int(value)
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        raise ValueError("is not an integer")
+
+
+def _coerce_number(value):
+    if isinstance(value, bool):
+        raise ValueError("is not a number")
+    try:
+        return float(str(value).strip()) \
+            if not isinstance(value, (int, float)) else value
+    except ValueError:
+        raise ValueError("is not a number")
+
+
+def _coerce_boolean(value):
+    if isinstance(value, bool):
+        return value
+    check = str(value).strip().lower()
+    if check in TRUE_VALUES:
+        return True
+    if check in FALSE_VALUES:
+        return False
+    raise ValueError("is not a boolean")
+
+
+COERCERS = {
+    "string":  _coerce_string,
+    "integer": _coerce_integer,
+    "number":  _coerce_number,
+    "boolean": _coerce_boolean,
+}
+
+
+def _check_string(spec, value):
+    if spec.min_length is not None and len(value) < spec.min_length:
+        raise ValueError(f"is shorter than {spec.min_length} characters")
+    if spec.max_length is not None and len(value) > spec.max_length:
+        raise ValueError(f"is longer than {spec.max_length} characters")
+    if spec.pattern is not None and not spec.pattern.fullmatch(value):
+        raise ValueError(f"does not match '{spec.pattern.pattern}'")
+
+
+def _coerce_array(spec, value):
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith("["):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise ValueError("is not a valid JSON array")
+        else:
+            value = [x.strip() for x in value.split(",")]
+    elif not isinstance(value, (list, tuple)):
+        value = [value]
+    coerce = COERCERS.get(spec.item_type, _coerce_string)
+    rv = [coerce(x) for x in value]
+    if spec.item_enum is not None:
+        invalid = [x for x in rv if x not in spec.item_enum]
+        if invalid:
+            raise ValueError(f"contains invalid values {invalid}")
+    return rv
+
+
+def coerce_value(spec, value):
+    """
+    Checks a value against a field specification and converts it to the
+    type Okta expects (e.g. "true" -> True for boolean fields).
+
+    :param spec: The FieldSpec
+    :param value: The value, usually a string from a CSV file
+    :return: The converted value. Empty values become None (which clears
+             the field), except for string fields.
+    :raises ValueError: If the value is invalid
+    """
+    if spec.read_only:
+        raise ValueError("is read-only")
+    if _is_empty(value):
+        if spec.required:
+            raise ValueError("is required")
+        return value if spec.type == "string" and value is not None \
+            else None
+    if spec.type == "array":
+        return _coerce_array(spec, value)
+    rv = COERCERS.get(spec.type, lambda x: x)(value)
+    if spec.type == "string":
+        _check_string(spec, rv)
+    if spec.enum is not None and rv not in spec.enum:
+        raise ValueError(f"is not one of {sorted(spec.enum)}")
+    return rv
+
+
+def validate_row(specs, row, prefix="profile."):
+    """
+    Validates and converts the profile fields of a flat row dict.
+
+    Fields which do not start with the prefix (e.g. "credentials.") are
+    not checked.
+
+    :param specs: The field specifications from compile_schema()
+    :param row: A dict with flat (dotted) keys
+    :param prefix: Only check fields starting with this
+    :return: A tuple (converted row, list of error messages)
+    """
+    rv = {}
+    errors = []
+    for key, value in row.items():
+        if not key.startswith(prefix):
+            rv[key] = value
+            continue
+        spec = specs.get(key)
+        if spec is None:
+            errors.append(f"{key}: unknown field")
+            continue
+        try:
+            rv[key] = coerce_value(spec, value)
+        except ValueError as e:
+            errors.append(f"{key}: {value!r} {e}")
+    return rv, errors
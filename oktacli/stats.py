@@ -0,0 +1,297 @@
+import bisect
+import json
+import math
+import threading
+
+
+# the buckets of the latency histograms grow by this factor, so
+# percentiles are exact to about +-2.5%
+BUCKET_FACTOR = 1.05
+MIN_LATENCY = 0.001
+
+# the (cumulative) buckets in the Prometheus export
+PROMETHEUS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                      60)
+
+
+class LatencyHistogram:
+    """
+    A histogram of latencies with logarithmic buckets. It needs little
+    memory however many values are added, and still gives good
+    percentiles. Additionally the values are counted exactly for the
+    (coarse) Prometheus buckets.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.prometheus = [0] * (len(PROMETHEUS_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _bucket(value):
+        if value <= MIN_LATENCY:
+            return 0
+        return int(math.log(value / MIN_LATENCY, BUCKET_FACTOR)) + 1
+
+    @staticmethod
+    def _upper_bound(bucket):
+        return MIN_LATENCY * BUCKET_FACTOR ** bucket
+
+    def add(self, value):
+        bucket = self._bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.prometheus[bisect.bisect_left(PROMETHEUS_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        :param p: The percentile, e.g. 95
+        :return: The latency p percent of the values are below (seconds),
+                 None if there are no values
+        """
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * p / 100)
+        if rank >= self.count:
+            return self.max
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # the middle of the bucket, but never more than the maximum
+                lower = self._upper_bound(bucket - 1) if bucket else 0
+                return min(self.max, (lower + self._upper_bound(bucket)) / 2)
+        return self.max
+
+    def merge(self, other):
+        for bucket, num in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + num
+        self.prometheus = [a + b for a, b in zip(self.prometheus,
+                                                 other.prometheus)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def cumulative(self):
+        """
+        :return: A list of (bound, number of values <= bound) for the
+                 Prometheus buckets
+        """
+        rv = []
+        total = 0
+        for bound, num in zip(PROMETHEUS_BUCKETS, self.prometheus):
+            total += num
+            rv.append((bound, total))
+        return rv
+
+
+class EndpointStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = LatencyHistogram()
+
+    def as_dict(self):
+        return {
+            "requests":       self.requests,
+            "errors":         self.errors,
+            "throttled":      self.throttled,
+            "retries":        self.retries,
+            "bytes_sent":     self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "latency": {
+                "sum": round(self.latency.sum, 6),
+                "max": round(self.latency.max, 6),
+                "p50": self.latency.percentile(50),
+                "p95": self.latency.percentile(95),
+                "p99": self.latency.percentile(99),
+            },
+        }
+
+
+class ClientStats:
+    """
+    Performance counters of an Okta client, by endpoint (see
+    Okta.endpoint_of()): requests, errors, 429 responses, retries, bytes
+    and a latency histogram. Additionally the time spent sleeping for rate
+    limits and retries, and the requests saved by the cache and by merging
+    identical requests.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.throttle_sleep = 0.0
+        self.backoff_sleep = 0.0
+        self.cache_hits = 0
+        self.not_modified = 0
+        self.merged = 0
+        self._lock = threading.Lock()
+
+    def _endpoint(self, endpoint):
+        rv = self.endpoints.get(endpoint)
+        if rv is None:
+            rv = self.endpoints[endpoint] = EndpointStats()
+        return rv
+
+    def record(self, endpoint, latency, *, rsp=None, sent=0):
+        """
+        Records one HTTP request.
+
+        :param endpoint: The endpoint
+        :param latency: The time until the response was read (seconds)
+        :param rsp: The response, None if the request failed without one
+        :param sent: The size of the request body
+        """
+        received = len(rsp.content) if rsp is not None else 0
+        with self._lock:
+            stats = self._endpoint(endpoint)
+            stats.requests += 1
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            stats.latency.add(latency)
+            if rsp is None or rsp.status_code >= 400:
+                stats.errors += 1
+            if rsp is not None and rsp.status_code == 429:
+                stats.throttled += 1
+            if rsp is not None and rsp.status_code == 304:
+                self.not_modified += 1
+
+    def record_retry(self, endpoint):
+        with self._lock:
+            self._endpoint(endpoint).retries += 1
+
+    def record_sleep(self, seconds, *, throttle):
+        """
+        :param throttle: True for rate limit waits, False for retry backoff
+        """
+        with self._lock:
+            if throttle:
+                self.throttle_sleep += seconds
+            else:
+                self.backoff_sleep += seconds
+
+    def record_cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def record_merged(self):
+        with self._lock:
+            self.merged += 1
+
+    def totals(self):
+        rv = EndpointStats()
+        with self._lock:
+            for stats in self.endpoints.values():
+                for key in ("requests", "errors", "throttled", "retries",
+                            "bytes_sent", "bytes_received"):
+                    setattr(rv, key, getattr(rv, key) + getattr(stats, key))
+                rv.latency.merge(stats.latency)
+        return rv
+
+    def as_dict(self):
+        with self._lock:
+            endpoints = {k: v.as_dict()
+                         for k, v in sorted(self.endpoints.items())}
+        return {
+            "endpoints":      endpoints,
+            "total":          self.totals().as_dict(),
+            "throttle_sleep": round(self.throttle_sleep, 3),
+            "backoff_sleep":  round(self.backoff_sleep, 3),
+            "cache_hits":     self.cache_hits,
+            "not_modified":   self.not_modified,
+            "merged":         self.merged,
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix="okta_cli"):
+        """
+        :return: The counters in the Prometheus text format (e.g. for the
+                 node_exporter textfile collector)
+        """
+        counters = (
+            ("requests", "requests_total", "HTTP requests"),
+            ("errors", "request_errors_total",
+             "Failed requests (status >= 400 or no response)"),
+            ("throttled", "throttled_total", "HTTP 429 responses"),
+            ("retries", "retries_total", "Repeated requests"),
+            ("bytes_sent", "sent_bytes_total", "Request body bytes"),
+            ("bytes_received", "received_bytes_total",
+             "Response body bytes"),
+        )
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+        lines = []
+        for attr, name, help_text in counters:
+            lines += [f"# HELP {prefix}_{name} {help_text}",
+                      f"# TYPE {prefix}_{name} counter"]
+            for endpoint, stats in endpoints:
+                lines.append(f'{prefix}_{name}{{endpoint="{endpoint}"}} '
+                             f'{getattr(stats, attr)}')
+        name = f"{prefix}_request_duration_seconds"
+        lines += [f"# HELP {name} Request latency",
+                  f"# TYPE {name} histogram"]
+        for endpoint, stats in endpoints:
+            for bound, num in stats.latency.cumulative():
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",'
+                             f'le="{bound}"}} {num}')
+            lines += [f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} '
+                      f'{stats.latency.count}',
+                      f'{name}_sum{{endpoint="{endpoint}"}} '
+                      f'{stats.latency.sum:.6f}',
+                      f'{name}_count{{endpoint="{endpoint}"}} '
+                      f'{stats.latency.count}']
+        for attr, help_text in (
+                ("throttle_sleep", "Seconds slept waiting for rate limits"),
+                ("backoff_sleep", "Seconds slept before retries")):
+            lines += [f"# HELP {prefix}_{attr}_seconds_total {help_text}",
+                      f"# TYPE {prefix}_{attr}_seconds_total counter",
+                      f"{prefix}_{attr}_seconds_total "
+                      f"{getattr(self, attr):.3f}"]
+        for attr, help_text in (
+                ("cache_hits", "Requests answered by the response cache"),
+                ("not_modified", "HTTP 304 responses"),
+                ("merged", "Requests merged into identical requests")):
+            lines += [f"# HELP {prefix}_{attr}_total {help_text}",
+                      f"# TYPE {prefix}_{attr}_total counter",
+                      f"{prefix}_{attr}_total {getattr(self, attr)}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        :return: A human readable table
+        """
+        def ms(value):
+            return f"{value * 1000:.0f}" if value is not None else "-"
+
+        header = ("endpoint", "reqs", "errs", "429", "retry",
+                  "p50ms", "p95ms", "p99ms", "KiB in")
+        rows = []
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+        for endpoint, stats in endpoints + [("TOTAL", self.totals())]:
+            lat = stats.latency
+            rows.append((endpoint, stats.requests, stats.errors,
+                         stats.throttled, stats.retries,
+                         ms(lat.percentile(50)), ms(lat.percentile(95)),
+                         ms(lat.percentile(99)),
+                         f"{stats.bytes_received / 1024:.1f}"))
+        width = max(len(str(r[0])) for r in rows + [header])
+        fmt = f"{{:<{width}}}" + " {:>6}" * 4 + " {:>7}" * 3 + " {:>9}"
+        lines = [fmt.format(*header)] + [fmt.format(*r) for r in rows]
+        lines.append(f"slept {self.throttle_sleep:.1f}s for rate limits, "
+                     f"{self.backoff_sleep:.1f}s before retries; "
+                     f"{self.cache_hits} cache hits, "
+                     f"{self.not_modified} not modified, "
+                     f"{self.merged} merged")
+        return "\n".join(lines)
@@ -0,0 +1,358 @@
+import bisect
+import json
+import re
+import threading
+import time
+from urllib.parse import urlsplit, parse_qsl
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .exceptions import ExitException
+
+
+# query parameters whose values never go into a trace
+SECRET_PARAMS = re.compile(r"token|password|secret|key|assertion", re.I)
+
+# connection setup timings of the current thread, set by the connection
+# classes below and picked up by Tracer.request()
+_local = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+
+    def _new_conn(self):
+        # name resolution and TCP connect
+        start = time.monotonic()
+        try:
+            return super()._new_conn()
+        finally:
+            _local.connect = time.monotonic() - start
+
+    def connect(self):
+        start = time.monotonic()
+        _local.connect = 0.0
+        super().connect()
+        # whatever connect() did besides _new_conn() is the TLS handshake
+        total = time.monotonic() - start
+        _local.tls = max(0.0, total - _local.connect) \
+            if isinstance(self, HTTPSConnection) else 0.0
+
+
+class _TimedHTTPSConnection(_TimedHTTPConnection, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimingAdapter(HTTPAdapter):
+    """
+    A transport adapter which measures the setup time (connect, TLS) of
+    new connections.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+def take_connection_timings():
+    """
+    :return: A tuple (connect, tls) in seconds for the connection opened
+             by the last request of this thread, (None, None) if the
+             request re-used a connection
+    """
+    rv = (getattr(_local, "connect", None), getattr(_local, "tls", None))
+    _local.connect = _local.tls = None
+    return rv
+
+
+def redact_params(params):
+    return {k: "REDACTED" if SECRET_PARAMS.search(k) else v
+            for k, v in (params or {}).items()}
+
+
+class Tracer:
+    """
+    Writes every HTTP request of an Okta client (and every sleep) as one
+    JSON line. Headers (i.e. the API token) and bodies are never written,
+    only their sizes, and secret-looking query parameters are redacted.
+
+    A request record looks like this:
+
+        {"type": "request", "seq": 12, "thread": 139872, "start": 1.2e9,
+         "method": "GET", "endpoint": "/users/{id}/groups", "path": "...",
+         "params": {...}, "status": 200, "attempt": 1, "page": 2,
+         "chain": 11, "timings": {"connect": null, "tls": null,
+         "ttfb": 0.21, "total": 0.23}, "sent": 0, "received": 5120,
+         "rate_remaining": 580, "rate_limit": 600, "error": null}
+
+    "connect" (name resolution and TCP connect) and "tls" are null if a
+    pooled connection was re-used. "chain" is the seq of the first page of
+    a paginated listing.
+    """
+
+    def __init__(self, file):
+        self.out = open(file, "w", encoding="utf-8")
+        self.seq = 0
+        self._lock = threading.Lock()
+        self._chains = threading.local()
+
+    def install(self, session):
+        adapter = TimingAdapter()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def _write(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            self.out.write(line + "\n")
+
+    def _next_seq(self):
+        with self._lock:
+            self.seq += 1
+            return self.seq
+
+    def request(self, *, method, endpoint, path, params, start, total,
+                page=None, attempt=1, sent=0, rsp=None, error=None):
+        """
+        Records one HTTP request.
+
+        :param start: The start time (time.time())
+        :param total: The duration in seconds
+        :param page: The page number in a paginated listing
+        """
+        seq = self._next_seq()
+        url = urlsplit(path)
+        # "next" links carry their parameters in the URL
+        params = dict(parse_qsl(url.query), **(params or {}))
+        if not page or page == 1:
+            self._chains.current = seq
+        connect, tls = take_connection_timings()
+
+        def header(name):
+            try:
+                return int(rsp.headers[name])
+            except (AttributeError, KeyError, ValueError, TypeError):
+                return None
+
+        self._write({
+            "type": "request",
+            "seq": seq,
+            "thread": threading.get_ident(),
+            "start": round(start, 6),
+            "method": method.upper(),
+            "endpoint": endpoint,
+            "path": url.path,
+            "params": redact_params(params),
+            "status": rsp.status_code if rsp is not None else None,
+            "attempt": attempt,
+            "page": page,
+            "chain": getattr(self._chains, "current", seq) if page
+            else None,
+            "timings": {
+                "connect": connect,
+                "tls": tls,
+                "ttfb": rsp.elapsed.total_seconds()
+                if rsp is not None else None,
+                "total": round(total, 6),
+            },
+            "sent": sent,
+            "received": len(rsp.content) if rsp is not None else 0,
+            "rate_remaining": header("X-Rate-Limit-Remaining"),
+            "rate_limit": header("X-Rate-Limit-Limit"),
+            "error": type(error).__name__ if error is not None else None,
+        })
+
+    def sleep(self, start, duration, *, throttle):
+        self._write({
+            "type": "sleep",
+            "thread": threading.get_ident(),
+            "start": round(start, 6),
+            "duration": round(duration, 6),
+            "reason": "throttle" if throttle else "backoff",
+        })
+
+    def close(self):
+        with self._lock:
+            self.out.close()
+
+
+def read_trace(file):
+    """
+    :return: A tuple (list of request records, list of sleep records)
+    """
+    requests, sleeps = [], []
+    try:
+        with open(file, "r", encoding="utf-8") as infile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("type") == "sleep":
+                    sleeps.append(record)
+                else:
+                    requests.append(record)
+    except (OSError, ValueError) as e:
+        raise ExitException(f"Cannot read trace file {file}: {e}")
+    return requests, sleeps
+
+
+def concurrency_timeline(requests, interval=1.0):
+    """
+    Reconstructs how many requests were running over time.
+
+    :param requests: Request records
+    :param interval: The length of a time slot (seconds)
+    :return: A list of dicts {"t": slot start (seconds from the first
+             request), "started": requests started in the slot,
+             "avg": average number of running requests, "max": maximum}
+    """
+    if not requests:
+        return []
+    t0 = min(r["start"] for r in requests)
+    end = max(r["start"] + r["timings"]["total"] for r in requests)
+    num_slots = int((end - t0) / interval) + 1
+    busy = [0.0] * num_slots
+    started = [0] * num_slots
+    events = []
+    for r in requests:
+        begin = r["start"] - t0
+        finish = begin + r["timings"]["total"]
+        started[int(begin / interval)] += 1
+        events += [(begin, 1), (finish, -1)]
+        # add the running time to all slots the request touches
+        slot = int(begin / interval)
+        while begin < finish:
+            slot_end = (slot + 1) * interval
+            busy[slot] += min(finish, slot_end) - begin
+            begin = slot_end
+            slot += 1
+    # at the same time, ends (-1) sort before starts (+1)
+    events.sort()
+    peak = [0] * num_slots
+    running = 0
+    idx = 0
+    for slot in range(num_slots):
+        peak[slot] = running
+        slot_end = (slot + 1) * interval
+        while idx < len(events) and events[idx][0] < slot_end:
+            running += events[idx][1]
+            peak[slot] = max(peak[slot], running)
+            idx += 1
+    return [{"t": round(slot * interval, 3),
+             "started": started[slot],
+             "avg": round(busy[slot] / interval, 2),
+             "max": peak[slot]}
+            for slot in range(num_slots)]
+
+
+def critical_path(requests):
+    """
+    Finds the chain of requests which determined the total run time:
+    starting with the request which ended last, the predecessor of a
+    request is the previous page of the same listing, or else the request
+    which ended last before it started. Gaps between them are time spent
+    in the client (sleeping, processing, waiting for a free worker).
+
+    :param requests: Request records
+    :return: A list of (request record, gap before it in seconds), in
+             chronological order
+    """
+    if not requests:
+        return []
+
+    def end(r):
+        return r["start"] + r["timings"]["total"]
+
+    by_seq = {r["seq"]: r for r in requests}
+    by_end = sorted(requests, key=end)
+    pages = {}
+    for r in requests:
+        if r.get("chain") is not None:
+            pages.setdefault(r["chain"], []).append(r)
+    previous_page = {}
+    for chain in pages.values():
+        chain.sort(key=lambda x: x["seq"])
+        for a, b in zip(chain, chain[1:]):
+            previous_page[b["seq"]] = a
+    ends = [end(r) for r in by_end]
+
+    rv = []
+    current = by_end[-1]
+    while current is not None:
+        pred = previous_page.get(current["seq"])
+        if pred is None:
+            # the last request which was done before this one started
+            idx = bisect.bisect_right(ends, current["start"]) - 1
+            pred = by_end[idx] if idx >= 0 else None
+        gap = current["start"] - end(pred) if pred is not None else 0.0
+        rv.append((current, max(0.0, gap)))
+        current = by_seq.get(pred["seq"]) if pred is not None else None
+    rv.reverse()
+    return rv
+
+
+def analyze(requests, sleeps, *, interval=1.0):
+    """
+    :return: A human readable report of a trace
+    """
+    if not requests:
+        return "No requests in trace."
+    t0 = min(r["start"] for r in requests)
+    wall = max(r["start"] + r["timings"]["total"] for r in requests) - t0
+    busy = sum(r["timings"]["total"] for r in requests)
+    statuses = {}
+    for r in requests:
+        statuses[r["status"] or r["error"]] = \
+            statuses.get(r["status"] or r["error"], 0) + 1
+    throttle = sum(s["duration"] for s in sleeps if s["reason"] == "throttle")
+    backoff = sum(s["duration"] for s in sleeps if s["reason"] == "backoff")
+    new_conns = [r["timings"] for r in requests
+                 if r["timings"]["connect"] is not None]
+    setup = sum(x["connect"] + (x["tls"] or 0) for x in new_conns)
+    lines = [
+        f"requests:          {len(requests)} in {wall:.2f}s "
+        f"({len(requests) / wall if wall else 0:.1f}/s)",
+        "status codes:      " + ", ".join(
+            f"{k}: {v}" for k, v in sorted(statuses.items(),
+                                           key=lambda x: str(x[0]))),
+        f"avg. concurrency:  {busy / wall if wall else 0:.2f}",
+        f"new connections:   {len(new_conns)}, setup time {setup:.2f}s",
+        f"slept:             {throttle:.2f}s for rate limits, "
+        f"{backoff:.2f}s before retries (summed over threads)",
+        "",
+        "concurrency over time:",
+        f"{'t[s]':>8} {'started':>8} {'avg':>6} {'max':>5}",
+    ]
+    for slot in concurrency_timeline(requests, interval):
+        lines.append(f"{slot['t']:>8} {slot['started']:>8} "
+                     f"{slot['avg']:>6} {slot['max']:>5}")
+    path = critical_path(requests)
+    per_endpoint = {}
+    gaps = 0.0
+    for r, gap in path:
+        gaps += gap
+        ep = f"{r['method']} {r['endpoint']}"
+        num, secs = per_endpoint.get(ep, (0, 0.0))
+        per_endpoint[ep] = (num + 1, secs + r["timings"]["total"])
+    lines += [
+        "",
+        f"critical path:     {len(path)} requests, "
+        f"{sum(x[1] for x in per_endpoint.values()):.2f}s in requests, "
+        f"{gaps:.2f}s between requests",
+    ]
+    for ep, (num, secs) in sorted(per_endpoint.items(),
+                                  key=lambda x: -x[1][1]):
+        lines.append(f"  {secs:>8.2f}s {num:>6}x  {ep}")
+    return "\n".join(lines)
@@ -24,11 +24,12 @@ AUTHOR = 'Axel Bock'
 REQUIRES_PYTHON = '>=3.5.0'
 
 REQUIRED = [
-    "appdirs", "click", "dotted", "requests", "openpyxl", "pony",
+    "appdirs", "click", "dotted", "requests", "openpyxl",
 ]
 
 EXTRAS = {
-    # 'fancy feature': ['django'],
+    # column-wise filtering ('users list --columnar')
+    'fast': ['numpy'],
 }
 
 # The rest you shouldn't have to touch too much :)
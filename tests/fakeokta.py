@@ -0,0 +1,549 @@
+"""
+A stand-in for the Okta API on a local port, for tests which need a real
+HTTP connection (retries, timeouts, dropped connections) and for the
+benchmarks in tools/.
+
+It serves a synthetic org of configurable size - users, groups,
+memberships and apps - with Okta-like pagination ("limit", "after" and a
+"Link" header), X-Rate-Limit-* headers and 429 responses if a rate limit
+is set, and a configurable latency.
+
+Faults are queued per method and path pattern and used up one by one:
+
+    with FakeOkta() as fake:
+        fake.fail("GET", r"/users/.*", 503, "reset", 502)
+        okta = Okta(fake.url, "token")
+        ...
+        assert fake.count("GET", r"/users/.*") == 4
+
+A bigger org:
+
+    with FakeOkta(users=10000, groups=50, apps=10, groups_per_user=3,
+                  apps_per_user=2, latency=0.02, rate_limit=600) as fake:
+        ...
+"""
+import hashlib
+import json
+import math
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, urlencode, unquote
+
+from .testdata import okta_user_schema
+
+
+DEPARTMENTS = ("IT", "Sales", "Marketing", "Finance", "HR", "Support")
+TITLES = ("Engineer", "Manager", "Intern", "Consultant", "Director")
+
+# a small subset of Okta's filter and search syntax
+CLAUSE = re.compile(r'([\w.]+)\s+(eq|sw|co)\s+"((?:[^"\\]|\\.)*)"')
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients which gave up (timeouts) are expected here
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode("utf-8") \
+            if status not in (204, 304) else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        if path.startswith("/api/v1"):
+            path = path[len("/api/v1"):]
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        fake.record(self.command, path, body, self.headers)
+        if fake.latency:
+            time.sleep(fake.latency)
+        fault = fake.next_fault(self.command, path)
+        if fault == "reset":
+            # drop the connection without an answer
+            self.close_connection = True
+            return
+        if isinstance(fault, tuple) and fault[0] == "delay":
+            time.sleep(fault[1])
+        elif isinstance(fault, int):
+            headers = {}
+            if fault == 429:
+                headers["X-Rate-Limit-Reset"] = int(time.time())
+            self._send(fault, {"errorCode": "E0000009",
+                               "errorSummary": f"Injected {fault}"},
+                       headers)
+            return
+        allowed, headers = fake.count_rate_limit(self.command, path)
+        if not allowed:
+            self._send(429, {"errorCode": "E0000047",
+                             "errorSummary": "API call exceeded rate limit "
+                                             "due to too many requests."},
+                       headers)
+            return
+        status, rv, more_headers = fake.route(self.command, path, body,
+                                              dict(parse_qsl(url.query)))
+        headers.update(more_headers)
+        if fake.etags and self.command == "GET" and status == 200:
+            etag = '"%s"' % hashlib.md5(
+                    json.dumps(rv, sort_keys=True).encode()).hexdigest()
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                status = 304
+        self._send(status, rv, headers)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+def _not_found(what):
+    return 404, {"errorCode": "E0000007",
+                 "errorSummary": f"Not found: {what}"}, {}
+
+
+def _get_dotted(obj, path):
+    for key in path.split("."):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def _matcher(expr):
+    """
+    :return: A function object -> bool for a simple filter or search
+             expression like 'status eq "ACTIVE" and profile.login sw "a"'
+             (no parentheses, "or" binds weaker than "and")
+    """
+    alternatives = []
+    for alternative in re.split(r"\s+or\s+", expr):
+        clauses = [CLAUSE.search(x)
+                   for x in re.split(r"\s+and\s+", alternative)]
+        alternatives.append([x.groups() for x in clauses if x])
+
+    def check(obj, path, op, value):
+        have = _get_dotted(obj, path)
+        have = str(have) if have is not None else ""
+        if op == "eq":
+            return have == value
+        if op == "sw":
+            return have.startswith(value)
+        return value in have
+
+    return lambda obj: any(all(check(obj, *c) for c in clauses)
+                           for clauses in alternatives)
+
+
+class FakeOkta:
+    """
+    The stand-in server. The users of the org are in .users, the groups in
+    .groups and the apps in .apps (dicts by ID), the memberships in
+    .group_users and .app_users (group or app ID -> dict of user IDs).
+
+    Supported are listing (with simple filter and search expressions),
+    getting, creating, updating and deleting users including lifecycle
+    operations and the user's groups; listing, creating and deleting
+    groups and their members; listing apps and their users; and the user
+    schema. GET responses have an ETag (unless .etags is set to False) and
+    If-None-Match is answered with 304.
+    """
+
+    # default and maximum "limit" by kind of listing
+    page_sizes = {
+        "users":   (200, 200),
+        "groups":  (10000, 10000),
+        "apps":    (20, 200),
+        "members": (1000, 1000),
+    }
+
+    LIFECYCLE = {
+        "activate":        "ACTIVE",
+        "deactivate":      "DEPROVISIONED",
+        "suspend":         "SUSPENDED",
+        "unsuspend":       "ACTIVE",
+        "unlock":          "ACTIVE",
+        "expire_password": "PASSWORD_EXPIRED",
+        "reset_password":  "RECOVERY",
+    }
+
+    def __init__(self, users=3, groups=0, apps=0, *, groups_per_user=0,
+                 apps_per_user=0, latency=0.0, rate_limit=None,
+                 rate_window=60, seed=0):
+        """
+        :param users: The number of users
+        :param groups: The number of groups
+        :param apps: The number of apps
+        :param groups_per_user: Every user is in this many random groups
+        :param apps_per_user: Every user is assigned to this many random
+                              apps
+        :param latency: Seconds to wait before answering a request
+        :param rate_limit: Requests per endpoint and rate window, None for
+                           no limit
+        :param rate_window: The length of a rate limit window (seconds)
+        :param seed: The seed for the random memberships
+        """
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.etags = True
+        self.requests = []
+        # the request headers, same order as .requests
+        self.headers = []
+        self._faults = []
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._generate(users, groups, apps, groups_per_user, apps_per_user,
+                       random.Random(seed))
+        routes = (
+            ("GET", r"/users", self._list_users),
+            ("POST", r"/users", self._create_user),
+            ("GET", r"/users/([^/]+)", self._get_user),
+            ("POST", r"/users/([^/]+)", self._update_user),
+            ("DELETE", r"/users/([^/]+)", self._delete_user),
+            ("GET", r"/users/([^/]+)/groups", self._user_groups),
+            ("POST", r"/users/([^/]+)/lifecycle/(\w+)", self._lifecycle),
+            ("GET", r"/groups", self._list_groups),
+            ("POST", r"/groups", self._create_group),
+            ("GET", r"/groups/([^/]+)", self._get_group),
+            ("DELETE", r"/groups/([^/]+)", self._delete_group),
+            ("GET", r"/groups/([^/]+)/users", self._group_users),
+            ("PUT", r"/groups/([^/]+)/users/([^/]+)", self._add_member),
+            ("DELETE", r"/groups/([^/]+)/users/([^/]+)",
+             self._remove_member),
+            ("GET", r"/apps", self._list_apps),
+            ("GET", r"/apps/([^/]+)", self._get_app),
+            ("DELETE", r"/apps/([^/]+)", self._delete_app),
+            ("GET", r"/apps/([^/]+)/users", self._app_users),
+            ("GET", r"/meta/schemas/user/default", self._schema),
+        )
+        self._routes = [(m, p, re.compile(p), f) for m, p, f in routes]
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.server.fake = self
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+
+    def _generate(self, num_users, num_groups, num_apps, groups_per_user,
+                  apps_per_user, rnd):
+        self.users = {}
+        self.logins = {}
+        for i in range(num_users):
+            self._add_user(f"00u{i:017d}", {
+                "login":      f"user{i}@example.com",
+                "email":      f"user{i}@example.com",
+                "firstName":  f"First{i}",
+                "lastName":   f"Last{i}",
+                "department": DEPARTMENTS[i % len(DEPARTMENTS)],
+                "title":      TITLES[i % len(TITLES)],
+            })
+        self.groups = {}
+        self.group_users = {}
+        for i in range(num_groups):
+            self._add_group(f"00g{i:017d}",
+                            {"name": f"Group {i}", "description": None})
+        self.apps = {}
+        self.app_users = {}
+        for i in range(num_apps):
+            app_id = f"0oa{i:017d}"
+            self.apps[app_id] = {"id": app_id, "name": "bookmark",
+                                 "label": f"App {i}", "status": "ACTIVE",
+                                 "signOnMode": "BOOKMARK"}
+            self.app_users[app_id] = {}
+        group_ids, app_ids = list(self.groups), list(self.apps)
+        for user_id in self.users:
+            for group_id in rnd.sample(group_ids,
+                                       min(groups_per_user, num_groups)):
+                self.group_users[group_id][user_id] = None
+            for app_id in rnd.sample(app_ids, min(apps_per_user, num_apps)):
+                self.app_users[app_id][user_id] = None
+
+    def _add_user(self, user_id, profile, status="ACTIVE"):
+        user = {"id": user_id, "status": status, "profile": profile}
+        self.users[user_id] = user
+        self.logins[profile.get("login")] = user_id
+        return user
+
+    def _add_group(self, group_id, profile):
+        group = {"id": group_id, "type": "OKTA_GROUP", "profile": profile}
+        self.groups[group_id] = group
+        self.group_users[group_id] = {}
+        return group
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(self, method, path, *faults):
+        """
+        Queues faults for requests matching method and path (a regex,
+        without "/api/v1").
+
+        :param faults: HTTP status codes, "reset" (close the connection
+                       without answer) or ("delay", seconds)
+        """
+        with self._lock:
+            self._faults += [(method, re.compile(path), x) for x in faults]
+
+    def next_fault(self, method, path):
+        with self._lock:
+            for idx, (m, regex, fault) in enumerate(self._faults):
+                if m == method and regex.fullmatch(path):
+                    del self._faults[idx]
+                    return fault
+        return None
+
+    def record(self, method, path, body, headers=None):
+        with self._lock:
+            self.requests.append((method, path, body))
+            self.headers.append(dict(headers or {}))
+
+    def count(self, method, path):
+        regex = re.compile(path)
+        return sum(1 for m, p, _ in self.requests
+                   if m == method and regex.fullmatch(p))
+
+    def _endpoint(self, method, path):
+        for m, pattern, regex, _ in self._routes:
+            if m == method and regex.fullmatch(path):
+                return f"{method} {pattern}"
+        return f"{method} {path}"
+
+    def count_rate_limit(self, method, path):
+        """
+        Counts a request against the rate limit of its endpoint, in fixed
+        windows of .rate_window seconds like Okta does.
+
+        :return: A tuple (allowed, X-Rate-Limit-* headers)
+        """
+        if self.rate_limit is None:
+            return True, {}
+        key = self._endpoint(method, path.rstrip("/") or "/")
+        now = time.time()
+        with self._lock:
+            start, used = self._windows.get(key, (now, 0))
+            if now >= start + self.rate_window:
+                start, used = now, 0
+            allowed = used < self.rate_limit
+            if allowed:
+                used += 1
+            self._windows[key] = (start, used)
+        return allowed, {
+            "X-Rate-Limit-Limit":     self.rate_limit,
+            "X-Rate-Limit-Remaining": self.rate_limit - used,
+            "X-Rate-Limit-Reset":     math.ceil(start + self.rate_window),
+        }
+
+    def route(self, method, path, body, query=None):
+        """
+        :return: A tuple (status, body, headers)
+        """
+        path = path.rstrip("/") or "/"
+        for m, _, regex, func in self._routes:
+            match = regex.fullmatch(path)
+            if m == method and match:
+                data = json.loads(body.decode("utf-8")) if body else {}
+                with self._lock:
+                    return func(path, query or {}, data, *match.groups())
+        return 404, {"errorCode": "E0000022",
+                     "errorSummary": "The endpoint does not support the "
+                                     "provided HTTP method"}, {}
+
+    def _page(self, path, kind, objects, query, match=None):
+        default, maximum = self.page_sizes[kind]
+        limit = min(int(query.get("limit", default)), maximum)
+        ids = list(objects)
+        start = 0
+        if "after" in query:
+            try:
+                start = ids.index(query["after"]) + 1
+            except ValueError:
+                return 400, {"errorCode": "E0000001",
+                             "errorSummary": "Invalid cursor"}, {}
+        page = []
+        more = False
+        for idx in range(start, len(ids)):
+            obj = objects[ids[idx]]
+            if match is None or match(obj):
+                if len(page) == limit:
+                    more = True
+                    break
+                page.append(obj)
+        headers = {}
+        if more:
+            params = dict(query, limit=limit, after=page[-1]["id"])
+            headers["Link"] = (f'<{self.url}/api/v1{path}?'
+                               f'{urlencode(params)}>; rel="next"')
+        return 200, page, headers
+
+    def _find_user(self, id_or_login):
+        user_id = id_or_login if id_or_login in self.users \
+            else self.logins.get(id_or_login)
+        return self.users.get(user_id)
+
+    # users
+
+    def _list_users(self, path, query, data):
+        expr = query.get("filter") or query.get("search")
+        if expr:
+            match = _matcher(expr)
+        else:
+            # like Okta, deprovisioned users only if asked for
+            def match(user):
+                return user["status"] != "DEPROVISIONED"
+        return self._page(path, "users", self.users, query, match)
+
+    def _create_user(self, path, query, data):
+        profile = dict(data.get("profile", {}))
+        if profile.get("login") in self.logins:
+            return 400, {"errorCode": "E0000001",
+                         "errorSummary": "login: An object with this field "
+                                         "already exists"}, {}
+        activate = query.get("activate", "true").lower() == "true"
+        user_id = "00u%017d" % (10 ** 16 + len(self.users))
+        return 200, self._add_user(user_id, profile,
+                                   "ACTIVE" if activate else "STAGED"), {}
+
+    def _get_user(self, path, query, data, user):
+        found = self._find_user(user)
+        return (200, found, {}) if found else _not_found(user)
+
+    def _update_user(self, path, query, data, user):
+        found = self._find_user(user)
+        if found is None:
+            return _not_found(user)
+        found["profile"].update(data.get("profile", {}))
+        return 200, found, {}
+
+    def _delete_user(self, path, query, data, user):
+        found = self._find_user(user)
+        if found is None:
+            return _not_found(user)
+        del self.users[found["id"]]
+        self.logins.pop(found["profile"].get("login"), None)
+        return 204, None, {}
+
+    def _user_groups(self, path, query, data, user):
+        found = self._find_user(user)
+        if found is None:
+            return _not_found(user)
+        return 200, [self.groups[group_id]
+                     for group_id, members in self.group_users.items()
+                     if found["id"] in members], {}
+
+    def _lifecycle(self, path, query, data, user, operation):
+        found = self._find_user(user)
+        if found is None:
+            return _not_found(user)
+        if operation not in self.LIFECYCLE:
+            return 404, {"errorCode": "E0000022",
+                         "errorSummary": "The endpoint does not support the "
+                                         "provided HTTP method"}, {}
+        found["status"] = self.LIFECYCLE[operation]
+        if operation == "reset_password":
+            return 200, {"resetPasswordUrl":
+                         f"{self.url}/reset/{found['id']}"}, {}
+        if operation == "expire_password":
+            return 200, found, {}
+        return 200, {}, {}
+
+    # groups
+
+    def _list_groups(self, path, query, data):
+        match = None
+        if query.get("q"):
+            prefix = query["q"].lower()
+
+            def match(group):
+                return group["profile"]["name"].lower().startswith(prefix)
+        return self._page(path, "groups", self.groups, query, match)
+
+    def _create_group(self, path, query, data):
+        group_id = "00g%017d" % (10 ** 16 + len(self.groups))
+        return 200, self._add_group(group_id,
+                                    dict(data.get("profile", {}))), {}
+
+    def _get_group(self, path, query, data, group):
+        found = self.groups.get(group)
+        return (200, found, {}) if found else _not_found(group)
+
+    def _delete_group(self, path, query, data, group):
+        if group not in self.groups:
+            return _not_found(group)
+        del self.groups[group]
+        del self.group_users[group]
+        return 204, None, {}
+
+    def _group_users(self, path, query, data, group):
+        if group not in self.groups:
+            return _not_found(group)
+        members = {user_id: self.users[user_id]
+                   for user_id in self.group_users[group]
+                   if user_id in self.users}
+        return self._page(path, "members", members, query)
+
+    def _add_member(self, path, query, data, group, user):
+        if group not in self.groups or user not in self.users:
+            return _not_found(f"{group}/{user}")
+        self.group_users[group][user] = None
+        return 204, None, {}
+
+    def _remove_member(self, path, query, data, group, user):
+        if group not in self.groups:
+            return _not_found(group)
+        self.group_users[group].pop(user, None)
+        return 204, None, {}
+
+    # apps
+
+    def _list_apps(self, path, query, data):
+        return self._page(path, "apps", self.apps, query)
+
+    def _get_app(self, path, query, data, app):
+        found = self.apps.get(app)
+        return (200, found, {}) if found else _not_found(app)
+
+    def _delete_app(self, path, query, data, app):
+        if app not in self.apps:
+            return _not_found(app)
+        del self.apps[app]
+        del self.app_users[app]
+        return 204, None, {}
+
+    def _app_users(self, path, query, data, app):
+        if app not in self.apps:
+            return _not_found(app)
+        members = {
+            user_id: {"id": user_id, "scope": "USER",
+                      "credentials": {
+                          "userName": self.users[user_id]["profile"]["login"]
+                      }}
+            for user_id in self.app_users[app] if user_id in self.users
+        }
+        return self._page(path, "members", members, query)
+
+    def _schema(self, path, query, data):
+        return 200, okta_user_schema, {}
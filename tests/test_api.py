@@ -0,0 +1,72 @@
+import json
+import os
+import stat
+from unittest.mock import patch
+
+import pytest
+
+from oktacli import api
+from oktacli.api import plan_user_search, filter_users
+from oktacli.exceptions import ExitException
+
+
+@pytest.mark.parametrize("filters,partial,wanted", [
+    ({"department": "IT"}, False, 'profile.department eq "IT"'),
+    ({"title": "Dev.*"}, False, 'profile.title sw "Dev"'),
+    ({"city": "Berlin|Paris"}, False,
+     '(profile.city eq "Berlin" or profile.city eq "Paris")'),
+    ({"a": "x", "b": "y\\.z"}, False,
+     'profile.a eq "x" and profile.b eq "y.z"'),
+    ({"title": "^Dev"}, True, 'profile.title sw "Dev"'),
+    ({"title": "^Dev$"}, True, 'profile.title eq "Dev"'),
+    ({"title": 'say "hi"'}, False, 'profile.title eq "say \\"hi\\""'),
+    # not translatable
+    ({"title": "Dev"}, True, ""),
+    ({"title": "D[ei]v"}, False, ""),
+    ({"title": "\\d+"}, False, ""),
+    ({"title": ".*Dev"}, False, ""),
+])
+def test_plan_user_search(filters, partial, wanted):
+    assert plan_user_search(filters, partial=partial) == wanted
+
+
+def test_plan_user_search_combined():
+    rv = plan_user_search({"title": "Dev", "city": "B.*n"},
+                          search_query='status eq "ACTIVE"')
+    assert rv == '(status eq "ACTIVE") and profile.title eq "Dev"'
+
+
+def test_filter_users():
+    users = [{"profile": {"title": "Dev"}}, {"profile": {"title": "dev"}},
+             {"profile": {}}]
+    rv = list(filter_users(users, filters={"title": "Dev"}))
+    assert rv == users[:1]
+
+
+def test_config_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path))
+    with pytest.raises(ExitException):
+        api.load_config()
+    api.save_config({"default": "a", "profiles": {
+        "a": {"url": "https://a.okta.com", "token": "1"},
+        "b": {"url": "https://b.okta.com", "token": "2"},
+    }})
+    config_file = api.get_config_file()
+    assert config_file.startswith(str(tmp_path))
+    assert stat.S_IMODE(os.stat(config_file).st_mode) == 0o600
+    with patch("oktacli.api.json.loads", wraps=json.loads) as loads:
+        assert api.get_profile() == ("a", {"url": "https://a.okta.com",
+                                           "token": "1"})
+        name, profile = api.get_profile("b")
+        profile["token"] = "changed"
+        assert api.list_profiles() == ["a", "b"]
+        # parsed once, and callers get copies
+        assert loads.call_count == 1
+        assert api.get_profile("b")[1]["token"] == "2"
+        config = api.load_config()
+        config["default"] = "b"
+        api.save_config(config)
+        assert api.get_manager().url == "https://b.okta.com/api/v1"
+        assert loads.call_count == 2
+    with pytest.raises(ExitException):
+        api.get_profile("c")
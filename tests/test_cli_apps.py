@@ -0,0 +1,65 @@
+import json
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from oktacli import cli
+from oktacli.okta import Okta
+from .fakeokta import FakeOkta
+
+
+@patch('oktacli.cli.get_manager')
+def test_apps_users_by_label(get_manager, monkeypatch):
+    monkeypatch.setitem(cli.client_options, "profiles", None)
+    with FakeOkta(users=4, apps=2, apps_per_user=1) as fake:
+        get_manager.return_value = Okta(fake.url, "12ab")
+        result = CliRunner().invoke(cli.cli_apps, ["users", "app 1", "-j"])
+        assert result.exit_code == 0
+        rv = json.loads(result.output)
+        assert sorted(x["id"] for x in rv) == \
+            sorted(fake.app_users["0oa00000000000000001"])
+        # all apps have the same name
+        result = CliRunner().invoke(cli.cli_apps, ["users", "bookmark"])
+        assert result.exit_code == -1
+        assert "Found 2 apps matching 'bookmark'" in result.output
+
+
+@patch('oktacli.cli.get_manager')
+def test_apps_assignments(get_manager, monkeypatch, tmp_path):
+    monkeypatch.setitem(cli.client_options, "profiles", None)
+    with FakeOkta(users=30, apps=5, apps_per_user=2) as fake:
+        get_manager.return_value = Okta(fake.url, "12ab")
+        result = CliRunner().invoke(cli.cli_apps, [
+            "assignments", "--all", "-j"])
+        assert result.exit_code == 0
+        rows = [json.loads(x) for x in result.output.splitlines()]
+        assert len(rows) == 60
+        assert set(rows[0]) == {"app", "user", "syncState", "userName"}
+        wanted = {(fake.apps[app]["label"], user) for app in fake.app_users
+                  for user in fake.app_users[app]}
+        assert {(x["app"], x["user"]) for x in rows} == wanted
+        assert fake.count("GET", "/apps") == 1
+        # apps from a file and the command line, each once
+        app_file = tmp_path / "apps.txt"
+        app_file.write_text("App 1\n# comment\n0oa00000000000000003\n")
+        result = CliRunner().invoke(cli.cli_apps, [
+            "assignments", "-f", str(app_file), "app 1"])
+        assert result.exit_code == 0
+        lines = result.output.splitlines()
+        assert lines[0] == "app,user,syncState,userName"
+        assert {x.split(",")[0] for x in lines[1:]} == {"App 1", "App 3"}
+        assert len(lines) == 1 + len(fake.app_users["0oa00000000000000001"]) \
+            + len(fake.app_users["0oa00000000000000003"])
+        # a failed app is not a silent gap in the output (a new client,
+        # the old one remembers the responses for a moment)
+        get_manager.return_value = Okta(fake.url, "12ab")
+        fake.fail("GET", "/apps/0oa00000000000000002/users", 400)
+        result = CliRunner().invoke(cli.cli_apps, [
+            "assignments", "--all", "-j"])
+        assert result.exit_code == -1
+        assert "ERROR: app App 2" in result.output
+        assert "ERROR: 1 of 5 apps failed." in result.output
+        rows = [json.loads(x) for x in result.output.splitlines()
+                if x.startswith("{")]
+        assert {x["app"] for x in rows} == {"App 0", "App 1", "App 3",
+                                            "App 4"}
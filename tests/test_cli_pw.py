@@ -0,0 +1,94 @@
+import csv
+import json
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from oktacli import cli, pwgen
+from oktacli.okta import Okta
+from .fakeokta import FakeOkta
+
+
+def _results(file):
+    with open(file, "r", encoding="utf-8") as fh:
+        return {row["user"]: row for row in csv.DictReader(fh)}
+
+
+@patch('oktacli.cli.get_manager')
+def test_pw_bulk_expire(get_manager, tmp_path):
+    users = tmp_path / "users.txt"
+    users.write_text("# header\nuser0@example.com\n00u00000000000000001\n"
+                     "nobody@example.com\n", encoding="utf-8")
+    results = tmp_path / "results.csv"
+    with FakeOkta() as fake:
+        get_manager.return_value = Okta(fake.url, "12ab")
+        result = CliRunner().invoke(cli.cli_pw, [
+            "bulk-expire", "-f", str(users), "-o", str(results)])
+        assert result.exit_code == 0
+        assert "2 ok, 1 errors" in result.output
+        assert fake.users["00u00000000000000000"]["status"] == \
+            "PASSWORD_EXPIRED"
+        assert fake.users["00u00000000000000002"]["status"] == "ACTIVE"
+    rows = _results(results)
+    assert rows["00u00000000000000001"]["result"] == "ok"
+    assert rows["nobody@example.com"]["result"] == "error"
+
+
+@patch('oktacli.cli.get_manager')
+def test_pw_bulk_reset_search(get_manager, tmp_path):
+    results = tmp_path / "results.csv"
+    with FakeOkta(users=5) as fake:
+        get_manager.return_value = Okta(fake.url, "12ab")
+        result = CliRunner().invoke(cli.cli_pw, [
+            "bulk-reset", "-n", "--search", 'profile.department eq "IT"',
+            "-o", str(results)])
+        assert result.exit_code == 0
+        assert fake.count("POST", "/users/.*/lifecycle/reset_password") == 1
+    rows = _results(results)
+    assert rows["user0@example.com"]["detail"].endswith(
+            "/reset/00u00000000000000000")
+
+
+@patch('oktacli.cli.get_manager')
+def test_pw_bulk_set_generate(get_manager, tmp_path, monkeypatch):
+    users = tmp_path / "users.txt"
+    users.write_text("".join(f"user{i}@example.com\n" for i in range(3)),
+                     encoding="utf-8")
+    results = tmp_path / "results.csv"
+    monkeypatch.setattr(pwgen, "_wordlists", {
+        "en": pwgen.WordList.from_words(["alpha", "beta", "gamma", "delta",
+                                         "epsilon", "zeta", "eta"])})
+    with FakeOkta() as fake:
+        get_manager.return_value = Okta(fake.url, "12ab")
+        result = CliRunner().invoke(cli.cli_pw, [
+            "bulk-set", "-g", "-f", str(users), "-o", str(results)])
+        assert result.exit_code == 0
+        bodies = [json.loads(body) for method, path, body in fake.requests
+                  if method == "POST"]
+    rows = _results(results)
+    assert len(rows) == 3
+    passwords = {x["credentials"]["password"]["value"] for x in bodies}
+    assert passwords == {x["detail"] for x in rows.values()}
+    assert all(len(x) >= 14 for x in passwords)
+    result = CliRunner().invoke(cli.cli_pw, ["bulk-set", "-f", str(users)])
+    assert "Either use -s or -g" in result.output
+
+
+@patch('oktacli.cli.get_manager')
+def test_pw_bulk_expire_profiles(get_manager, tmp_path, monkeypatch):
+    monkeypatch.setitem(cli.client_options, "profiles", None)
+    users = tmp_path / "users.txt"
+    users.write_text("user0@example.com\n", encoding="utf-8")
+    with FakeOkta(users=1) as fake_a, FakeOkta(users=1) as fake_b:
+        fakes = {"a": fake_a, "b": fake_b}
+        get_manager.side_effect = lambda profile: Okta(fakes[profile].url,
+                                                       "12ab")
+        # one results file per profile, none overwrites the other
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "pw", "bulk-expire", "-t", "-f", str(users),
+            "-o", str(tmp_path / "results.csv")])
+        assert result.exit_code == 0
+    for profile in ("a", "b"):
+        rows = _results(tmp_path / f"results-{profile}.csv")
+        assert rows["user0@example.com"]["result"] == "ok"
+    assert not (tmp_path / "results.csv").exists()
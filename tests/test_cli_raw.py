@@ -0,0 +1,77 @@
+import json
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from oktacli import cli
+from oktacli.okta import Okta
+from .fakeokta import FakeOkta
+
+
+@patch('oktacli.cli.get_manager')
+def test_raw_batch(get_manager, monkeypatch, tmp_path):
+    monkeypatch.setitem(cli.client_options, "profiles", None)
+    with FakeOkta(users=3, groups=1) as fake:
+        get_manager.return_value = Okta(fake.url, "12ab")
+        user, group = "00u00000000000000001", "00g00000000000000000"
+        lines = [
+            {"method": "POST", "path": f"/users/{user}/lifecycle/suspend"},
+            {"path": "users", "params": {"filter": 'status eq "ACTIVE"'}},
+            {"method": "put", "path": f"/groups/{group}/users/{user}"},
+            {"method": "post", "path": f"/users/{user}",
+             "body": {"profile": {"title": "Boss"}}},
+            {"method": "get", "path": "/users/nobody"},
+        ]
+        stdin = "\n".join(json.dumps(x) for x in lines) + "\n\nno json\n"
+        result = CliRunner().invoke(cli.cli_raw, ["batch", "--ordered"],
+                                    input=stdin)
+        assert result.exit_code == -1
+        rv = [json.loads(x) for x in result.output.splitlines()
+              if x.startswith("{")]
+        assert [x["line"] for x in rv] == [1, 2, 3, 4, 5, 7]
+        assert [x.get("status") for x in rv] == \
+            [200, 200, 204, 200, 404, None]
+        assert "error" in rv[4] and "Invalid request" in rv[5]["error"]
+        assert isinstance(rv[1]["body"], list)
+        assert rv[3]["body"]["profile"]["title"] == "Boss"
+        assert fake.users[user]["status"] == "SUSPENDED"
+        assert user in fake.group_users[group]
+        assert "2 of 6 requests failed" in result.output
+        # completion order, from a file
+        requests_file = tmp_path / "requests.jsonl"
+        requests_file.write_text("".join(
+                json.dumps({"path": f"/users/{x}"}) + "\n"
+                for x in fake.users))
+        result = CliRunner().invoke(cli.cli_raw, [
+            "batch", "-f", str(requests_file), "-w", "3"])
+        assert result.exit_code == 0
+        rv = [json.loads(x) for x in result.output.splitlines()]
+        assert sorted(x["line"] for x in rv) == [1, 2, 3]
+        assert {x["body"]["id"] for x in rv} == set(fake.users)
+
+
+@patch('oktacli.cli.get_manager')
+def test_raw_batch_ordered_profiles(get_manager, monkeypatch, tmp_path):
+    monkeypatch.setitem(cli.client_options, "profiles", None)
+    with FakeOkta(users=30) as fake_a, FakeOkta(users=30) as fake_b:
+        fakes = {"a": fake_a, "b": fake_b}
+        get_manager.side_effect = lambda profile: Okta(fakes[profile].url,
+                                                       "12ab")
+        requests_file = tmp_path / "requests.jsonl"
+        requests_file.write_text("".join(
+                json.dumps({"path": f"/users/{x}"}) + "\n"
+                for x in fake_a.users))
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "raw", "batch", "--ordered", "-w", "4",
+            "--max-workers", "4", "-f", str(requests_file)])
+        assert result.exit_code == 0
+        output = result.output.split("==> b <==")
+        for profile_output in output:
+            rv = [json.loads(x) for x in profile_output.splitlines()
+                  if x.startswith("{")]
+            assert [x["line"] for x in rv] == list(range(1, 31))
+        # stdin cannot be shared by the profiles
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "raw", "batch"], input="{}")
+        assert result.exit_code == -1
+        assert "read the requests from a file" in result.output
@@ -1,12 +1,15 @@
+import json
 import re
 from unittest.mock import patch
 
 from click.testing import CliRunner
+import pytest
 import responses
 
 from oktacli import cli
 from oktacli.okta import Okta
-from .testdata import okta_user_schema
+from .fakeokta import FakeOkta
+from .testdata import okta_user_schema, okta_groups_list
 
 
 def _prep_schema_response(func):
@@ -35,3 +38,227 @@ def test_user_update(get_manager):
     # validate
     assert result.exit_code == 0
     assert result.exception is None
+
+
+@pytest.mark.parametrize("processes", ["0", "2"])
+@patch('oktacli.cli.get_manager')
+@responses.activate
+def test_user_bulk_update(get_manager, processes, tmp_path, monkeypatch):
+    # test data
+    infile = tmp_path / "update.csv"
+    infile.write_text("profile.login,profile.title,profile.anint,ignored\n"
+                      "user0,Boss,1,x\n"
+                      ",Nobody,2,x\n"
+                      "user1,Minion,3,x\n"
+                      "user2,Invalid,three,x\n", encoding="utf-8")
+    params0 = ["bulk-update", str(infile), "-p", processes,
+               "-s", "profile.department=HQ"]
+    # set up test
+    monkeypatch.chdir(tmp_path)
+    get_manager.return_value = Okta("http://okta", "12ab")
+    runner = CliRunner()
+    responses.add(
+            responses.GET, 'http://okta/api/v1/meta/schemas/user/default/',
+            json=okta_user_schema, status=200,
+    )
+    responses.add(responses.POST, re.compile('.+/users/user[0-9]$'),
+                  json={"test": "ok"}, status=200)
+    # run command
+    result = runner.invoke(cli.cli_users, params0)
+    # validate
+    assert result.exit_code == 0
+    assert "2 ok" in result.output
+    assert "2 errors" in result.output
+    bodies = {c.request.url.rsplit("/", 1)[1]: json.loads(c.request.body)
+              for c in responses.calls if c.request.method == "POST"}
+    # the invalid row must not be sent
+    assert sorted(bodies) == ["user0", "user1"]
+    assert bodies["user0"] == {
+        "profile": {"department": "HQ", "title": "Boss", "anint": 1}}
+
+
+@patch('oktacli.cli.get_manager')
+@responses.activate
+def test_user_list_match_pushdown(get_manager):
+    # test data
+    params0 = ["list", "-m", "title=Dev", "-m", "city=B.*n", "-j"]
+    page1 = [{"id": "u1", "status": "ACTIVE",
+              "profile": {"title": "Dev", "city": "Berlin"}},
+             {"id": "u2", "status": "ACTIVE",
+              "profile": {"title": "dev", "city": "Berlin"}}]
+    page2 = [{"id": "u3", "status": "DEPROVISIONED",
+              "profile": {"title": "Dev", "city": "Bonn"}}]
+    # set up test
+    get_manager.return_value = Okta("http://okta", "12ab")
+    runner = CliRunner()
+    responses.add(responses.GET, 'http://okta/api/v1/users', json=page1,
+                  headers={"Link": '<http://okta/api/v1/users?after=u2>; '
+                                   'rel="next"'})
+    responses.add(responses.GET, 'http://okta/api/v1/users', json=page2)
+    # run command
+    result = runner.invoke(cli.cli_users, params0)
+    # validate
+    assert result.exit_code == 0
+    assert [x["id"] for x in json.loads(result.output)] == ["u1"]
+    search = responses.calls[0].request.params["search"]
+    assert search == 'profile.title eq "Dev"'
+
+
+@patch('oktacli.cli.get_manager')
+@responses.activate
+def test_user_groups_from_file(get_manager, tmp_path):
+    # test data
+    infile = tmp_path / "users.txt"
+    infile.write_text("user0\n\n# comment\nuser1\nnobody\n", encoding="utf-8")
+    params0 = ["groups", "-f", str(infile)]
+    # set up test
+    get_manager.return_value = Okta("http://okta", "12ab")
+    runner = CliRunner()
+    for user in ("user0", "user1"):
+        responses.add(responses.GET, f'http://okta/api/v1/users/{user}/groups',
+                      json=okta_groups_list[:2], status=200)
+    responses.add(responses.GET, 'http://okta/api/v1/users/nobody/groups',
+                  json={"errorCode": "E0000007"}, status=404)
+    # run command
+    result = runner.invoke(cli.cli_users, params0)
+    # validate
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert "user,group_id,group_name" in lines
+    assert "user0,group2,Group Two" in lines
+    assert "user1,group1,Group One" in lines
+    assert not any(x.startswith("nobody,") for x in lines)
+
+
+@patch('oktacli.cli.get_manager')
+def test_user_bulk_update_deadline(get_manager, tmp_path, monkeypatch):
+    infile = tmp_path / "update.csv"
+    infile.write_text("id,profile.title\n" +
+                      "".join(f"00u{i:017d},Title {i}\n" for i in range(3)),
+                      encoding="utf-8")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(cli.client_options, "deadline", None)
+    with FakeOkta() as fake:
+        fake.fail("POST", "/users/.*", ("delay", 0.7), ("delay", 0.7))
+        get_manager.return_value = Okta(fake.url, "12ab")
+        result = CliRunner().invoke(cli.cli_main, [
+            "--deadline", "1", "users", "bulk-update", str(infile),
+            "--no-validate", "-w", "1", "--no-adaptive"])
+        # the first update was done, the second one timed out at the
+        # deadline, the third one was never sent
+        assert result.exit_code != 0
+        assert "1 ok" in result.output
+        assert "continue with '-i 1'" in result.output
+        assert fake.count("POST", "/users/.*") == 2
+
+
+@patch('oktacli.cli.get_manager')
+def test_user_bulk_lifecycle(get_manager, tmp_path):
+    users = tmp_path / "users.txt"
+    users.write_text("user0@example.com\nuser1@example.com\n"
+                     "nobody@example.com\n", encoding="utf-8")
+    results = tmp_path / "results.csv"
+    with FakeOkta() as fake:
+        get_manager.return_value = Okta(fake.url, "12ab")
+        runner = CliRunner()
+        result = runner.invoke(cli.cli_users, [
+            "bulk-lifecycle", "deactivate", "-f", str(users), "--dry-run"])
+        assert result.exit_code == 0
+        assert "deactivate: 3 users (user0@example.com" in result.output
+        assert not fake.count("POST", "/users/.*/lifecycle/.*")
+        # one confirmation for all users
+        result = runner.invoke(cli.cli_users, [
+            "bulk-lifecycle", "deactivate", "-f", str(users)], input="2\n")
+        assert "Aborted" in result.output
+        result = runner.invoke(cli.cli_users, [
+            "bulk-lifecycle", "deactivate", "-f", str(users),
+            "-o", str(results)], input="3\n")
+        assert result.exit_code == 0
+        assert "2 ok, 1 errors" in result.output
+        assert fake.users["00u00000000000000001"]["status"] == \
+            "DEPROVISIONED"
+        assert fake.users["00u00000000000000002"]["status"] == "ACTIVE"
+        # resuming skips the users which were done
+        result = runner.invoke(cli.cli_users, [
+            "bulk-lifecycle", "deactivate", "-f", str(users),
+            "--resume", str(results), "--dry-run"])
+        assert "deactivate: 1 users (nobody@example.com)" in result.output
+        # but not with the results of another operation
+        result = runner.invoke(cli.cli_users, [
+            "bulk-lifecycle", "delete", "-f", str(users),
+            "--resume", str(results), "--dry-run"])
+        assert result.exit_code == -1
+        assert "another operation (users-deactivate)" in result.output
+
+
+@patch('oktacli.cli.get_manager')
+def test_users_list_profiles(get_manager, monkeypatch):
+    monkeypatch.setitem(cli.client_options, "profiles", None)
+    with FakeOkta(users=2) as fake_a, FakeOkta(users=3) as fake_b:
+        fakes = {"a": fake_a, "b": fake_b}
+        get_manager.side_effect = lambda profile: Okta(fakes[profile].url,
+                                                       "12ab")
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "users", "list", "-j"])
+        assert result.exit_code == 0
+        rv = json.loads(result.output)
+        assert [(x["config_profile"], x["id"]) for x in rv] == \
+            [("a", f"00u{i:017d}") for i in range(2)] + \
+            [("b", f"00u{i:017d}") for i in range(3)]
+        # the table has the profile column, errors are per profile
+        fake_b.fail("GET", "/users", 400)
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "users", "list"])
+        assert result.exit_code != 0
+        lines = result.output.splitlines()
+        assert [x.split()[:2] for x in lines if x.startswith("a ")] == \
+            [["a", f"00u{i:017d}"] for i in range(2)]
+        assert "[b]" in result.output
+
+
+@patch('oktacli.cli.get_manager')
+def test_users_delete_profiles_needs_no_confirmation(get_manager,
+                                                     monkeypatch):
+    monkeypatch.setitem(cli.client_options, "profiles", None)
+    with FakeOkta(users=2) as fake_a, FakeOkta(users=2) as fake_b:
+        fakes = {"a": fake_a, "b": fake_b}
+        get_manager.side_effect = lambda profile: Okta(fakes[profile].url,
+                                                       "12ab")
+        # nobody can answer the prompts of two orgs at once
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "users", "delete", "user0@example.com"],
+            input="user0@example.com\n")
+        assert result.exit_code == -1
+        assert "ERROR: [a] Cannot ask for confirmation" in result.output
+        assert "ERROR: [b] Cannot ask for confirmation" in result.output
+        assert "SOMETHING REALLY BAD" not in result.output
+        assert len(fake_a.users) == len(fake_b.users) == 2
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "users", "deactivate", "user0@example.com"])
+        assert result.exit_code == -1
+        assert fake_a.users["00u00000000000000000"]["status"] == "ACTIVE"
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "users", "delete", "user0@example.com",
+            "--no-confirmation"])
+        assert result.exit_code == 0
+        assert "00u00000000000000000" not in fake_a.users
+        assert "00u00000000000000000" not in fake_b.users
+
+
+@patch('oktacli.cli.get_manager')
+def test_users_stdin_profiles(get_manager, monkeypatch):
+    monkeypatch.setitem(cli.client_options, "profiles", None)
+    with FakeOkta(users=2) as fake_a, FakeOkta(users=2) as fake_b:
+        fakes = {"a": fake_a, "b": fake_b}
+        get_manager.side_effect = lambda profile: Okta(fakes[profile].url,
+                                                       "12ab")
+        # the profiles would split the lines of stdin between them
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "users", "bulk-lifecycle", "suspend",
+            "-f", "-", "--no-confirmation"],
+            input="user0@example.com\nuser1@example.com\n")
+        assert result.exit_code == -1
+        assert "ERROR: [a] With --profiles read the list from a file" in \
+            result.output
+        assert not fake_a.count("POST", "/users/.*/lifecycle/.*")
+        assert not fake_b.count("POST", "/users/.*/lifecycle/.*")
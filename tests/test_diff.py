@@ -0,0 +1,211 @@
+import csv
+import io
+import json
+from unittest.mock import patch
+
+from click.testing import CliRunner
+import pytest
+
+from oktacli import cli
+from oktacli.diff import external_sort, merge_join, diff_tables, diff_dumps
+from oktacli.diff import diff_snapshots
+from oktacli.okta import Okta
+from .fakeokta import FakeOkta
+
+
+def _write_dump(dump_dir, tables):
+    dump_dir.mkdir()
+    for name, rows in tables.items():
+        with open(str(dump_dir / f"{name}.csv"), "w", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerows(rows)
+    return str(dump_dir)
+
+
+def test_external_sort():
+    rows = [[x % 7, x] for x in range(50)]
+    # three runs on disk and one in memory
+    rv = list(external_sort(rows, key=lambda x: x, chunk_size=13))
+    assert rv == sorted(rows)
+    assert list(external_sort([], key=lambda x: x)) == []
+
+
+def test_diff_tables():
+    left = [{"k": "a", "v": "1"}, {"k": "b", "v": "2", "id": "1"}]
+    right = [{"k": "b", "v": "3", "id": "2"}, {"k": "c", "v": "4"}]
+    key = lambda x: x["k"]  # noqa: E731
+    assert [k for k, *_ in merge_join(left, right, key)] == ["a", "b", "c"]
+    assert list(diff_tables(left, right, key, ignore={"id"})) == [
+        ("removed", "a", "", "", ""),
+        ("changed", "b", "v", "2", "3"),
+        ("added", "c", "", "", ""),
+    ]
+
+
+def test_diff_dumps(tmp_path):
+    groups = [["id", "profile.name"], ["g1", "Staff"], ["g2", "Admins"]]
+    apps = [["id", "label"]]
+    left = _write_dump(tmp_path / "left", {
+        "users": [["id", "profile.login", "profile.title"],
+                  ["u1", "anna", "Boss"], ["u2", "bert", "Dev"]],
+        "groups": groups, "apps": apps,
+        "group_users": [["group", "user"], ["g1", "u1"], ["g1", "u2"]],
+        "app_users": [["app", "user"]],
+    })
+    # other IDs in the other org, "bert" got promoted and left "Staff"
+    right = _write_dump(tmp_path / "right", {
+        "users": [["id", "profile.login", "profile.title"],
+                  ["x7", "bert", "Boss"], ["x9", "anna", "Boss"]],
+        "groups": [["id", "profile.name"], ["h1", "Staff"]], "apps": apps,
+        "group_users": [["group", "user"], ["h1", "x9"]],
+        "app_users": [["app", "user"]],
+    })
+    rv = list(diff_dumps(left, right, chunk_size=1))
+    assert rv == [
+        ("users", "changed", "bert", "profile.title", "Dev", "Boss"),
+        ("groups", "removed", "Admins", "", "", ""),
+        ("group_users", "removed", "Staff / bert", "", "", ""),
+    ]
+    assert list(diff_dumps(left, right, tables=["users"],
+                           fields=["profile.email"])) == []
+
+
+def test_diff_snapshots(tmp_path):
+    users = [["id", "profile.login", "status", "lastLogin"],
+             ["u1", "anna", "ACTIVE", "monday"],
+             ["u2", "bert", "ACTIVE", "monday"]]
+    groups = [["id", "profile.name"], ["g1", "Staff"]]
+    apps = [["id", "label"]]
+    old = _write_dump(tmp_path / "old", {
+        "users": users, "groups": groups, "apps": apps,
+        "group_users": [["group", "user"], ["g1", "u1"], ["g1", "u2"]],
+        "app_users": [["app", "user"]],
+    })
+    # anna renamed and suspended, bert gone, carl new and in "Staff"
+    new = _write_dump(tmp_path / "new", {
+        "users": [users[0], ["u1", "anna.b", "SUSPENDED", "friday"],
+                  ["u3", "carl", "ACTIVE", ""]],
+        "groups": groups, "apps": apps,
+        "group_users": [["group", "user"], ["g1", "u1"], ["g1", "u3"]],
+        "app_users": [["app", "user"]],
+    })
+    rv = list(diff_snapshots(old, new, chunk_size=1))
+    assert rv == [
+        ("users", "changed", "u1", "anna.b", "profile.login", "anna",
+         "anna.b"),
+        ("users", "changed", "u1", "anna.b", "status", "ACTIVE",
+         "SUSPENDED"),
+        ("users", "removed", "u2", "bert", "", "", ""),
+        ("users", "added", "u3", "carl", "", "", ""),
+        ("group_users", "removed", "g1/u2", "Staff / bert", "", "", ""),
+        ("group_users", "added", "g1/u3", "Staff / carl", "", "", ""),
+    ]
+    result = CliRunner().invoke(cli.cli_main, [
+        "dump-diff", old, new, "-t", "users", "-f", "status"])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert lines[0].split() == ["users", "changed", "anna.b", "status:",
+                                '"ACTIVE"', "->", '"SUSPENDED"']
+    assert "1 users added, 1 users changed, 1 users removed" in lines
+    result = CliRunner().invoke(cli.cli_main, [
+        "dump-diff", old, str(tmp_path)])
+    assert result.exit_code == -1
+    # a broken dump is an error, not a traceback
+    with open(str(tmp_path / "new" / "group_users.csv"), "w") as fh:
+        fh.write("group,member\ng1,u1\n")
+    result = CliRunner().invoke(cli.cli_main, ["dump-diff", old, new])
+    assert result.exit_code == -1
+    assert "group_users.csv has no column user" in result.output
+    assert not isinstance(result.exception, KeyError)
+
+
+@patch('oktacli.cli.get_manager')
+def test_diff_profiles(get_manager, monkeypatch, tmp_path):
+    for key in ("profiles", "trace", "stats", "stats_file", "deadline",
+                "cache"):
+        monkeypatch.setitem(cli.client_options, key, None)
+    monkeypatch.setitem(cli.client_options, "timeouts",
+                        {"connect": None, "read": None})
+    with FakeOkta(users=3, groups=2, groups_per_user=1) as fake_a, \
+            FakeOkta(users=4, groups=2, groups_per_user=1) as fake_b:
+        fake_b.users["00u00000000000000001"]["profile"]["title"] = "CEO"
+        fakes = {"a": fake_a, "b": fake_b}
+        get_manager.side_effect = lambda profile: Okta(fakes[profile].url,
+                                                       "12ab")
+        result = CliRunner().invoke(cli.cli_main, [
+            "diff", "--left", "a", "--right", "b", "-t", "users", "-j"])
+        assert result.exit_code == 0
+        rv = [json.loads(x) for x in result.output.splitlines()
+              if x.startswith("{")]
+        assert [(x["change"], x["key"], x["field"]) for x in rv] == [
+            ("changed", "user1@example.com", "profile.title"),
+            ("added", "user3@example.com", ""),
+        ]
+        # --profiles would be ignored
+        result = CliRunner().invoke(cli.cli_main, [
+            "--profiles", "a,b", "diff", "--left", "a", "--right", "b"])
+        assert result.exit_code == -1
+        assert "cannot be used with --profiles" in result.output
+        # a dump directory on one side
+        result = CliRunner().invoke(cli.cli_main, [
+            "diff", "--left", str(tmp_path), "--right", "b"])
+        assert result.exit_code == -1
+        assert "not found" in result.output
+
+
+def test_dump_org(tmp_path):
+    with FakeOkta(users=1200, groups=3, groups_per_user=2) as fake:
+        fake.users["00u00000000000000005"]["status"] = "DEPROVISIONED"
+        fake.users["00u00000000000000007"]["profile"]["nickName"] = "Seven"
+        cli._dump_org(Okta(fake.url, "12ab"), str(tmp_path),
+                      out=io.StringIO())
+        with open(str(tmp_path / "users.csv"), newline="") as fh:
+            users = list(csv.DictReader(fh))
+        # all pages, deprovisioned users, and the columns of all users
+        assert len(users) == 1200
+        assert {x["id"]: x["profile.nickName"] for x in users
+                if x["profile.nickName"]} == {"00u00000000000000007": "Seven"}
+        with open(str(tmp_path / "group_users.csv"), newline="") as fh:
+            members = list(csv.reader(fh))
+        assert members[0] == ["group", "user"]
+        assert sorted(map(tuple, members[1:])) == sorted(
+                (group, user) for group in fake.group_users
+                for user in fake.group_users[group])
+
+
+def test_diff_dumps_duplicate_names(tmp_path):
+    users = [["id", "profile.login"], ["u1", "anna"], ["u2", "bert"]]
+    left = _write_dump(tmp_path / "left", {
+        "users": users,
+        "groups": [["id", "profile.name", "type"], ["g1", "Staff", "OKTA"]],
+        # two apps labeled "Mail", of different kinds
+        "apps": [["id", "label", "name", "status"],
+                 ["a1", "Mail", "gmail", "ACTIVE"],
+                 ["a2", "Mail", "office365", "ACTIVE"]],
+        "group_users": [["group", "user"]],
+        "app_users": [["app", "user"], ["a1", "u1"], ["a2", "u2"]],
+    })
+    right = _write_dump(tmp_path / "right", {
+        "users": users,
+        # "Staff" twice, even with the same type
+        "groups": [["id", "profile.name", "type"],
+                   ["h1", "Staff", "OKTA"], ["h2", "Staff", "OKTA"]],
+        "apps": [["id", "label", "name", "status"],
+                 ["b2", "Mail", "office365", "INACTIVE"],
+                 ["b1", "Mail", "gmail", "ACTIVE"]],
+        "group_users": [["group", "user"]],
+        "app_users": [["app", "user"], ["b1", "u2"], ["b2", "u2"]],
+    })
+    rv = list(diff_dumps(left, right, tables=["groups", "apps", "app_users"]))
+    assert rv == [
+        ("groups", "duplicate", "Staff / OKTA", "", "", ""),
+        ("groups", "removed", "Staff / OKTA / g1", "", "", ""),
+        ("groups", "added", "Staff / OKTA / h1", "", "", ""),
+        ("groups", "added", "Staff / OKTA / h2", "", "", ""),
+        ("apps", "changed", "Mail / office365", "status", "ACTIVE",
+         "INACTIVE"),
+        ("app_users", "removed", "Mail / gmail / anna", "", "", ""),
+        ("app_users", "added", "Mail / gmail / bert", "", "", ""),
+    ]
+    with pytest.raises(ValueError):
+        list(merge_join([1, 1], [1], key=lambda x: x))
@@ -0,0 +1,265 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from oktacli.exceptions import DeadlineExceeded
+from oktacli.okta import Okta, REST
+from oktacli.parallel import SingleFlight
+from oktacli.retry import RetryPolicy
+
+from .fakeokta import FakeOkta
+
+
+@pytest.mark.parametrize("path,wanted", [
+    ("/users", "/users"),
+    ("/users/00u1ab2c3d4e5f6g7h8i/groups", "/users/{id}/groups"),
+    ("/users/me@example.com/lifecycle/unlock", "/users/{id}/lifecycle/unlock"),
+    ("http://okta/api/v1/groups/00g1ab2c3d4e5f6g7h8i/users?after=x",
+     "/groups/{id}/users"),
+])
+def test_endpoint_of(path, wanted):
+    assert Okta("http://okta", "12ab").endpoint_of(path) == wanted
+
+
+def _fast_okta(url, **retries):
+    return Okta(url, "12ab", retries=dict({"base_delay": 0.01}, **retries))
+
+
+def test_retry_server_errors_and_resets():
+    with FakeOkta() as fake:
+        fake.fail("GET", "/users/.*", 503, "reset", 502, 504)
+        okta = _fast_okta(fake.url)
+        user = okta.call_okta("/users/00u00000000000000000", REST.get)
+        assert user["profile"]["login"] == "user0@example.com"
+        assert fake.count("GET", "/users/.*") == 5
+
+
+def test_retry_budget_per_class():
+    with FakeOkta() as fake:
+        fake.fail("GET", "/users", 503, 503, 503)
+        okta = _fast_okta(fake.url, server=2)
+        with pytest.raises(requests.HTTPError):
+            okta.call_okta("/users", REST.get)
+        assert fake.count("GET", "/users") == 3
+        # the connection budget is separate
+        fake.fail("GET", "/users", 503, "reset", 503)
+        assert len(okta.call_okta("/users", REST.get)) == 3
+
+
+def test_retry_throttled():
+    with FakeOkta() as fake:
+        fake.fail("GET", "/users", 429)
+        okta = _fast_okta(fake.url)
+        with patch("oktacli.retry.time.time", return_value=0), \
+                patch("oktacli.okta.time.sleep") as sleep:
+            okta.call_okta("/users", REST.get)
+        assert fake.count("GET", "/users") == 2
+        assert sleep.call_count == 1
+
+
+def test_no_blind_retry_of_post():
+    with FakeOkta() as fake:
+        fake.fail("POST", "/users/.*/lifecycle/.*", 503, "reset")
+        okta = _fast_okta(fake.url)
+        with pytest.raises(requests.HTTPError):
+            okta.deactivate_user("00u00000000000000001")
+        with pytest.raises(requests.ConnectionError):
+            okta.deactivate_user("00u00000000000000001")
+        assert fake.count("POST", "/users/.*/lifecycle/.*") == 2
+        # throttled requests were not processed, these are safe
+        fake.fail("POST", "/users/.*/lifecycle/.*", 429)
+        with patch("oktacli.okta.time.sleep"):
+            okta.deactivate_user("00u00000000000000001")
+        assert fake.users["00u00000000000000001"]["status"] == \
+            "DEPROVISIONED"
+        assert fake.count("POST", "/users/.*/lifecycle/.*") == 4
+        # profile updates are idempotent
+        fake.fail("POST", "/users/.*", 502, "reset")
+        rv = okta.update_user("00u00000000000000001",
+                              {"profile": {"title": "Boss"}})
+        assert rv["profile"]["title"] == "Boss"
+        # password changes are not
+        before = fake.count("POST", "/users/00u00000000000000001")
+        fake.fail("POST", "/users/.*", 502)
+        with pytest.raises(requests.HTTPError):
+            okta.update_user("00u00000000000000001", body_data=json.dumps(
+                    {"credentials": {"password": {"value": "x"}}}))
+        assert fake.count("POST", "/users/00u00000000000000001") == \
+            before + 1
+
+
+def test_post_retried_when_not_sent():
+    okta = _fast_okta("http://127.0.0.1:1", connection=2)
+    with patch("oktacli.okta.time.sleep") as sleep:
+        with pytest.raises(requests.ConnectionError):
+            okta.deactivate_user("00u00000000000000001")
+    # connection refused: even the POST was retried
+    assert sleep.call_count == 2
+
+
+def test_retry_policy_validation():
+    with pytest.raises(ValueError):
+        RetryPolicy(servers=3)
+
+
+def test_read_timeout():
+    with FakeOkta() as fake:
+        fake.fail("GET", "/users", ("delay", 1))
+        okta = Okta(fake.url, "12ab", timeouts={"read": 0.2},
+                    retries={"timeout": 0})
+        with pytest.raises(requests.ReadTimeout):
+            okta.call_okta("/users", REST.get)
+        fake.fail("GET", "/users", ("delay", 1))
+        okta.retry = RetryPolicy(timeout=1, base_delay=0.01)
+        assert len(okta.call_okta("/users", REST.get)) == 3
+
+
+def test_deadline():
+    with FakeOkta() as fake:
+        fake.fail("GET", "/users", ("delay", 2))
+        okta = Okta(fake.url, "12ab")
+        okta.set_deadline(0.3)
+        start = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            okta.call_okta("/users", REST.get)
+        assert time.monotonic() - start < 1.5
+        # no more requests after the deadline
+        with pytest.raises(DeadlineExceeded):
+            okta.call_okta("/users", REST.get)
+        assert fake.count("GET", "/users") == 1
+
+
+def test_response_cache(tmp_path):
+    cache = {"file": str(tmp_path / "cache.sqlite"),
+             "ttls": {"/users/{id}": 0.5}}
+    user_path = "/users/00u00000000000000001"
+    with FakeOkta() as fake:
+        okta = Okta(fake.url, "12ab", cache=cache)
+        first = okta.call_okta(user_path, REST.get)
+        # fresh: no request at all, even from a new client
+        okta = Okta(fake.url, "12ab", cache=cache)
+        okta.flights.memo_ttl = 0
+        assert okta.call_okta(user_path, REST.get) == first
+        assert fake.count("GET", user_path) == 1
+        # another token does not see the entry
+        Okta(fake.url, "other", cache=cache).call_okta(user_path, REST.get)
+        assert fake.count("GET", user_path) == 2
+        # stale: revalidated with If-None-Match, 304
+        time.sleep(0.6)
+        assert okta.call_okta(user_path, REST.get) == first
+        assert fake.count("GET", user_path) == 3
+        assert "If-None-Match" in fake.headers[-1]
+        # writes invalidate
+        okta.update_user("00u00000000000000001",
+                         {"profile": {"title": "Boss"}})
+        rv = okta.call_okta(user_path, REST.get)
+        assert rv["profile"]["title"] == "Boss"
+        assert fake.count("GET", user_path) == 4
+        # endpoints without TTL are not cached
+        okta.call_okta("/users", REST.get)
+        okta.call_okta("/users", REST.get)
+        assert fake.count("GET", "/users") == 2
+
+
+def test_single_flight():
+    with FakeOkta() as fake:
+        fake.fail("GET", "/users/.*", ("delay", 0.3))
+        okta = Okta(fake.url, "12ab")
+        path = "/users/00u00000000000000001"
+        with ThreadPoolExecutor(8) as ex:
+            rv = list(ex.map(lambda _: okta.call_okta(path, REST.get),
+                             range(8)))
+        assert all(x == rv[0] for x in rv)
+        assert fake.count("GET", path) == 1
+        # the memo answers, until something is written
+        okta.call_okta(path, REST.get)
+        assert fake.count("GET", path) == 1
+        okta.update_user("00u00000000000000001",
+                         {"profile": {"title": "Boss"}})
+        rv = okta.call_okta(path, REST.get)
+        assert rv["profile"]["title"] == "Boss"
+        assert fake.count("GET", path) == 2
+
+
+def test_single_flight_errors():
+    flights = SingleFlight(memo_ttl=10)
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise ValueError("nope")
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            flights.do("key", fail)
+    # errors are not remembered
+    assert len(calls) == 2
+    assert flights.do("key", lambda: 42) == 42
+    assert flights.do("key", lambda: 43) == 42
+
+
+def test_fake_org():
+    with FakeOkta(users=450, groups=4, apps=2, groups_per_user=2,
+                  apps_per_user=1, rate_limit=100) as fake:
+        okta = _fast_okta(fake.url)
+        users = list(okta.call_okta_iter("/users"))
+        assert len(users) == 450
+        assert fake.count("GET", "/users") == 3
+        active = okta.list_users(filter_query='profile.login eq '
+                                              '"user7@example.com"')
+        assert [x["id"] for x in active] == ["00u00000000000000007"]
+        group = okta.call_okta("/groups", REST.get)[0]
+        members = okta.call_okta(f"/groups/{group['id']}/users", REST.get)
+        assert len(members) == len(fake.group_users[group["id"]])
+        assert sum(len(x) for x in fake.group_users.values()) == 900
+        rsp = requests.get(f"{fake.url}/api/v1/apps")
+        assert rsp.headers["X-Rate-Limit-Limit"] == "100"
+        assert rsp.headers["X-Rate-Limit-Remaining"] == "99"
+        fake.rate_limit = 1
+        rsp = requests.get(f"{fake.url}/api/v1/apps")
+        assert rsp.status_code == 429
+
+
+def test_app_index():
+    with FakeOkta(users=0, apps=3) as fake:
+        fake.apps["0oa00000000000000002"]["name"] = "salesforce"
+        okta = _fast_okta(fake.url)
+        index = okta.app_index()
+        assert [x["id"] for x in index.find("app 1")] == \
+            ["0oa00000000000000001"]
+        assert [x["label"] for x in index.find("SalesForce")] == ["App 2"]
+        assert len(index.find("bookmark")) == 2
+        assert len(index.find("^app")) == 3
+        assert index.find("0oa00000000000000000")[0]["label"] == "App 0"
+        assert index.find("app (") == []
+        # one request, until apps are changed
+        assert okta.app_index() is index
+        assert fake.count("GET", "/apps") == 1
+        okta.call_okta_raw("/apps/0oa00000000000000000", REST.delete)
+        assert len(okta.app_index().find("^app")) == 2
+
+
+def test_no_blind_retry_of_delete():
+    with FakeOkta() as fake:
+        okta = _fast_okta(fake.url)
+        okta.set_timeouts(read=0.3)
+        # the first DELETE deactivates the user, a repeated one would
+        # delete it for good
+        fake.fail("DELETE", "/users/.*", ("delay", 1.0))
+        with pytest.raises(requests.ReadTimeout):
+            okta.delete_user("00u00000000000000001")
+        fake.fail("DELETE", "/users/.*", 503)
+        with pytest.raises(requests.HTTPError):
+            okta.delete_user("00u00000000000000001")
+        assert fake.count("DELETE", "/users/.*") == 2
+        # removing a group member is safe to repeat
+        fake.fail("DELETE", "/groups/.*", 503)
+        with patch("oktacli.okta.time.sleep"), \
+                pytest.raises(requests.HTTPError, match="E0000007"):
+            okta.call_okta_raw("/groups/g/users/u", REST.delete,
+                               idempotent=True)
+        assert fake.count("DELETE", "/groups/.*") == 2
@@ -0,0 +1,98 @@
+import threading
+import time
+
+from oktacli.parallel import AdaptiveLimiter, run_parallel, ordered_map, \
+    batched, inheriting, thread_values
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_ordered_map():
+    with ThreadPoolExecutor(4) as ex:
+        rv = list(ordered_map(ex, lambda x, y: x * y, range(10), 2))
+    assert rv == [x * 2 for x in range(10)]
+
+
+def test_ordered_map_bounded():
+    pulled = []
+
+    def items():
+        for x in range(100):
+            pulled.append(x)
+            yield x
+
+    def slow_first(x):
+        if x == 0:
+            time.sleep(0.2)
+        return x
+
+    with ThreadPoolExecutor(4) as ex:
+        rv = ordered_map(ex, slow_first, items(), max_pending=4)
+        assert next(rv) == 0
+        # the others had to wait for the first one
+        assert len(pulled) == 4
+        assert list(rv) == list(range(1, 100))
+
+
+def test_inheriting():
+    thread_values()["name"] = "main"
+    try:
+        with ThreadPoolExecutor(2) as ex:
+            func = inheriting(lambda: thread_values().get("name"))
+            assert ex.submit(func).result() == "main"
+    finally:
+        thread_values().clear()
+
+
+def test_limiter_aimd():
+    limiter = AdaptiveLimiter(4, max_limit=6)
+    for _ in range(100):
+        limiter.observe(200, 0.1, 900, 1000)
+    assert limiter.current == 6
+    limiter.observe(429, 0.1, 0, 1000)
+    assert limiter.current == 3
+    # within the cooldown period: count the burst only once
+    limiter.observe(503, 0.1)
+    assert limiter.current == 3
+    # slow responses do not increase the limit
+    limiter.observe(200, 5.0, 900, 1000)
+    assert limiter.limit == 3
+
+
+def test_limiter_rate_limit_remaining():
+    limiter = AdaptiveLimiter(10)
+    limiter.observe(200, 0.1, 50, 1000)
+    assert limiter.current == 5
+
+
+def test_limiter_fixed():
+    limiter = AdaptiveLimiter(4, adaptive=False)
+    limiter.observe(429, 0.1)
+    assert limiter.current == 4
+    assert limiter.max_limit == 4
+
+
+def test_run_parallel_respects_limit():
+    limiter = AdaptiveLimiter(3, adaptive=False)
+    lock = threading.Lock()
+    state = {"now": 0, "max": 0}
+
+    def work(item):
+        with lock:
+            state["now"] += 1
+            state["max"] = max(state["max"], state["now"])
+        time.sleep(0.01)
+        with lock:
+            state["now"] -= 1
+        if item == 5:
+            raise ValueError("five")
+        return item * 2
+
+    rv = list(run_parallel(work, range(20), limiter=limiter))
+    assert state["max"] == 3
+    assert sorted(x[1] for x in rv if x[2] is None) == \
+        [x * 2 for x in range(20) if x != 5]
+    assert [x[0] for x in rv if x[2] is not None] == [5]
@@ -0,0 +1,45 @@
+import pytest
+
+from oktacli.exceptions import ExitException
+from oktacli.predicates import parse, compile_predicate, filter_columnar
+
+
+users = [
+    {"id": "u1", "status": "ACTIVE",
+     "profile": {"department": "IT", "title": "Developer", "level": 3}},
+    {"id": "u2", "status": "SUSPENDED",
+     "profile": {"department": "HR", "title": "Recruiter", "level": 5}},
+    {"id": "u3", "status": "ACTIVE",
+     "profile": {"department": "IT", "title": "Intern"}},
+    {"id": "u4", "status": "DEPROVISIONED", "profile": {"level": "7"}},
+]
+
+
+@pytest.mark.parametrize("expr,wanted", [
+    ('profile.department == "IT"', ["u1", "u3"]),
+    ('profile.department != "IT"', ["u2"]),
+    ('profile.level >= 5', ["u2"]),
+    ('profile.level == null', ["u3"]),
+    ('status in ("ACTIVE", "SUSPENDED") and profile.level < 4', ["u1"]),
+    ('status not in ("ACTIVE")', ["u2", "u4"]),
+    ('profile.title ~ "^(Dev|Rec)"', ["u1", "u2"]),
+    ('profile.title !~ "^Dev" and profile.department == "IT"', ["u3"]),
+    ('not (profile.department == "IT" or status == "SUSPENDED")', ["u4"]),
+    ("profile.title ~ 'e\\w' and profile.level > 1", ["u1", "u2"]),
+])
+def test_predicates(expr, wanted):
+    node = parse(expr)
+    assert [u["id"] for u in filter(compile_predicate(node), users)] == wanted
+    assert [u["id"] for u in filter_columnar(node, users)] == wanted
+
+
+@pytest.mark.parametrize("expr", [
+    'profile.level >',
+    'profile.level = 5',
+    '(status == "ACTIVE"',
+    'status == "ACTIVE" profile',
+    'status ~ 5',
+])
+def test_invalid_expressions(expr):
+    with pytest.raises(ExitException):
+        parse(expr)
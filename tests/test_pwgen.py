@@ -0,0 +1,57 @@
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+from oktacli import pwgen
+from oktacli.exceptions import ExitException
+from oktacli.pwgen import WordList, pack_words
+
+
+WORDS = ["apple", "Bäume", "cherry", "dog", "elephant"]
+
+
+def test_packed_wordlist(tmp_path):
+    file = tmp_path / "wordlist-en.bin"
+    file.write_bytes(pack_words(WORDS))
+    wordlist = WordList.open(str(file))
+    assert len(wordlist) == 5
+    assert [wordlist[i] for i in range(5)] == WORDS
+    with pytest.raises(IndexError):
+        wordlist[5]
+    picked = wordlist.sample(5)
+    assert sorted(picked) == sorted(WORDS)
+    with pytest.raises(ValueError):
+        wordlist.sample(6)
+    with pytest.raises(ValueError):
+        WordList(b"XXXX" + bytes(20))
+
+
+def test_generate_password(tmp_path, monkeypatch):
+    (tmp_path / "wordlist-en.bin").write_bytes(pack_words(WORDS))
+    monkeypatch.setattr(pwgen, "_wordlists", {})
+    with patch("oktacli.pwgen.resource_filename",
+               side_effect=lambda pkg, name: str(tmp_path / name)):
+        words = pwgen.generate_password(3)
+        assert len(set(words)) == 3 and set(words) <= set(WORDS)
+        # loaded only once
+        assert pwgen.load_wordlist("en") is pwgen.load_wordlist("en")
+        batch = pwgen.generate_passwords(10, 2)
+        assert len(batch) == 10 and all(len(x) == 2 for x in batch)
+        with pytest.raises(ExitException):
+            pwgen.generate_password(3, lang="de")
+
+
+def test_sqlite_fallback(tmp_path, monkeypatch):
+    db = sqlite3.connect(str(tmp_path / "wordlist.sqlite"))
+    db.execute("CREATE TABLE Word (id INTEGER PRIMARY KEY, lang TEXT, "
+               "word TEXT)")
+    db.executemany("INSERT INTO Word (lang, word) VALUES (?, ?)",
+                   [("de", x + "\n") for x in WORDS])
+    db.commit()
+    db.close()
+    monkeypatch.setattr(pwgen, "_wordlists", {})
+    with patch("oktacli.pwgen.resource_filename",
+               side_effect=lambda pkg, name: str(tmp_path / name)):
+        assert sorted(pwgen.generate_password(5, lang="de")) == \
+            sorted(WORDS)
@@ -0,0 +1,83 @@
+import pytest
+from openpyxl import Workbook
+
+from oktacli.exceptions import ExitException
+from oktacli.readers import excel_reader, csv_reader, read_rows, CsvIndex
+
+
+def test_excel_reader(tmp_path):
+    file = str(tmp_path / "users.xlsx")
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["profile.login", "profile.title"])
+    ws.append(["user0", "Boss"])
+    ws.append([None, None])
+    ws.append(["user1", "Minion"])
+    wb.save(file)
+    rows = list(excel_reader(file))
+    assert rows == [
+        {"profile.login": "user0", "profile.title": "Boss"},
+        {"profile.login": "user1", "profile.title": "Minion"},
+    ]
+
+
+def test_csv_reader(tmp_path):
+    file = tmp_path / "users.csv"
+    file.write_text("profile.login;profile.title\n"
+                    "user0;Boss\n"
+                    ";\n"
+                    "user1;Minion\n", encoding="utf-8")
+    rows = list(csv_reader(str(file)))
+    assert [r["profile.title"] for r in rows] == ["Boss", "Minion"]
+
+
+def _write_users_csv(path, num):
+    lines = ["id,profile.login,profile.title"]
+    for i in range(num):
+        lines.append(f'id{i},user{i},"Title, with\nnewline {i}"')
+        if i % 3 == 0:
+            lines.append(",,")
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def test_read_rows_with_index(tmp_path):
+    file = tmp_path / "users.csv"
+    _write_users_csv(file, 50)
+    start, rows = read_rows(str(file), jump_to_user="user42")
+    rows = list(rows)
+    assert start == 42
+    assert [r["id"] for r in rows] == [f"id{i}" for i in range(42, 50)]
+    assert rows[0]["profile.title"] == "Title, with\nnewline 42"
+    assert (tmp_path / "users.csv.okta-index").is_file()
+    start, rows = read_rows(str(file), jump_to_index=10)
+    assert start == 10
+    assert next(rows)["id"] == "id10"
+    # must be the same as without index
+    _, rows_noidx = read_rows(str(file), jump_to_index=10, use_index=False)
+    assert list(rows) == list(rows_noidx)[1:]
+
+
+def test_read_rows_missing_user(tmp_path):
+    file = tmp_path / "users.csv"
+    _write_users_csv(file, 5)
+    for use_index in (True, False):
+        with pytest.raises(ExitException):
+            read_rows(str(file), jump_to_user="nobody", use_index=use_index)
+    with pytest.raises(ExitException):
+        read_rows(str(file), jump_to_index=99)
+
+
+def test_index_rebuilt_on_change(tmp_path):
+    file = tmp_path / "users.csv"
+    _write_users_csv(file, 5)
+    assert len(CsvIndex.open(str(file))) == 5
+    _write_users_csv(file, 8)
+    assert len(CsvIndex.open(str(file))) == 8
+
+
+def test_index_not_writable(tmp_path):
+    file = tmp_path / "users.csv"
+    _write_users_csv(file, 5)
+    with pytest.raises(ExitException) as e:
+        CsvIndex.open(str(file), str(tmp_path / "missing" / "users.idx"))
+    assert "--no-index" in str(e.value)
@@ -0,0 +1,47 @@
+import pytest
+
+from oktacli.schema import compile_schema, coerce_value, validate_row
+from .testdata import okta_user_schema
+
+
+specs = compile_schema(okta_user_schema)
+
+
+def test_compile_schema():
+    assert specs["profile.abool"].type == "boolean"
+    assert specs["profile.login"].required
+    assert specs["profile.login"].max_length == 100
+    assert not specs["profile.title"].required
+
+
+@pytest.mark.parametrize("field,value,wanted", [
+    ("profile.abool", "TRUE", True),
+    ("profile.abool", "no", False),
+    ("profile.anint", " 42", 42),
+    ("profile.anint", 42.0, 42),
+    ("profile.anint", "", None),
+    ("profile.title", 12345.0, "12345"),
+    ("profile.title", "", ""),
+])
+def test_coerce_value(field, value, wanted):
+    assert coerce_value(specs[field], value) == wanted
+
+
+@pytest.mark.parametrize("field,value", [
+    ("profile.abool", "maybe"),
+    ("profile.anint", "4.5"),
+    ("profile.firstName", ""),
+    ("profile.firstName", "x" * 51),
+    ("profile.login", "abc"),
+])
+def test_coerce_value_invalid(field, value):
+    with pytest.raises(ValueError):
+        coerce_value(specs[field], value)
+
+
+def test_validate_row():
+    row = {"profile.anint": "1", "profile.nope": "x",
+           "credentials.password.value": "secret"}
+    rv, errors = validate_row(specs, row)
+    assert rv == {"profile.anint": 1, "credentials.password.value": "secret"}
+    assert errors == ["profile.nope: unknown field"]
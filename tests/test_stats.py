@@ -0,0 +1,63 @@
+import json
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from oktacli import cli
+from oktacli.okta import Okta, REST
+from oktacli.stats import LatencyHistogram
+
+from .fakeokta import FakeOkta
+
+
+def test_histogram_percentiles():
+    hist = LatencyHistogram()
+    for i in range(1, 1001):
+        hist.add(i / 1000)
+    assert abs(hist.percentile(50) - 0.5) < 0.5 * 0.03
+    assert abs(hist.percentile(99) - 0.99) < 0.99 * 0.03
+    assert hist.percentile(100) == 1.0
+    assert dict(hist.cumulative())[1] == 1000
+    assert dict(hist.cumulative())[0.1] == 100
+    assert LatencyHistogram().percentile(50) is None
+
+
+def test_client_stats():
+    with FakeOkta() as fake:
+        fake.fail("GET", "/users", 503, 429)
+        okta = Okta(fake.url, "12ab", retries={"base_delay": 0.01})
+        with patch("oktacli.okta.time.sleep"):
+            okta.call_okta("/users", REST.get)
+        okta.call_okta("/users/00u00000000000000001", REST.get)
+    stats = okta.stats.as_dict()
+    users = stats["endpoints"]["/users"]
+    assert users["requests"] == 3
+    assert users["errors"] == 2
+    assert users["throttled"] == 1
+    assert users["retries"] == 2
+    assert users["bytes_received"] > 0
+    assert stats["total"]["requests"] == 4
+    assert stats["throttle_sleep"] >= 1
+    prom = okta.stats.to_prometheus()
+    assert 'okta_cli_requests_total{endpoint="/users"} 3' in prom
+    assert 'okta_cli_request_duration_seconds_count{' \
+        'endpoint="/users/{id}"} 1' in prom
+    assert "/users/{id}" in okta.stats.summary()
+
+
+@patch('oktacli.cli.get_manager')
+def test_stats_options(get_manager, tmp_path, monkeypatch):
+    monkeypatch.setitem(cli.client_options, "stats", False)
+    monkeypatch.setitem(cli.client_options, "stats_file", None)
+    with FakeOkta() as fake:
+        get_manager.return_value = Okta(fake.url, "12ab")
+        for name in ("stats.json", "stats.prom"):
+            result = CliRunner().invoke(cli.cli_main, [
+                "--stats", "--stats-file", str(tmp_path / name),
+                "users", "get", "00u00000000000000001"])
+            assert result.exit_code == 0
+            assert "TOTAL" in result.output
+    stats = json.loads((tmp_path / "stats.json").read_text())
+    assert stats["total"]["requests"] >= 1
+    assert "# TYPE okta_cli_requests_total counter" in \
+        (tmp_path / "stats.prom").read_text()
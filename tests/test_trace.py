@@ -0,0 +1,81 @@
+import json
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from oktacli import cli
+from oktacli.okta import Okta, REST
+from oktacli.trace import Tracer, read_trace, critical_path, \
+    concurrency_timeline, analyze
+
+from .fakeokta import FakeOkta
+
+
+def _request(seq, start, total, chain=None, endpoint="/users"):
+    return {"seq": seq, "start": start, "chain": chain, "method": "GET",
+            "endpoint": endpoint, "status": 200, "error": None,
+            "timings": {"connect": None, "tls": None, "total": total}}
+
+
+def test_trace_records(tmp_path):
+    trace_file = str(tmp_path / "trace.jsonl")
+    with FakeOkta() as fake:
+        fake.fail("GET", "/users", 503)
+        okta = Okta(fake.url, "secret-token",
+                    retries={"base_delay": 0.01})
+        okta.set_tracer(Tracer(trace_file))
+        okta.call_okta("/users", REST.get,
+                       params={"limit": 2, "token": "abc"})
+        okta.update_user("00u00000000000000001",
+                         {"profile": {"title": "Top secret"}})
+        okta.tracer.close()
+    content = open(trace_file).read()
+    assert "secret" not in content.lower()
+    requests, sleeps = read_trace(trace_file)
+    assert [(r["method"], r["status"], r["page"]) for r in requests] == [
+        ("GET", 503, 1), ("GET", 200, 1), ("GET", 200, 2), ("POST", 200, 1)]
+    assert requests[1]["attempt"] == 2
+    assert requests[2]["chain"] == requests[1]["seq"]
+    assert requests[2]["params"]["after"] == "00u00000000000000001"
+    assert requests[0]["params"]["token"] == "REDACTED"
+    assert requests[3]["sent"] > 0
+    # only the first request opened a connection
+    assert requests[0]["timings"]["connect"] is not None
+    assert requests[2]["timings"]["connect"] is None
+    assert [s["reason"] for s in sleeps] == ["backoff"]
+
+
+def test_critical_path():
+    requests = [
+        # a paginated listing ...
+        _request(1, 0.0, 1.0, chain=1),
+        _request(2, 1.1, 1.0, chain=1),
+        # ... and parallel requests
+        _request(3, 0.0, 0.5, endpoint="/users/{id}"),
+        _request(4, 0.6, 0.5, endpoint="/users/{id}"),
+        _request(5, 2.2, 0.3, endpoint="/groups"),
+    ]
+    path = critical_path(requests)
+    assert [r["seq"] for r, _ in path] == [1, 2, 5]
+    assert [round(gap, 2) for _, gap in path] == [0, 0.1, 0.1]
+    timeline = concurrency_timeline(requests, interval=1.0)
+    assert [x["started"] for x in timeline] == [3, 1, 1]
+    assert timeline[0]["max"] == 2
+    assert "critical path:     3 requests" in analyze(requests, [])
+
+
+@patch('oktacli.cli.get_manager')
+def test_trace_option(get_manager, tmp_path, monkeypatch):
+    monkeypatch.setitem(cli.client_options, "trace", None)
+    trace_file = str(tmp_path / "trace.jsonl")
+    with FakeOkta() as fake:
+        get_manager.return_value = Okta(fake.url, "12ab")
+        result = CliRunner().invoke(cli.cli_main, [
+            "--trace", trace_file, "users", "get", "00u00000000000000002"])
+        assert result.exit_code == 0
+    lines = open(trace_file).read().splitlines()
+    assert json.loads(lines[-1])["endpoint"] == "/users/{id}"
+    result = CliRunner().invoke(cli.cli_main,
+                                ["trace", "analyze", trace_file])
+    assert result.exit_code == 0
+    assert "GET /users/{id}" in result.output
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Runs okta-cli commands against a synthetic org served by the stand-in
+# Okta server of the tests (tests/fakeokta.py), and reports throughput and
+# peak memory per command. No Okta tenant or network needed.
+#
+# Usage:
+#   tools/bench-okta-commands.py -u 20000 -g 100 --groups-per-user 3 \
+#       --latency 0.02 --rate-limit 600
+#
+# Every command runs in its own subprocess, so the peak RSS numbers do not
+# influence each other. The server runs in this process.
+
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, REMAINDER
+from contextlib import redirect_stdout, redirect_stderr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tests.fakeokta import FakeOkta  # noqa: E402
+
+
+COMMANDS = ("users-list", "dump", "bulk-update", "apps-assignments",
+            "groups-clear")
+
+
+def run_one(args):
+    from oktacli.cli import cli_main
+    start = time.perf_counter()
+    exit_code = 0
+    with open(os.devnull, "w") as null, \
+            redirect_stdout(null), redirect_stderr(null):
+        try:
+            cli_main.main(args, standalone_mode=False)
+        except SystemExit as e:
+            exit_code = e.code
+    duration = time.perf_counter() - start
+    # ru_maxrss is in KiB on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": duration, "peak_rss_kb": peak_rss,
+                      "exit_code": exit_code}))
+
+
+def write_config(config_home, url):
+    config_dir = os.path.join(config_home, "okta-cli")
+    os.makedirs(config_dir)
+    with open(os.path.join(config_dir, "config.json"), "w") as outfile:
+        json.dump({"default": "bench",
+                   "profiles": {"bench": {"url": url,
+                                          "token": "bench-token"}}},
+                  outfile)
+
+
+def write_updates(file, fake, num_rows):
+    with open(file, "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(["profile.login", "profile.title"])
+        for idx, user in enumerate(list(fake.users.values())[:num_rows]):
+            writer.writerow([user["profile"]["login"], f"Title {idx}"])
+
+
+def doit():
+    parser = ArgumentParser()
+    parser.add_argument("-u", "--users", type=int, default=5000)
+    parser.add_argument("-g", "--groups", type=int, default=20)
+    parser.add_argument("-a", "--apps", type=int, default=5)
+    parser.add_argument("--groups-per-user", type=int, default=2)
+    parser.add_argument("--apps-per-user", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="server latency per request in seconds")
+    parser.add_argument("--rate-limit", type=int, default=None,
+                        help="requests per endpoint and minute")
+    parser.add_argument("--updates", type=int, default=1000,
+                        help="number of rows for bulk-update")
+    parser.add_argument("-c", "--command", dest="commands",
+                        action="append", choices=COMMANDS,
+                        help="run only these commands (repeatable)")
+    parser.add_argument("--run", nargs=REMAINDER, default=None,
+                        help=("(internal) run only this okta-cli command "
+                              "line and print the results as JSON"))
+    config = parser.parse_args()
+
+    if config.run:
+        run_one(config.run)
+        return
+
+    print(f"Generating {config.users} users, {config.groups} groups, "
+          f"{config.apps} apps ... ", end="", flush=True)
+    fake = FakeOkta(config.users, config.groups, config.apps,
+                    groups_per_user=config.groups_per_user,
+                    apps_per_user=config.apps_per_user,
+                    latency=config.latency, rate_limit=config.rate_limit)
+    print("done.")
+    # the biggest group, the last command empties it
+    biggest = max(fake.group_users, default=None,
+                  key=lambda x: len(fake.group_users[x]))
+    with fake, tempfile.TemporaryDirectory() as tmpdir:
+        write_config(tmpdir, fake.url)
+        updates = os.path.join(tmpdir, "updates.csv")
+        write_updates(updates, fake, config.updates)
+        command_lines = {
+            "users-list":   ["users", "list", "-j"],
+            "dump":         ["dump", "-d", os.path.join(tmpdir, "dump")],
+            "bulk-update":  ["users", "bulk-update", updates],
+            "apps-assignments": ["apps", "assignments", "--all"],
+            "groups-clear": ["groups", "clear", "-i", biggest or "none"],
+        }
+        env = dict(os.environ, XDG_CONFIG_HOME=tmpdir)
+        for name in config.commands or COMMANDS:
+            before = len(fake.requests)
+            out = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), "--run"] +
+                    command_lines[name], cwd=tmpdir, env=env)
+            res = json.loads(out.decode("utf-8"))
+            num_requests = len(fake.requests) - before
+            per_sec = num_requests / max(res["seconds"], 1e-9)
+            failed = "" if not res["exit_code"] else \
+                f"  (exit code {res['exit_code']})"
+            print(f"{name:16} {num_requests:>8} requests  "
+                  f"{res['seconds']:8.2f} s  {per_sec:>8.0f} req/s  "
+                  f"{res['peak_rss_kb'] / 1024:8.1f} MiB peak RSS{failed}")
+
+
+if __name__ == "__main__":
+    doit()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Compares the old (full object model) and the new (read-only, streaming)
+# way of reading bulk-update Excel files.
+#
+# Usage:
+#   tools/bench-xlsx-reader.py -r 200000 -c 20
+#
+# Every reader runs in its own subprocess, so the peak RSS numbers do not
+# influence each other.
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from openpyxl import Workbook, load_workbook
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from oktacli.readers import excel_reader  # noqa: E402
+
+
+def legacy_reader(file):
+    # the reader as it was used in "users bulk-update" before
+    wb = load_workbook(filename=file)
+    rows = wb.active.rows
+    keys = [c.value for c in next(rows)]
+    num_keys = len(keys)
+    for row in rows:
+        values = [c.value for c in row]
+        rv = dict(zip(keys, values[:num_keys]))
+        if any(rv.values()):
+            yield rv
+
+
+READERS = {
+    "legacy": legacy_reader,
+    "streaming": excel_reader,
+}
+
+
+def generate_workbook(file, num_rows, num_cols):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    headers = ["profile.login"] + [f"profile.field{i}"
+                                   for i in range(1, num_cols)]
+    ws.append(headers)
+    for row in range(num_rows):
+        ws.append([f"user{row}@example.com"] +
+                  [f"value-{row}-{col}" for col in range(1, num_cols)])
+    wb.save(file)
+
+
+def run_one(reader, file):
+    start = time.perf_counter()
+    count = sum(1 for _ in READERS[reader](file))
+    duration = time.perf_counter() - start
+    # ru_maxrss is in KiB on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"rows": count, "seconds": duration,
+                      "peak_rss_kb": peak_rss}))
+
+
+def doit():
+    parser = ArgumentParser()
+    parser.add_argument("-r", "--rows", type=int, default=100000)
+    parser.add_argument("-c", "--columns", type=int, default=10)
+    parser.add_argument("-f", "--file", default=None,
+                        help="use this workbook instead of generating one")
+    parser.add_argument("--run", choices=READERS.keys(), default=None,
+                        help=("(internal) run only this reader and print "
+                              "the results as JSON"))
+    config = parser.parse_args()
+
+    if config.run:
+        run_one(config.run, config.file)
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file = config.file
+        if file is None:
+            file = os.path.join(tmpdir, "bench.xlsx")
+            print(f"Generating {config.rows} rows x {config.columns} "
+                  f"columns ... ", end="", flush=True)
+            generate_workbook(file, config.rows, config.columns)
+            print("done.")
+        for reader in READERS:
+            out = subprocess.check_output(
+                    [sys.executable, __file__, "--run", reader, "-f", file])
+            res = json.loads(out.decode("utf-8"))
+            rows_per_sec = res["rows"] / max(res["seconds"], 1e-9)
+            print(f"{reader:10}  {res['rows']:>9} rows  "
+                  f"{res['seconds']:8.2f} s  {rows_per_sec:>10.0f} rows/s  "
+                  f"{res['peak_rss_kb'] / 1024:8.1f} MiB peak RSS")
+
+
+if __name__ == "__main__":
+    doit()
@@ -1,34 +1,98 @@
 #!/usr/bin/env python3
 
-from pony.orm import Database, Required, db_session, delete
+# Imports a word list (one word per line) for 'pw set -g'.
+#
+# Usage:
+#   tools/import-wordlist.py -f words-en.txt -l en
+#
+# writes oktacli/wordlist-en.bin in the packed format of oktacli.pwgen.
+# With -d the words are (also) written into an SQLite database, as older
+# versions of okta-cli used it.
+#
+# The file is read line by line. Words are stripped, normalized to Unicode
+# NFC, and duplicates are dropped, all in the same pass.
 
+import os
+import sqlite3
+import sys
+import unicodedata
 from argparse import ArgumentParser
+from itertools import islice
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 
-db = Database()
+from oktacli.pwgen import HEADER, pack_words  # noqa: E402
 
 
-class Word(db.Entity):
-    lang = Required(str)
-    word = Required(str)
+BATCH_SIZE = 10000
+
+
+def read_words(file):
+    seen = set()
+    with open(file, "r", encoding="utf-8") as wordsfile:
+        for line in wordsfile:
+            word = unicodedata.normalize("NFC", line.strip())
+            if word and word not in seen:
+                seen.add(word)
+                yield word
+
+
+def write_packed(file, words):
+    data = pack_words(words)
+    tmp_file = file + ".tmp"
+    with open(tmp_file, "wb") as outfile:
+        outfile.write(data)
+    # replace atomically, running processes keep their mapped copy
+    os.replace(tmp_file, file)
+    return HEADER.unpack_from(data)[2]
+
+
+def write_sqlite(file, lang, words):
+    db = sqlite3.connect(file)
+    with db:
+        db.execute("CREATE TABLE IF NOT EXISTS Word ("
+                   "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "lang TEXT NOT NULL, word TEXT NOT NULL)")
+        # delete all LANG words from database, then import the new ones
+        db.execute("DELETE FROM Word WHERE lang = ?", (lang,))
+        count = 0
+        words = iter(words)
+        while True:
+            batch = [(lang, word) for word in islice(words, BATCH_SIZE)]
+            if not batch:
+                break
+            db.executemany("INSERT INTO Word (lang, word) VALUES (?, ?)",
+                           batch)
+            count += len(batch)
+        # after the inserts, that's faster for a new table
+        db.execute("CREATE INDEX IF NOT EXISTS idx_word__lang "
+                   "ON Word (lang)")
+    db.close()
+    return count
 
 
 def doit():
     parser = ArgumentParser()
-    parser.add_argument("-d", "--database", required=True)
     parser.add_argument("-f", "--wordsfile", required=True)
     parser.add_argument("-l", "--language", required=True)
+    parser.add_argument("-o", "--output", default=None,
+                        help=("the packed word list, default: "
+                              "oktacli/wordlist-LANGUAGE.bin"))
+    parser.add_argument("-d", "--database", default=None,
+                        help=("write the words into this SQLite database "
+                              "instead"))
     config = parser.parse_args()
 
-    db.bind("sqlite", filename=config.database, create_db=True)
-    db.generate_mapping(create_tables=True)
-    with open(config.wordsfile, "r") as wordsfile:
-        with db_session:
-            # delete all LANG words from database
-            delete(w for w in Word if w.lang == config.language)
-            # import new wordlist for language
-            for word in wordsfile.readlines():
-                Word(lang=config.language, word=word)
+    words = read_words(config.wordsfile)
+    if config.database:
+        target = config.database
+        count = write_sqlite(target, config.language, words)
+    else:
+        target = config.output or os.path.join(
+                os.path.dirname(__file__), "..", "oktacli",
+                f"wordlist-{config.language}.bin")
+        count = write_packed(target, words)
+    print(f"{count} words imported into {target}.")
 
 
 if __name__ == "__main__":